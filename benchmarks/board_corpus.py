@@ -0,0 +1,291 @@
+"""Renders labelled board images, to measure how well and how fast
+`image_processing` reads boards (see `benchmarks.ocr_eval`).
+
+Every image shows a board from a random point of a game, drawn with a random
+variation: symbols as pen strokes or as glyphs of a font, stroke width, cell
+resolution, rotation, noise, margin around the grid and JPEG quality. The
+labels go to `labels.ndjson` next to the images, one line per image with its
+file name, the board as rows of `Symbol` values and the variation. `--clean`
+leaves out rotation, noise and JPEG compression, for a baseline.
+
+    python -m benchmarks.board_corpus --count 2000 --output corpus --seed 0
+    python -m benchmarks.board_corpus --font /usr/share/fonts/DejaVuSans.ttf
+"""
+
+from __future__ import annotations
+from typing import Any, Optional, Union
+import argparse
+import dataclasses
+import io
+import json
+import pathlib
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+
+from server.game_state import DEFAULT_BOARD_SIZE, Symbol
+
+LABELS_FILENAME = "labels.ndjson"
+# Pillow's own font, for glyphs without `--font`. Before Pillow 10.1 it is a
+# small bitmap font, whose glyphs are scaled up to the cell.
+DEFAULT_FONT = "default"
+STYLE_STROKES = "strokes"
+STYLE_FONT = "font"
+
+# Every variation is picked from these, so that results can be grouped by
+# any of them.
+STYLES = (STYLE_STROKES, STYLE_FONT)
+CELL_PIXELS = (48, 96, 192)
+# As a fraction of the cell side.
+STROKE_WIDTHS = (0.03, 0.06, 0.1)
+ROTATION_DEGREES = (0, 0, -2, 2, -5, 5)
+# Standard deviation of gaussian pixel noise.
+NOISE_LEVELS = (0, 8, 24)
+# None saves a PNG.
+JPEG_QUALITIES = (None, 95, 75, 50, 25)
+# Blank space around the grid, as a fraction of the cell side.
+MARGINS = (0.0, 0.3, 1.0)
+# Symbols are drawn this far in from the cell sides, as a fraction of them.
+SYMBOL_PADDING = 0.22
+# Pen strokes end up to this far from where they are aimed.
+STROKE_JITTER = 0.06
+
+
+@dataclasses.dataclass(frozen=True)
+class Variation:
+    style: str
+    font: str
+    cell_pixels: int
+    stroke_width: float
+    rotation_degrees: int
+    noise: int
+    jpeg_quality: Optional[int]
+    margin: float
+
+
+def random_variation(
+    rng: random.Random,
+    fonts: list[str],
+    margins: tuple[float, ...] = MARGINS,
+    clean: bool = False,
+) -> Variation:
+    style = rng.choice(STYLES)
+    return Variation(
+        style=style,
+        font=rng.choice(fonts) if style == STYLE_FONT else "",
+        cell_pixels=rng.choice(CELL_PIXELS),
+        stroke_width=rng.choice(STROKE_WIDTHS),
+        rotation_degrees=0 if clean else rng.choice(ROTATION_DEGREES),
+        noise=0 if clean else rng.choice(NOISE_LEVELS),
+        jpeg_quality=None if clean else rng.choice(JPEG_QUALITIES),
+        margin=rng.choice(margins),
+    )
+
+
+def random_board(
+    rng: random.Random, size: int = DEFAULT_BOARD_SIZE
+) -> list[list[Symbol]]:
+    """A board after a random number of alternating moves, X first."""
+    cells = rng.sample(range(size * size), rng.randint(0, size * size))
+    board = [[Symbol.EMPTY] * size for _ in range(size)]
+    for turn, cell in enumerate(cells):
+        board[cell // size][cell % size] = Symbol.X if turn % 2 == 0 else Symbol.O
+    return board
+
+
+def _load_font(
+    font: str, pixels: int
+) -> Optional[Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]]:
+    """The font at `pixels` size, or None for Pillow's bitmap font, which
+    has no sizes."""
+    if font != DEFAULT_FONT:
+        return ImageFont.truetype(font, pixels)
+    try:
+        return ImageFont.load_default(pixels)
+    except TypeError:
+        return None
+
+
+def _draw_scaled_glyph(
+    draw: ImageDraw.ImageDraw, text: str, box: tuple[int, int, int, int], ink: int
+) -> None:
+    glyph = Image.new("L", (32, 32), 0)
+    ImageDraw.Draw(glyph).text((0, 0), text, fill=255, font=ImageFont.load_default())
+    bounds = glyph.getbbox()
+    if bounds is None:
+        return
+    left, top, right, bottom = box
+    mask = glyph.crop(bounds).resize(
+        (right - left, bottom - top), resample=Image.Resampling.BILINEAR
+    )
+    draw.bitmap((left, top), mask, fill=ink)
+
+
+def _jittered(rng: random.Random, point: float, cell: int) -> float:
+    return point + rng.uniform(-STROKE_JITTER, STROKE_JITTER) * cell
+
+
+def _draw_symbol(
+    draw: ImageDraw.ImageDraw,
+    symbol: Symbol,
+    box: tuple[int, int, int, int],
+    variation: Variation,
+    ink: int,
+    rng: random.Random,
+) -> None:
+    cell = variation.cell_pixels
+    width = max(1, round(variation.stroke_width * cell))
+    left, top, right, bottom = box
+    if variation.style == STYLE_FONT:
+        font = _load_font(variation.font, bottom - top)
+        if font is None:
+            _draw_scaled_glyph(draw, symbol.value, box, ink)
+            return
+        center = ((left + right) / 2, (top + bottom) / 2)
+        draw.text(center, symbol.value, fill=ink, font=font, anchor="mm")
+        return
+    if symbol == Symbol.X:
+        for start, end in [
+            ((left, top), (right, bottom)),
+            ((left, bottom), (right, top)),
+        ]:
+            draw.line(
+                [
+                    (_jittered(rng, start[0], cell), _jittered(rng, start[1], cell)),
+                    (_jittered(rng, end[0], cell), _jittered(rng, end[1], cell)),
+                ],
+                fill=ink,
+                width=width,
+            )
+    else:
+        draw.ellipse(
+            [
+                _jittered(rng, left, cell),
+                _jittered(rng, top, cell),
+                _jittered(rng, right, cell),
+                _jittered(rng, bottom, cell),
+            ],
+            outline=ink,
+            width=width,
+        )
+
+
+def render(
+    board: list[list[Symbol]], variation: Variation, rng: random.Random
+) -> bytes:
+    """The encoded image, a JPEG or a PNG."""
+    cell = variation.cell_pixels
+    margin = round(variation.margin * cell)
+    grid = cell * len(board)
+    side = grid + 2 * margin
+    background = rng.randint(200, 255)
+    ink = rng.randint(0, 60)
+    image = Image.new("L", (side, side), background)
+    draw = ImageDraw.Draw(image)
+    line_width = max(1, round(variation.stroke_width * cell / 2))
+    for line in range(1, len(board)):
+        offset = margin + line * cell
+        draw.line(
+            [(offset, margin), (offset, margin + grid)], fill=ink, width=line_width
+        )
+        draw.line(
+            [(margin, offset), (margin + grid, offset)], fill=ink, width=line_width
+        )
+    padding = round(SYMBOL_PADDING * cell)
+    for row, symbols in enumerate(board):
+        for col, symbol in enumerate(symbols):
+            if symbol == Symbol.EMPTY:
+                continue
+            left = margin + col * cell + padding
+            top = margin + row * cell + padding
+            box = (left, top, left + cell - 2 * padding, top + cell - 2 * padding)
+            _draw_symbol(draw, symbol, box, variation, ink, rng)
+    if variation.rotation_degrees:
+        image = image.rotate(
+            variation.rotation_degrees,
+            resample=Image.Resampling.BICUBIC,
+            fillcolor=background,
+        )
+    if variation.noise:
+        pixels = np.asarray(image, dtype=np.float32)
+        noise = np.random.default_rng(rng.getrandbits(32)).normal(
+            0, variation.noise, pixels.shape
+        )
+        image = Image.fromarray(np.clip(pixels + noise, 0, 255).astype(np.uint8))
+    output = io.BytesIO()
+    if variation.jpeg_quality is None:
+        image.save(output, format="PNG")
+    else:
+        image.save(output, format="JPEG", quality=variation.jpeg_quality)
+    return output.getvalue()
+
+
+def read_labels(corpus: pathlib.Path) -> list[dict[str, Any]]:
+    with open(corpus / LABELS_FILENAME) as labels:
+        return [json.loads(line) for line in labels]
+
+
+def generate(
+    output: pathlib.Path,
+    count: int,
+    fonts: list[str],
+    margins: tuple[float, ...] = MARGINS,
+    seed: Optional[int] = None,
+    clean: bool = False,
+) -> None:
+    rng = random.Random(seed)
+    output.mkdir(parents=True, exist_ok=True)
+    with open(output / LABELS_FILENAME, "w") as labels:
+        for index in range(count):
+            board = random_board(rng)
+            variation = random_variation(rng, fonts, margins, clean)
+            extension = "png" if variation.jpeg_quality is None else "jpg"
+            filename = f"{index:06d}.{extension}"
+            (output / filename).write_bytes(render(board, variation, rng))
+            label = {
+                "file": filename,
+                "board": ["".join(symbol.value for symbol in row) for row in board],
+                "variation": dataclasses.asdict(variation),
+            }
+            labels.write(json.dumps(label) + "\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("corpus"))
+    parser.add_argument(
+        "--font",
+        action="append",
+        default=[],
+        help="TrueType font for glyphs, can be repeated. Pillow's own by default",
+    )
+    parser.add_argument(
+        "--margin",
+        type=float,
+        action="append",
+        help="blank space around the grid as a fraction of a cell, can be repeated",
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--clean",
+        action="store_true",
+        help="without rotation, noise and JPEG compression",
+    )
+    args = parser.parse_args()
+    generate(
+        args.output,
+        args.count,
+        args.font or [DEFAULT_FONT],
+        tuple(args.margin) if args.margin else MARGINS,
+        args.seed,
+        args.clean,
+    )
+    print(f"Wrote {args.count} images to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
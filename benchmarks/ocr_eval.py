@@ -0,0 +1,223 @@
+"""Reads a corpus from `benchmarks.board_corpus` with `image_processing` on a
+process pool, and reports how many cells were read right, a confusion matrix
+of the symbols and the images read per second.
+
+Images per second per core divides the throughput by the worker count. CPU
+milliseconds per image only counts the time the workers, and the tesseract
+processes they start, spent recognizing, which doesn't depend on how busy the
+machine is. `--by` breaks the accuracy down by a variation, to see which ones
+the recognition struggles with.
+
+    python -m benchmarks.ocr_eval corpus --workers 4 --classifier shape
+    python -m benchmarks.ocr_eval corpus --by rotation_degrees --by noise
+"""
+
+from __future__ import annotations
+from typing import Any
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import io
+import json
+import multiprocessing
+import os
+import pathlib
+import time
+
+from server.game_state import Symbol
+from benchmarks import board_corpus
+
+SYMBOLS = (Symbol.X, Symbol.O, Symbol.EMPTY)
+
+
+def cpu_seconds() -> float:
+    """The CPU time of this process and of its child processes that ended,
+    like the tesseract ones."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def recognize(path: str, size: int, classifier: str) -> tuple[list[str], float]:
+    """The board as rows of `Symbol` values, and the CPU seconds it took."""
+    from server import image_processing
+
+    data = pathlib.Path(path).read_bytes()
+    start = cpu_seconds()
+    board = image_processing.get_board_from_file(
+        io.BytesIO(data), size=size, classifier=image_processing.CLASSIFIERS[classifier]
+    )
+    seconds = cpu_seconds() - start
+    return ["".join(symbol.value for symbol in row) for row in board], seconds
+
+
+@dataclasses.dataclass
+class Tally:
+    cells: int = 0
+    correct_cells: int = 0
+    boards: int = 0
+    correct_boards: int = 0
+
+    def add(self, expected: list[str], recognized: list[str]) -> None:
+        matches = sum(
+            want == got
+            for want_row, got_row in zip(expected, recognized)
+            for want, got in zip(want_row, got_row)
+        )
+        cells = sum(len(row) for row in expected)
+        self.cells += cells
+        self.correct_cells += matches
+        self.boards += 1
+        self.correct_boards += matches == cells
+
+    @property
+    def cell_accuracy(self) -> float:
+        return self.correct_cells / self.cells if self.cells else 0.0
+
+    @property
+    def board_accuracy(self) -> float:
+        return self.correct_boards / self.boards if self.boards else 0.0
+
+
+@dataclasses.dataclass
+class Report:
+    classifier: str
+    workers: int
+    elapsed_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    total: Tally = dataclasses.field(default_factory=Tally)
+    # Cells by expected and recognized symbol value.
+    confusion: collections.Counter[tuple[str, str]] = dataclasses.field(
+        default_factory=collections.Counter
+    )
+    # Tallies by variation name and value.
+    by_variation: dict[str, dict[str, Tally]] = dataclasses.field(default_factory=dict)
+
+    @property
+    def images_per_second(self) -> float:
+        return self.total.boards / self.elapsed_seconds
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "classifier": self.classifier,
+            "workers": self.workers,
+            "images": self.total.boards,
+            "cell_accuracy": self.total.cell_accuracy,
+            "board_accuracy": self.total.board_accuracy,
+            "images_per_second": self.images_per_second,
+            "images_per_second_per_core": self.images_per_second / self.workers,
+            "cpu_seconds_per_image": self.cpu_seconds / self.total.boards,
+            "confusion": {
+                expected.value: {
+                    recognized.value: self.confusion[expected.value, recognized.value]
+                    for recognized in SYMBOLS
+                }
+                for expected in SYMBOLS
+            },
+            "by_variation": {
+                name: {
+                    value: {
+                        "images": tally.boards,
+                        "cell_accuracy": tally.cell_accuracy,
+                        "board_accuracy": tally.board_accuracy,
+                    }
+                    for value, tally in sorted(tallies.items())
+                }
+                for name, tallies in self.by_variation.items()
+            },
+        }
+
+    def format(self) -> str:
+        lines = [
+            f"{self.total.boards} images with {self.classifier} "
+            f"on {self.workers} workers",
+            f"cell accuracy  {self.total.cell_accuracy:.2%}",
+            f"board accuracy {self.total.board_accuracy:.2%}",
+            f"images/s       {self.images_per_second:.1f}",
+            f"images/s/core  {self.images_per_second / self.workers:.1f}",
+            f"cpu ms/image   {1000 * self.cpu_seconds / self.total.boards:.1f}",
+            "",
+            "expected \\ recognized" + "".join(f"{s.value:>10}" for s in SYMBOLS),
+        ]
+        for expected in SYMBOLS:
+            counts = "".join(
+                f"{self.confusion[expected.value, recognized.value]:>10}"
+                for recognized in SYMBOLS
+            )
+            lines.append(f"{expected.value:<21}{counts}")
+        for name, tallies in self.by_variation.items():
+            lines += ["", f"{name:<21}{'images':>10}{'cells':>10}{'boards':>10}"]
+            for value, tally in sorted(tallies.items()):
+                lines.append(
+                    f"{value:<21}{tally.boards:>10}"
+                    f"{tally.cell_accuracy:>10.2%}{tally.board_accuracy:>10.2%}"
+                )
+        return "\n".join(lines)
+
+
+def evaluate(
+    corpus: pathlib.Path,
+    classifier: str,
+    workers: int,
+    by: list[str],
+    chunk_size: int = 16,
+) -> Report:
+    labels = board_corpus.read_labels(corpus)
+    report = Report(classifier, workers, by_variation={name: {} for name in by})
+    paths = [str(corpus / label["file"]) for label in labels]
+    sizes = [len(label["board"]) for label in labels]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        # Starts the workers and imports the image stack before the clock.
+        list(
+            executor.map(
+                recognize, paths[:workers], sizes[:workers], [classifier] * workers
+            )
+        )
+        start = time.perf_counter()
+        results = list(
+            executor.map(
+                recognize,
+                paths,
+                sizes,
+                [classifier] * len(paths),
+                chunksize=chunk_size,
+            )
+        )
+        report.elapsed_seconds = time.perf_counter() - start
+    for label, (recognized, seconds) in zip(labels, results):
+        expected = label["board"]
+        report.cpu_seconds += seconds
+        report.total.add(expected, recognized)
+        for want_row, got_row in zip(expected, recognized):
+            for want, got in zip(want_row, got_row):
+                report.confusion[want, got] += 1
+        for name, tallies in report.by_variation.items():
+            value = str(label["variation"][name])
+            tallies.setdefault(value, Tally()).add(expected, recognized)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("corpus", type=pathlib.Path)
+    parser.add_argument("--classifier", default="shape")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--by",
+        action="append",
+        default=[],
+        choices=[field.name for field in dataclasses.fields(board_corpus.Variation)],
+        help="break the accuracy down by this variation, can be repeated",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    report = evaluate(args.corpus, args.classifier, args.workers, args.by)
+    print(json.dumps(report.to_json(), indent=2) if args.json else report.format())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Times the game logic, the image recognition stages, the endpoints and the
+start up of the server and the cli, and compares the results with a stored
+baseline.
+
+Every benchmark reports the best time per call over a few repeats. A
+benchmark that got slower than its baseline by more than the threshold is a
+regression, and makes the run exit with status 1. Baselines are only
+comparable on the machine they were recorded on, so record one first:
+
+    python -m benchmarks.suite --save-baseline
+    python -m benchmarks.suite --threshold 0.2
+    python -m benchmarks.suite --filter image
+"""
+
+from __future__ import annotations
+from typing import Any, Callable, Optional
+import argparse
+import dataclasses
+import io
+import json
+import pathlib
+import random
+import subprocess
+import sys
+import time
+import uuid
+
+from fastapi import testclient
+from PIL import Image
+import numpy as np
+
+from server import image_processing, server_main
+from server.game_state import BoardShape, GameState, Move, Symbol, get_board_shape
+from t3_client import loadtest
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+IMAGES = {
+    "example": REPO_DIR / "tic-tac-toe-example.png",
+    "hand_drawn": REPO_DIR / "hand_drawn.jpg",
+}
+DEFAULT_BASELINE = pathlib.Path(__file__).resolve().parent / "baseline.json"
+# A 3x3 game that is drawn, so it takes the most turns.
+DRAWN_GAME = [Move(row, col) for row, col in loadtest.DRAWN_GAME]
+# Moves on a 15x15 five-in-a-row board that don't end the game.
+LARGE_GAME = [
+    Move(row, (row * 4 + turn) % 15) for turn in range(2) for row in range(15)
+]
+
+# A benchmark runs `loops` calls and returns the seconds they took, leaving
+# out its own setup.
+Benchmark = Callable[[int], float]
+
+
+class Skipped(Exception):
+    pass
+
+
+def new_game(shape: Optional[BoardShape] = None) -> GameState:
+    game = GameState(uuid.uuid4(), "player1", shape)
+    game.first_player_starts = True
+    game.current_turn_first_player = True
+    return game
+
+
+def bench_play_turn(moves: list[Move], shape: BoardShape) -> Benchmark:
+    def run(loops: int) -> float:
+        games = [new_game(shape) for _ in range(loops)]
+        start = time.perf_counter()
+        for game in games:
+            for move in moves:
+                game.play_turn(move)
+        return (time.perf_counter() - start) / len(moves)
+
+    return run
+
+
+def bench_is_winning_move(loops: int) -> float:
+    game = new_game()
+    for move in DRAWN_GAME[:-1]:
+        game.play_turn(move)
+    is_winning_move = game._is_winning_move
+    move = DRAWN_GAME[-2]
+    start = time.perf_counter()
+    for _ in range(loops):
+        is_winning_move(move)
+    return time.perf_counter() - start
+
+
+def bench_get_move_difference(loops: int) -> float:
+    game = new_game()
+    for move in DRAWN_GAME[:4]:
+        game.play_turn(move)
+    board = game.game_state
+    board[DRAWN_GAME[4].row][DRAWN_GAME[4].col] = Symbol.X
+    start = time.perf_counter()
+    for _ in range(loops):
+        game.get_move_difference(board)
+    return time.perf_counter() - start
+
+
+def bench_preprocess_image(path: pathlib.Path) -> Benchmark:
+    data = path.read_bytes()
+
+    def run(loops: int) -> float:
+        start = time.perf_counter()
+        for _ in range(loops):
+            with Image.open(io.BytesIO(data)) as image:
+                image_processing.preprocess_image(image)
+        return time.perf_counter() - start
+
+    return run
+
+
+def preprocessed(path: pathlib.Path) -> image_processing.Pixels:
+    with Image.open(path) as image:
+        return np.asarray(image_processing.preprocess_image(image))
+
+
+def bench_crop_cell(loops: int) -> float:
+    pixels = preprocessed(IMAGES["example"])
+    start = time.perf_counter()
+    for _ in range(loops):
+        for row in range(3):
+            for col in range(3):
+                image_processing.crop_cell(pixels, row=row, col=col)
+    return (time.perf_counter() - start) / 9
+
+
+def bench_get_char_from_image(loops: int) -> float:
+    cell = Image.fromarray(
+        image_processing.crop_cell(preprocessed(IMAGES["example"]), row=0, col=0)
+    )
+    try:
+        image_processing.get_char_from_image(cell)
+    except OSError:  # pytesseract.TesseractNotFoundError
+        raise Skipped("tesseract isn't installed")
+    start = time.perf_counter()
+    for _ in range(loops):
+        image_processing.get_char_from_image(cell)
+    return time.perf_counter() - start
+
+
+def bench_get_board_from_file(path: pathlib.Path, classifier: str) -> Benchmark:
+    data = path.read_bytes()
+    cell_classifier = image_processing.CLASSIFIERS[classifier]
+
+    def run(loops: int) -> float:
+        start = time.perf_counter()
+        for _ in range(loops):
+            image_processing.get_board_from_file(
+                io.BytesIO(data), classifier=cell_classifier
+            )
+        return time.perf_counter() - start
+
+    return run
+
+
+def started_games(client: testclient.TestClient, count: int) -> list[dict[str, str]]:
+    """`count` joined games, with `game_id` and the `player_token` of the
+    player whose turn it is."""
+    items = [{"player_name": "player1"}] * count
+    created = client.post("/batch/new_game", json={"items": items}).json()["results"]
+    items = [
+        {"game_id": result["body"]["game_id"], "player_name": "player2"}
+        for result in created
+    ]
+    joined = client.post("/batch/join", json={"items": items}).json()["results"]
+    games = []
+    for first, second in zip(created, joined):
+        game_id = first["body"]["game_id"]
+        current_turn = client.get(f"/{game_id}").json()["current_turn"]
+        player = first if current_turn == "first_player" else second
+        games.append(
+            {"game_id": game_id, "player_token": player["body"]["player_token"]}
+        )
+    return games
+
+
+def bench_endpoint(
+    prepare: Callable[[testclient.TestClient, int], list[dict[str, Any]]],
+) -> Benchmark:
+    def run(loops: int) -> float:
+        # Like the tests, this skips the app's lifespan, so games are kept in
+        # memory only.
+        client = testclient.TestClient(server_main.app)
+        requests = prepare(client, loops)
+        start = time.perf_counter()
+        for request in requests:
+            client.request(**request).raise_for_status()
+        return time.perf_counter() - start
+
+    return run
+
+
+def new_game_requests(
+    client: testclient.TestClient, loops: int
+) -> list[dict[str, Any]]:
+    return [
+        {"method": "POST", "url": "/new_game", "json": {"player_name": "player1"}}
+    ] * loops
+
+
+def get_game_requests(
+    client: testclient.TestClient, loops: int
+) -> list[dict[str, Any]]:
+    game_id = started_games(client, 1)[0]["game_id"]
+    return [{"method": "GET", "url": f"/{game_id}"}] * loops
+
+
+def play_turn_requests(
+    client: testclient.TestClient, loops: int
+) -> list[dict[str, Any]]:
+    return [
+        {
+            "method": "POST",
+            "url": f"/{game['game_id']}/play_turn",
+            "headers": {"x-player-token": game["player_token"]},
+            "json": {"row": 0, "column": 0},
+        }
+        for game in started_games(client, loops)
+    ]
+
+
+def play_turn_image_requests(
+    client: testclient.TestClient, loops: int
+) -> list[dict[str, Any]]:
+    rng = random.Random()
+    board = [["X", "_", "_"], ["_", "_", "_"], ["_", "_", "_"]]
+    return [
+        {
+            "method": "POST",
+            "url": f"/{game['game_id']}/play_turn_image",
+            "headers": {"x-player-token": game["player_token"]},
+            # Every image is different, so none is served from the cache.
+            "files": {"image_file": loadtest.render_board(board, rng)},
+        }
+        for game in started_games(client, loops)
+    ]
+
+
+def bench_startup(*args: str) -> Benchmark:
+    """Runs Python with `args` in a fresh process, to time the imports a cold
+    start pays for."""
+
+    def run(loops: int) -> float:
+        start = time.perf_counter()
+        for _ in range(loops):
+            subprocess.run(
+                [sys.executable, *args],
+                cwd=REPO_DIR,
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+        return time.perf_counter() - start
+
+    return run
+
+
+BENCHMARKS: dict[str, Benchmark] = {
+    "game.play_turn.3x3": bench_play_turn(DRAWN_GAME, get_board_shape()),
+    "game.play_turn.15x15": bench_play_turn(LARGE_GAME, get_board_shape(15, 5)),
+    "game.is_winning_move": bench_is_winning_move,
+    "game.get_move_difference": bench_get_move_difference,
+    **{
+        f"image.preprocess_image.{name}": bench_preprocess_image(path)
+        for name, path in IMAGES.items()
+    },
+    "image.crop_cell": bench_crop_cell,
+    "image.get_char_from_image": bench_get_char_from_image,
+    **{
+        f"image.get_board_from_file.{name}.{classifier}": bench_get_board_from_file(
+            path, classifier
+        )
+        for name, path in IMAGES.items()
+        for classifier in ["shape", "shape+tesseract"]
+    },
+    "endpoint.new_game": bench_endpoint(new_game_requests),
+    "endpoint.get_game": bench_endpoint(get_game_requests),
+    "endpoint.play_turn": bench_endpoint(play_turn_requests),
+    "endpoint.play_turn_image": bench_endpoint(play_turn_image_requests),
+    # The interpreter on its own, which the other start ups include.
+    "startup.python": bench_startup("-c", "pass"),
+    "startup.server": bench_startup("-c", "import server.server_main"),
+    "startup.client.help": bench_startup("-m", "t3_client.client_main", "--help"),
+    # What the commands other than `loadtest` import.
+    "startup.client.command": bench_startup(
+        "-c", "import t3_client.client_main, t3_client.client"
+    ),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class Timing:
+    name: str
+    seconds_per_call: float
+    baseline: Optional[float]
+
+    @property
+    def ratio(self) -> Optional[float]:
+        return None if self.baseline is None else self.seconds_per_call / self.baseline
+
+
+def measure(benchmark: Benchmark, min_seconds: float, repeats: int) -> float:
+    """The best seconds per call, with enough calls per repeat to take at
+    least `min_seconds`."""
+    loops = 1
+    while (elapsed := benchmark(loops)) < min_seconds and loops < 1 << 24:
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_seconds / elapsed) + 1))
+    best = elapsed / loops
+    for _ in range(repeats - 1):
+        best = min(best, benchmark(loops) / loops)
+    return best
+
+
+def format_seconds(seconds: float) -> str:
+    for unit, scale in [("s", 1.0), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--baseline", type=pathlib.Path, default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="slowdown over the baseline that counts as a regression, 0.25 is 25%%",
+    )
+    parser.add_argument("--filter", default="", help="only run names containing this")
+    parser.add_argument("--min-seconds", type=float, default=0.2)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline: dict[str, float] = (
+        json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    )
+    timings = []
+    print(f"{'benchmark':<48}{'per call':>12}{'baseline':>12}{'change':>9}")
+    for name, benchmark in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        try:
+            seconds = measure(benchmark, args.min_seconds, args.repeats)
+        except Skipped as reason:
+            print(f"{name:<48}  skipped, {reason}")
+            continue
+        timing = Timing(name, seconds, baseline.get(name))
+        timings.append(timing)
+        change = "" if timing.ratio is None else f"{timing.ratio - 1:+.0%}"
+        recorded = "" if timing.baseline is None else format_seconds(timing.baseline)
+        print(f"{name:<48}{format_seconds(seconds):>12}{recorded:>12}{change:>9}")
+
+    if args.save_baseline:
+        baseline.update({timing.name: timing.seconds_per_call for timing in timings})
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"Saved the baseline to {args.baseline}")
+        return
+
+    regressions = [
+        timing.name
+        for timing in timings
+        if timing.ratio is not None and timing.ratio > 1 + args.threshold
+    ]
+    if regressions:
+        print(f"Slower than the baseline by over {args.threshold:.0%}:")
+        print("\n".join(f"  {name}" for name in regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from typing import Union
+import dataclasses
+import pathlib
+import random
+import subprocess
+import sys
+
+import pytest
+from PIL import ImageFont
+
+from benchmarks import board_corpus, ocr_eval
+
+
+def test_corpus_round_trip(tmp_path: pathlib.Path) -> None:
+    board_corpus.generate(tmp_path / "a", 10, [board_corpus.DEFAULT_FONT], seed=0)
+    board_corpus.generate(tmp_path / "b", 10, [board_corpus.DEFAULT_FONT], seed=0)
+    labels = board_corpus.read_labels(tmp_path / "a")
+    assert labels == board_corpus.read_labels(tmp_path / "b")
+    assert len(labels) == 10
+    fields = {field.name for field in dataclasses.fields(board_corpus.Variation)}
+    for label in labels:
+        assert (tmp_path / "a" / label["file"]).exists()
+        assert len(label["board"]) == 3
+        assert all(len(row) == 3 and set(row) <= set("XO_") for row in label["board"])
+        assert label["variation"].keys() == fields
+
+    report = ocr_eval.evaluate(tmp_path / "a", "shape", workers=1, by=["margin"])
+    assert (report.total.boards, report.total.cells) == (10, 90)
+    assert sum(report.confusion.values()) == 90
+    report_json = report.to_json()
+    assert report_json["images"] == 10
+    assert 0 <= report_json["cell_accuracy"] <= 1
+    assert set(report_json["confusion"]) == {"X", "O", "_"}
+    margins = report_json["by_variation"]["margin"]
+    assert sum(margin["images"] for margin in margins.values()) == 10
+    assert report.format().startswith("10 images with shape on 1 workers")
+
+
+def test_clean_corpus_accuracy(tmp_path: pathlib.Path) -> None:
+    board_corpus.generate(tmp_path, 40, [board_corpus.DEFAULT_FONT], seed=0, clean=True)
+    report = ocr_eval.evaluate(tmp_path, "shape", workers=1, by=["style"])
+    strokes = report.by_variation["style"][board_corpus.STYLE_STROKES]
+    glyphs = report.by_variation["style"][board_corpus.STYLE_FONT]
+    assert strokes.cell_accuracy >= 0.95 and strokes.board_accuracy >= 0.7
+    # Before Pillow 10.1 the default font is a bold bitmap font, whose O has
+    # next to no hole.
+    assert glyphs.cell_accuracy >= 0.75
+    assert report.total.cell_accuracy >= 0.85
+
+
+def test_cpu_seconds_include_child_processes() -> None:
+    start = ocr_eval.cpu_seconds()
+    subprocess.run([sys.executable, "-c", "sum(range(3 * 10**7))"], check=True)
+    assert ocr_eval.cpu_seconds() - start >= 0.1
+
+
+def test_default_font_without_sizes(monkeypatch: pytest.MonkeyPatch) -> None:
+    load_default = ImageFont.load_default
+
+    def bitmap_font_only() -> Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]:
+        # Pillow before 10.1 takes no size.
+        return load_default()
+
+    monkeypatch.setattr(ImageFont, "load_default", bitmap_font_only)
+    variation = board_corpus.Variation(
+        style=board_corpus.STYLE_FONT,
+        font=board_corpus.DEFAULT_FONT,
+        cell_pixels=48,
+        stroke_width=0.06,
+        rotation_degrees=0,
+        noise=0,
+        jpeg_quality=None,
+        margin=0.0,
+    )
+    rng = random.Random(0)
+    board = board_corpus.random_board(rng)
+    assert board_corpus.render(board, variation, rng)
@@ -0,0 +1,133 @@
+"""Measures how request throughput scales with the number of workers behind
+`server.dispatcher`.
+
+For every worker count a dispatcher is started, and client processes play
+whole matches against it for a fixed time. Scaling needs as many free cores
+as there are workers plus dispatchers and clients.
+
+    python benchmarks/worker_scaling.py --workers 1 2 4 --seconds 10
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import concurrent.futures
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+
+# A 3x3 game that is drawn, so it takes the most turns.
+DRAWN_GAME = [(0, 0), (1, 1), (2, 2), (0, 1), (2, 1), (2, 0), (0, 2), (1, 2), (1, 0)]
+STARTUP_TIMEOUT_SECONDS = 30.0
+
+
+async def play_matches(client: httpx.AsyncClient, deadline: float) -> int:
+    requests = 0
+    while time.monotonic() < deadline:
+        game = (await client.post("/new_game", json={"player_name": "x"})).json()
+        joined = await client.post(
+            f"/{game['game_id']}/join", json={"player_name": "o"}
+        )
+        requests += 2
+        state = (await client.get(f"/{game['game_id']}")).json()
+        tokens = [game["player_token"], joined.json()["player_token"]]
+        if state["current_turn"] == "second_player":
+            tokens.reverse()
+        for turn, (row, col) in enumerate(DRAWN_GAME):
+            response = await client.post(
+                f"/{game['game_id']}/play_turn",
+                json={"row": row, "column": col},
+                headers={"x-player-token": tokens[turn % 2]},
+            )
+            response.raise_for_status()
+        requests += 1 + len(DRAWN_GAME)
+    return requests
+
+
+async def run_client(url: str, matches: int, seconds: float) -> int:
+    deadline = time.monotonic() + seconds
+    limits = httpx.Limits(max_connections=matches)
+    async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+        counts = await asyncio.gather(
+            *(play_matches(client, deadline) for _ in range(matches))
+        )
+    return sum(counts)
+
+
+def client_process(url: str, matches: int, seconds: float) -> int:
+    return asyncio.run(run_client(url, matches, seconds))
+
+
+def free_port() -> int:
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        port: int = free_socket.getsockname()[1]
+        return port
+
+
+def wait_until_up(url: str) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    while True:
+        try:
+            httpx.get(f"{url}/{uuid.uuid4()}")
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def measure(workers: int, args: argparse.Namespace) -> float:
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "server.dispatcher",
+            f"--workers={workers}",
+            f"--port={port}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        url = f"http://127.0.0.1:{port}"
+        wait_until_up(url)
+        with concurrent.futures.ProcessPoolExecutor(args.clients) as clients:
+            counts = clients.map(
+                client_process,
+                [url] * args.clients,
+                [args.matches] * args.clients,
+                [args.seconds] * args.clients,
+            )
+            throughput: float = sum(counts) / args.seconds
+            return throughput
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=2, help="client processes")
+    parser.add_argument(
+        "--matches", type=int, default=32, help="concurrent matches per client"
+    )
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    baseline = None
+    print("workers  requests/s  speedup")
+    for workers in args.workers:
+        throughput = measure(workers, args)
+        baseline = baseline or throughput
+        print(f"{workers:7d}  {throughput:10.0f}  {throughput / baseline:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Which worker owns a game, when several run behind `server.dispatcher`.
+
+Every game lives in exactly one worker. The owner follows from the game id
+alone, so the dispatcher can route requests without any shared state.
+"""
+
+from __future__ import annotations
+import dataclasses
+import os
+import uuid
+
+
+def owner(game_id: uuid.UUID, worker_count: int) -> int:
+    # The low bits of a uuid4 are random.
+    return game_id.int % worker_count
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkerSlot:
+    index: int = 0
+    count: int = 1
+
+    @staticmethod
+    def from_env() -> WorkerSlot:
+        return WorkerSlot(
+            index=int(os.environ.get("T3_WORKER_INDEX", 0)),
+            count=int(os.environ.get("T3_WORKER_COUNT", 1)),
+        )
+
+    def owns(self, game_id: uuid.UUID) -> bool:
+        return owner(game_id, self.count) == self.index
+
+    def new_game_id(self) -> uuid.UUID:
+        """A random game id owned by this worker. Takes `count` draws on
+        average."""
+        while True:
+            game_id = uuid.uuid4()
+            if self.owns(game_id):
+                return game_id
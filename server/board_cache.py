@@ -0,0 +1,94 @@
+"""A bounded LRU cache of recognized boards, keyed by a hash of the uploaded
+image, so that retried and duplicate uploads skip image recognition."""
+
+from __future__ import annotations
+from typing import Optional, Union
+import collections
+import dataclasses
+import hashlib
+import os
+import threading
+
+from server import game_state
+
+DIGEST_SIZE = 16
+# Rough cost of an entry on top of its key and board, for the dict slot, the
+# linked list node and the bytes object headers.
+ENTRY_OVERHEAD_BYTES = 200
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+def _encode_board(board: list[list[game_state.Symbol]]) -> bytes:
+    return "".join(symbol.value for row in board for symbol in row).encode()
+
+
+def _decode_board(encoded: bytes, size: int) -> list[list[game_state.Symbol]]:
+    symbols = [game_state.Symbol(chr(char)) for char in encoded]
+    return [symbols[row * size : (row + 1) * size] for row in range(size)]
+
+
+class BoardCache:
+    """Boards are stored as one byte per cell. The cache is bounded both by
+    entry count and by an estimate of its memory use."""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._entries: collections.OrderedDict[bytes, bytes] = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> BoardCache:
+        return BoardCache(
+            max_entries=int(os.environ.get("T3_BOARD_CACHE_ENTRIES", 10_000)),
+            max_bytes=int(os.environ.get("T3_BOARD_CACHE_BYTES", 16 * 1024 * 1024)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._bytes
+
+    @staticmethod
+    def key(data: Union[bytes, memoryview], size: int) -> bytes:
+        digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+        return digest + bytes([size])
+
+    def get(self, key: bytes) -> Optional[list[list[game_state.Symbol]]]:
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+        return _decode_board(encoded, key[-1])
+
+    def put(self, key: bytes, board: list[list[game_state.Symbol]]) -> None:
+        encoded = _encode_board(board)
+        cost = len(key) + len(encoded) + ENTRY_OVERHEAD_BYTES
+        if self.max_entries <= 0 or cost > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(key) + len(previous) + ENTRY_OVERHEAD_BYTES
+            while self._entries and (
+                len(self._entries) >= self.max_entries
+                or self._bytes + cost > self.max_bytes
+            ):
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted_key) + len(evicted) + ENTRY_OVERHEAD_BYTES
+                self.stats.evictions += 1
+            self._entries[key] = encoded
+            self._bytes += cost
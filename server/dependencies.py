@@ -2,25 +2,97 @@ import uuid
 
 import fastapi
 
-from server import game_state
+from server import (
+    affinity,
+    board_cache,
+    events,
+    game_state,
+    locks,
+    matchmaking,
+    ocr_pool,
+    reaper,
+    storage,
+    uploads,
+)
 
-
-GamesDict = dict[uuid.UUID, game_state.GameState]
+GamesDict = storage.GamesDict
 
 ALL_GAMES: GamesDict = {}
 
+WORKER_SLOT = affinity.WorkerSlot.from_env()
+
+GAME_LOCKS = locks.LockStripes.from_env()
+
+GAME_EVENTS = events.GameEvents.from_env()
+
+GAME_STORE = storage.store_from_env(GAME_LOCKS)
+
+REAPER_SETTINGS = reaper.ReaperSettings.from_env()
+
+GAME_ARCHIVE = storage.GameArchive(REAPER_SETTINGS.max_archived_games)
+
+OCR_POOL = ocr_pool.OcrPool(ocr_pool.OcrPoolSettings.from_env())
+
+BOARD_CACHE = board_cache.BoardCache.from_env()
+
+MATCHMAKER = matchmaking.Matchmaker.from_env()
+
+UPLOAD_SETTINGS = uploads.UploadSettings.from_env()
+
 
 def get_active_games() -> GamesDict:
     return ALL_GAMES
 
 
+def get_worker_slot() -> affinity.WorkerSlot:
+    return WORKER_SLOT
+
+
+def get_game_locks() -> locks.LockStripes:
+    return GAME_LOCKS
+
+
+def get_game_events() -> events.GameEvents:
+    return GAME_EVENTS
+
+
+def get_game_store() -> storage.GameStore:
+    return GAME_STORE
+
+
+def get_game_archive() -> storage.GameArchive:
+    return GAME_ARCHIVE
+
+
+def get_reaper_settings() -> reaper.ReaperSettings:
+    return REAPER_SETTINGS
+
+
+def get_ocr_pool() -> ocr_pool.OcrPool:
+    return OCR_POOL
+
+
+def get_board_cache() -> board_cache.BoardCache:
+    return BOARD_CACHE
+
+
+def get_matchmaker() -> matchmaking.Matchmaker:
+    return MATCHMAKER
+
+
+def get_upload_settings() -> uploads.UploadSettings:
+    return UPLOAD_SETTINGS
+
+
 def get_current_game(
     game_id: uuid.UUID,
     active_games: GamesDict = fastapi.Depends(get_active_games),
 ) -> game_state.GameState:
     try:
-        return active_games[game_id]
+        game = active_games[game_id]
     except KeyError:
         raise fastapi.exceptions.HTTPException(
             status_code=fastapi.status.HTTP_404_NOT_FOUND
         )
+    reaper.touch(game)
+    return game
@@ -0,0 +1,397 @@
+"""Runs several server workers on one host behind a dispatcher.
+
+Games live in the memory of a single worker, so requests for a game have to
+reach the worker that owns it (see `server.affinity`). Each worker listens on
+a unix socket, and the dispatcher forwards every request whose path starts
+with a game id to its owner. `/matchmake` goes to the first worker, which
+keeps the matchmaking queue, and `/export` is streamed from every worker one
+after the other, once they have all answered. `/metrics` scrapes every worker
+and merges their metrics, labelled by worker, so that consecutive scrapes see
+the same counters. Other requests, like `/new_game`, go to the workers in turn.
+The dispatcher keeps no state, so it runs in several processes of its own.
+
+Games started by `/matchmake` are created in the first worker too, so all
+their requests land there and don't spread over the workers like the games
+from `/new_game` do. Deployments that mostly matchmake scale with the first
+worker rather than with `--workers`.
+
+    python -m server.dispatcher --workers 4 --port 8000
+"""
+
+from __future__ import annotations
+from typing import Any, AsyncIterator, Optional, Union
+import argparse
+import asyncio
+import contextlib
+import itertools
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+import fastapi
+import httpx
+import uvicorn
+
+from server import affinity, metrics
+
+SOCKET_NAME = "worker-{}.sock"
+# Batches whose items can be for games on different workers.
+SPLIT_BATCHES = frozenset({"/batch/join", "/batch/play_turn"})
+# Paths served by the first worker only, since its state isn't per game.
+FIRST_WORKER_PATHS = frozenset({"/matchmake"})
+# Paths whose responses from all workers are streamed one after the other.
+ALL_WORKER_PATHS = frozenset({"/export"})
+METRICS_PATH = "/metrics"
+STARTUP_TIMEOUT_SECONDS = 30.0
+# Headers that only apply to a single connection and must not be forwarded.
+HOP_BY_HOP_HEADERS = frozenset(
+    {
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+        "host",
+    }
+)
+
+
+def socket_path(socket_dir: pathlib.Path, index: int) -> pathlib.Path:
+    return socket_dir / SOCKET_NAME.format(index)
+
+
+def _forwarded_headers(headers: httpx.Headers) -> list[tuple[str, str]]:
+    return [
+        (name, value)
+        for name, value in headers.multi_items()
+        if name.lower() not in HOP_BY_HOP_HEADERS
+    ]
+
+
+async def _relay(upstream: httpx.Response) -> AsyncIterator[bytes]:
+    # Also closes the worker connection when the client goes away mid-stream.
+    try:
+        async for chunk in upstream.aiter_raw():
+            yield chunk
+    finally:
+        await upstream.aclose()
+
+
+class Dispatcher:
+    def __init__(self, socket_dir: pathlib.Path, worker_count: int) -> None:
+        self.worker_count = worker_count
+        self.clients = [
+            httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(
+                    uds=str(socket_path(socket_dir, index))
+                ),
+                base_url="http://worker",
+                timeout=None,
+            )
+            for index in range(worker_count)
+        ]
+        self._next_worker = itertools.count()
+
+    def worker_for(self, path: str) -> int:
+        if path in FIRST_WORKER_PATHS:
+            return 0
+        first_segment = path.lstrip("/").split("/", 1)[0]
+        try:
+            game_id = uuid.UUID(first_segment)
+        except ValueError:
+            return next(self._next_worker) % self.worker_count
+        return affinity.owner(game_id, self.worker_count)
+
+    def worker_for_item(self, item: Any) -> int:
+        try:
+            return affinity.owner(uuid.UUID(item["game_id"]), self.worker_count)
+        except (TypeError, KeyError, ValueError):
+            # Any worker can reject the item.
+            return 0
+
+    async def forward_batch(
+        self, request: fastapi.Request
+    ) -> Optional[fastapi.Response]:
+        """Splits the items by the worker owning their game and puts the
+        results back together in order. Returns None for a malformed batch,
+        for a worker to reject."""
+        try:
+            items = (await request.json())["items"]
+        except (ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(items, list):
+            return None
+        positions_by_worker: dict[int, list[int]] = {}
+        for position, item in enumerate(items):
+            positions_by_worker.setdefault(self.worker_for_item(item), []).append(
+                position
+            )
+        headers = [
+            (name, value)
+            for name, value in _forwarded_headers(httpx.Headers(request.headers.raw))
+            if name.lower() != "content-length"
+        ]
+        responses = await asyncio.gather(
+            *(
+                self.clients[worker].post(
+                    request.url.path,
+                    json={"items": [items[position] for position in positions]},
+                    headers=headers,
+                )
+                for worker, positions in positions_by_worker.items()
+            )
+        )
+        results: list[Any] = [None] * len(items)
+        for positions, response in zip(positions_by_worker.values(), responses):
+            if response.status_code != fastapi.status.HTTP_200_OK:
+                return fastapi.Response(
+                    response.content,
+                    status_code=response.status_code,
+                    headers=dict(_forwarded_headers(response.headers)),
+                )
+            for position, result in zip(positions, response.json()["results"]):
+                results[position] = result
+        return fastapi.responses.JSONResponse({"results": results})
+
+    async def forward_to_all(self, request: fastapi.Request) -> fastapi.Response:
+        """Concatenates the workers' responses, which works for record
+        streams like the export. Every worker has to answer 200 before the
+        response starts, otherwise the first error is returned as is. A
+        worker failing mid-stream aborts the response, so that a partial
+        export can't pass for a whole one."""
+        headers = _forwarded_headers(httpx.Headers(request.headers.raw))
+
+        async def send(client: httpx.AsyncClient) -> httpx.Response:
+            upstream_request = client.build_request(
+                request.method,
+                request.url.path,
+                params=request.url.query,
+                headers=headers,
+            )
+            return await client.send(upstream_request, stream=True)
+
+        sent = await asyncio.gather(
+            *(send(client) for client in self.clients), return_exceptions=True
+        )
+        upstreams = [
+            upstream for upstream in sent if isinstance(upstream, httpx.Response)
+        ]
+        failed = next(
+            (
+                upstream
+                for upstream in sent
+                if not isinstance(upstream, httpx.Response)
+                or upstream.status_code != fastapi.status.HTTP_200_OK
+            ),
+            None,
+        )
+        if failed is not None:
+            for upstream in upstreams:
+                if upstream is not failed:
+                    await upstream.aclose()
+            if isinstance(failed, BaseException):
+                raise failed
+            return fastapi.responses.StreamingResponse(
+                _relay(failed),
+                status_code=failed.status_code,
+                headers=dict(_forwarded_headers(failed.headers)),
+            )
+
+        async def concatenated() -> AsyncIterator[bytes]:
+            try:
+                for upstream in upstreams:
+                    async for chunk in upstream.aiter_raw():
+                        yield chunk
+            finally:
+                for upstream in upstreams:
+                    await upstream.aclose()
+
+        return fastapi.responses.StreamingResponse(
+            concatenated(), media_type=upstreams[0].headers.get("content-type")
+        )
+
+    async def forward_metrics(self) -> fastapi.Response:
+        """Every worker's metrics with a `worker` label. Scrapes fail when a
+        worker can't be scraped, rather than leaving its counters out."""
+        responses = await asyncio.gather(
+            *(client.get(METRICS_PATH) for client in self.clients)
+        )
+        for response in responses:
+            if response.status_code != fastapi.status.HTTP_200_OK:
+                return fastapi.Response(
+                    response.content,
+                    status_code=response.status_code,
+                    headers=dict(_forwarded_headers(response.headers)),
+                )
+        return fastapi.Response(
+            metrics.merge([response.content for response in responses]),
+            media_type=metrics.CONTENT_TYPE,
+        )
+
+    async def forward(self, request: fastapi.Request) -> fastapi.Response:
+        if request.url.path in ALL_WORKER_PATHS:
+            return await self.forward_to_all(request)
+        if request.method == "GET" and request.url.path == METRICS_PATH:
+            return await self.forward_metrics()
+        content: Union[bytes, AsyncIterator[bytes]] = request.stream()
+        if request.method == "POST" and request.url.path in SPLIT_BATCHES:
+            batch_response = await self.forward_batch(request)
+            if batch_response is not None:
+                return batch_response
+            content = await request.body()
+        client = self.clients[self.worker_for(request.url.path)]
+        upstream_request = client.build_request(
+            request.method,
+            request.url.path,
+            params=request.url.query,
+            headers=_forwarded_headers(httpx.Headers(request.headers.raw)),
+            content=content,
+        )
+        # Responses are streamed through, so that long polls and event
+        # streams reach the client as they are written.
+        upstream = await client.send(upstream_request, stream=True)
+        return fastapi.responses.StreamingResponse(
+            _relay(upstream),
+            status_code=upstream.status_code,
+            headers=dict(_forwarded_headers(upstream.headers)),
+        )
+
+    async def close(self) -> None:
+        for client in self.clients:
+            await client.aclose()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI) -> AsyncIterator[None]:
+    dispatcher = Dispatcher(
+        pathlib.Path(os.environ["T3_WORKER_SOCKET_DIR"]),
+        int(os.environ["T3_WORKER_COUNT"]),
+    )
+    app.state.dispatcher = dispatcher
+    yield
+    await dispatcher.close()
+
+
+app = fastapi.FastAPI(lifespan=lifespan, docs_url=None, openapi_url=None)
+
+
+@app.api_route(
+    "/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD"]
+)
+async def forward(request: fastapi.Request) -> fastapi.Response:
+    dispatcher: Dispatcher = request.app.state.dispatcher
+    return await dispatcher.forward(request)
+
+
+def start_workers(
+    worker_count: int, socket_dir: pathlib.Path
+) -> list[subprocess.Popen[bytes]]:
+    cpus_per_worker = max(1, (os.cpu_count() or 1) // worker_count)
+    data_dir = os.environ.get("T3_DATA_DIR")
+    workers = []
+    for index in range(worker_count):
+        env = dict(os.environ)
+        env["T3_WORKER_INDEX"] = str(index)
+        env["T3_WORKER_COUNT"] = str(worker_count)
+        # Otherwise every worker starts a process per cpu for images.
+        env.setdefault("T3_OCR_WORKERS", str(cpus_per_worker))
+        if data_dir is not None:
+            env["T3_DATA_DIR"] = str(pathlib.Path(data_dir) / f"worker-{index}")
+        path = socket_path(socket_dir, index)
+        path.unlink(missing_ok=True)
+        workers.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "uvicorn",
+                    "server.server_main:app",
+                    "--uds",
+                    str(path),
+                    "--no-access-log",
+                ],
+                env=env,
+            )
+        )
+    return workers
+
+
+def wait_for_workers(
+    workers: list[subprocess.Popen[bytes]], socket_dir: pathlib.Path
+) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    for index, worker in enumerate(workers):
+        while not socket_path(socket_dir, index).exists():
+            if worker.poll() is not None:
+                raise RuntimeError(f"worker {index} exited with {worker.returncode}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"worker {index} did not start")
+            time.sleep(0.05)
+
+
+def stop_workers(workers: list[subprocess.Popen[bytes]]) -> None:
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.wait()
+
+
+def _exit(signal_number: int, frame: Optional[types.FrameType]) -> None:
+    sys.exit(128 + signal_number)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Runs several server workers behind a dispatcher."
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--dispatchers",
+        type=int,
+        default=None,
+        help="dispatcher processes, by default one per worker",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--socket-dir", type=pathlib.Path, default=None, help="for the worker sockets"
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    # Uvicorn passes SIGTERM on once it has shut down. Turning it into an
+    # exception lets the workers be stopped too.
+    signal.signal(signal.SIGTERM, _exit)
+    with contextlib.ExitStack() as stack:
+        socket_dir = args.socket_dir
+        if socket_dir is None:
+            socket_dir = pathlib.Path(
+                stack.enter_context(tempfile.TemporaryDirectory(prefix="t3-"))
+            )
+        workers = start_workers(args.workers, socket_dir)
+        stack.callback(stop_workers, workers)
+        wait_for_workers(workers, socket_dir)
+        # The dispatcher processes pick their settings up from the environment.
+        os.environ["T3_WORKER_SOCKET_DIR"] = str(socket_dir)
+        os.environ["T3_WORKER_COUNT"] = str(args.workers)
+        uvicorn.run(
+            "server.dispatcher:app",
+            host=args.host,
+            port=args.port,
+            workers=args.dispatchers or args.workers,
+            access_log=False,
+        )
+
+
+if __name__ == "__main__":
+    main()
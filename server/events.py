@@ -0,0 +1,125 @@
+"""Pushes game updates to subscribers as server-sent events.
+
+Every update is encoded once and the same bytes are handed to every
+subscriber of the game. Each subscriber has a bounded queue. One that falls
+too far behind is dropped, and its stream ends after the events it already
+has, so that the client can reconnect and start over from the full state.
+"""
+
+from __future__ import annotations
+from typing import Any, AsyncIterator, Optional
+import asyncio
+import json
+import os
+import threading
+import uuid
+
+KEEPALIVE = b": keepalive\n\n"
+
+
+def encode(event: str, data: dict[str, Any]) -> bytes:
+    payload = json.dumps(data, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n".encode()
+
+
+class Subscription:
+    def __init__(self, game_id: uuid.UUID, queue_size: int) -> None:
+        self.game_id = game_id
+        self.loop = asyncio.get_running_loop()
+        # Events, and whether the stream ends after them.
+        self.queue: asyncio.Queue[tuple[bytes, bool]] = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def deliver(self, event: bytes, final: bool) -> bool:
+        """Returns whether the subscriber should keep getting events."""
+        try:
+            self.queue.put_nowait((event, final))
+        except asyncio.QueueFull:
+            self.overflowed = True
+        return not final and not self.overflowed
+
+
+class GameEvents:
+    def __init__(self, queue_size: int, keepalive_seconds: float) -> None:
+        self.queue_size = queue_size
+        self.keepalive_seconds = keepalive_seconds
+        self._subscriptions: dict[uuid.UUID, set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> GameEvents:
+        return GameEvents(
+            queue_size=int(os.environ.get("T3_EVENT_QUEUE_SIZE", 16)),
+            keepalive_seconds=float(os.environ.get("T3_EVENT_KEEPALIVE_SECONDS", 15.0)),
+        )
+
+    def subscribers(self, game_id: uuid.UUID) -> int:
+        return len(self._subscriptions.get(game_id, ()))
+
+    def subscribe(self, game_id: uuid.UUID) -> Subscription:
+        """Must be called from the event loop the events are read on."""
+        subscription = self.new_subscription(game_id)
+        self.add(subscription)
+        return subscription
+
+    def new_subscription(self, game_id: uuid.UUID) -> Subscription:
+        """A subscription that doesn't get events until it is added. Must be
+        called from the event loop the events are read on."""
+        return Subscription(game_id, self.queue_size)
+
+    def add(self, subscription: Subscription) -> None:
+        """Can be called from any thread."""
+        with self._lock:
+            self._subscriptions.setdefault(subscription.game_id, set()).add(
+                subscription
+            )
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.game_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.game_id]
+
+    def publish(self, game_id: uuid.UUID, event: bytes, final: bool = False) -> None:
+        """Can be called from any thread."""
+        with self._lock:
+            subscriptions = self._subscriptions.get(game_id)
+            if not subscriptions:
+                return
+            subscriptions = set(subscriptions)
+        by_loop: dict[asyncio.AbstractEventLoop, list[Subscription]] = {}
+        for subscription in subscriptions:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        for loop, loop_subscriptions in by_loop.items():
+            loop.call_soon_threadsafe(self._deliver, loop_subscriptions, event, final)
+
+    def _deliver(
+        self, subscriptions: list[Subscription], event: bytes, final: bool
+    ) -> None:
+        for subscription in subscriptions:
+            if not subscription.deliver(event, final):
+                self.unsubscribe(subscription)
+
+    async def stream(
+        self, subscription: Subscription, first_event: Optional[bytes] = None
+    ) -> AsyncIterator[bytes]:
+        """The events of `subscription`, with keepalive comments while there
+        are none. Unsubscribes when the stream ends or is closed."""
+        try:
+            if first_event is not None:
+                yield first_event
+            while True:
+                try:
+                    event, final = await asyncio.wait_for(
+                        subscription.queue.get(), self.keepalive_seconds
+                    )
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+                    continue
+                yield event
+                if final or (subscription.overflowed and subscription.queue.empty()):
+                    return
+        finally:
+            self.unsubscribe(subscription)
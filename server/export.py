@@ -0,0 +1,171 @@
+"""Exports games with their move history for offline analysis, as NDJSON or
+as a packed binary record stream.
+
+Games are encoded one at a time and handed out in chunks, so an export
+never holds more than a chunk of encoded games, however many games there
+are.
+
+A binary record is `<length: u32>` followed by `RECORD_HEADER`, one byte per
+move with its cell, `row * board_size + col`, the move times as
+little-endian u32s, and the UTF-8 names of both players.
+"""
+
+from __future__ import annotations
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional
+import struct
+import uuid
+
+import orjson
+
+from server import game_state
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_BINARY = "binary"
+MEDIA_TYPES = {
+    FORMAT_NDJSON: "application/x-ndjson",
+    FORMAT_BINARY: "application/octet-stream",
+}
+CHUNK_BYTES = 64 * 1024
+
+LENGTH = struct.Struct("<I")
+# Game id, board size, win length, index in `game_state.STATUSES`, `FLAG_*`
+# flags, creation time in ms since the epoch, number of moves and the byte
+# lengths of the player names.
+RECORD_HEADER = struct.Struct("<16sBBBBQHHH")
+FLAG_FIRST_PLAYER_STARTS = 1
+FLAG_AGAINST_SERVER = 2
+FLAG_ARCHIVED = 4
+FLAG_SECOND_PLAYER = 8
+FLAG_FIRST_PLAYER_WON = 16
+
+Encoder = Callable[[game_state.GameState, bool], bytes]
+
+
+def _winner(game: game_state.GameState) -> Optional[str]:
+    if game.winner is None:
+        return None
+    return "first_player" if game.winner is game.first_player else "second_player"
+
+
+def encode_ndjson(game: game_state.GameState, archived: bool) -> bytes:
+    size = game.shape.size
+    return orjson.dumps(
+        {
+            "game_id": str(game.game_id),
+            "board_size": size,
+            "win_length": game.shape.win_length,
+            "status": game.status,
+            "winner": _winner(game),
+            "first_player_name": game.first_player.name,
+            "second_player_name": (
+                None if game.second_player is None else game.second_player.name
+            ),
+            "first_player_starts": game.first_player_starts,
+            "against_server": game.against_server,
+            "archived": archived,
+            "created_at_ms": game.created_at_ms,
+            "moves": [divmod(cell, size) for cell in game.moves],
+            "move_times_ms": game.move_times.tolist(),
+        },
+        option=orjson.OPT_APPEND_NEWLINE,
+    )
+
+
+def encode_binary(game: game_state.GameState, archived: bool) -> bytes:
+    first_name = game.first_player.name.encode()
+    second_name = (
+        b"" if game.second_player is None else game.second_player.name.encode()
+    )
+    flags = (
+        (FLAG_FIRST_PLAYER_STARTS if game.first_player_starts else 0)
+        | (FLAG_AGAINST_SERVER if game.against_server else 0)
+        | (FLAG_ARCHIVED if archived else 0)
+        | (FLAG_SECOND_PLAYER if game.second_player is not None else 0)
+        | (FLAG_FIRST_PLAYER_WON if _winner(game) == "first_player" else 0)
+    )
+    move_count = len(game.moves)
+    record = b"".join(
+        [
+            RECORD_HEADER.pack(
+                game.game_id.bytes,
+                game.shape.size,
+                game.shape.win_length,
+                game_state.STATUSES.index(game.status),
+                flags,
+                game.created_at_ms,
+                move_count,
+                len(first_name),
+                len(second_name),
+            ),
+            game.moves,
+            struct.pack(f"<{move_count}I", *game.move_times),
+            first_name,
+            second_name,
+        ]
+    )
+    return LENGTH.pack(len(record)) + record
+
+
+ENCODERS: dict[str, Encoder] = {
+    FORMAT_NDJSON: encode_ndjson,
+    FORMAT_BINARY: encode_binary,
+}
+
+
+def chunked(
+    records: Iterable[bytes], chunk_bytes: int = CHUNK_BYTES
+) -> Iterator[bytes]:
+    chunk = bytearray()
+    for record in records:
+        chunk += record
+        if len(chunk) >= chunk_bytes:
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+
+def read_binary(stream: BinaryIO) -> Iterator[dict[str, Any]]:
+    """Decodes a binary export into the same dicts as the NDJSON export."""
+    while length_bytes := stream.read(LENGTH.size):
+        (length,) = LENGTH.unpack(length_bytes)
+        record = stream.read(length)
+        (
+            game_id,
+            size,
+            win_length,
+            status,
+            flags,
+            created_at_ms,
+            move_count,
+            first_name_length,
+            second_name_length,
+        ) = RECORD_HEADER.unpack_from(record)
+        offset = RECORD_HEADER.size
+        moves = record[offset : offset + move_count]
+        offset += move_count
+        move_times = struct.unpack_from(f"<{move_count}I", record, offset)
+        offset += 4 * move_count
+        first_name = record[offset : offset + first_name_length].decode()
+        offset += first_name_length
+        second_name = record[offset : offset + second_name_length].decode()
+        winner = None
+        if game_state.STATUSES[status] == "won":
+            winner = (
+                "first_player" if flags & FLAG_FIRST_PLAYER_WON else "second_player"
+            )
+        yield {
+            "game_id": str(uuid.UUID(bytes=game_id)),
+            "board_size": size,
+            "win_length": win_length,
+            "status": game_state.STATUSES[status],
+            "winner": winner,
+            "first_player_name": first_name,
+            "second_player_name": (second_name if flags & FLAG_SECOND_PLAYER else None),
+            "first_player_starts": bool(flags & FLAG_FIRST_PLAYER_STARTS),
+            "against_server": bool(flags & FLAG_AGAINST_SERVER),
+            "archived": bool(flags & FLAG_ARCHIVED),
+            "created_at_ms": created_at_ms,
+            "moves": [list(divmod(cell, size)) for cell in moves],
+            "move_times_ms": list(move_times),
+        }
@@ -1,8 +1,12 @@
 from __future__ import annotations
 from typing import Optional
+import array
 import dataclasses
 import enum
+import functools
 import random
+import struct
+import time
 import uuid
 
 
@@ -25,14 +29,117 @@ class Symbol(enum.Enum):
         return Symbol.EMPTY
 
 
+DEFAULT_BOARD_SIZE = 3
+MIN_BOARD_SIZE = 3
+MAX_BOARD_SIZE = 15
+MIN_WIN_LENGTH = 3
+
+# Row/column steps of the four line directions: horizontal, vertical, diagonal
+# and anti-diagonal.
+DIRECTIONS: tuple[tuple[int, int], ...] = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+@functools.lru_cache(maxsize=None)
+def winning_lines(size: int, win_length: int) -> tuple[int, ...]:
+    """Every `win_length` long line on a `size` x `size` board as a bitmask."""
+    lines = []
+    for row in range(size):
+        for col in range(size):
+            for row_step, col_step in DIRECTIONS:
+                end_row = row + row_step * (win_length - 1)
+                end_col = col + col_step * (win_length - 1)
+                if not (0 <= end_row < size and 0 <= end_col < size):
+                    continue
+                lines.append(
+                    sum(
+                        1 << ((row + row_step * i) * size + col + col_step * i)
+                        for i in range(win_length)
+                    )
+                )
+    return tuple(lines)
+
+
+class BoardShape:
+    """The geometry of a board, shared by all games played on it."""
+
+    __slots__ = (
+        "size",
+        "win_length",
+        "cell_count",
+        "full_board",
+        "winning_masks_by_cell",
+    )
+
+    def __init__(self, size: int, win_length: int) -> None:
+        if not MIN_BOARD_SIZE <= size <= MAX_BOARD_SIZE:
+            raise ValueError(
+                f"board size must be between {MIN_BOARD_SIZE} and {MAX_BOARD_SIZE}"
+            )
+        if not MIN_WIN_LENGTH <= win_length <= size:
+            raise ValueError(
+                f"win length must be between {MIN_WIN_LENGTH} and the board size"
+            )
+        self.size = size
+        self.win_length = win_length
+        self.cell_count = size * size
+        self.full_board = (1 << self.cell_count) - 1
+        # The classic board is small enough to check a move against the winning
+        # masks through its cell. Larger boards keep incremental run counters
+        # per game instead, see `GameState._update_runs`.
+        self.winning_masks_by_cell: Optional[tuple[tuple[int, ...], ...]] = None
+        if size == DEFAULT_BOARD_SIZE:
+            masks = winning_lines(size, win_length)
+            self.winning_masks_by_cell = tuple(
+                tuple(mask for mask in masks if mask & (1 << cell))
+                for cell in range(self.cell_count)
+            )
+
+    def cell_bit(self, row: int, col: int) -> int:
+        return 1 << (row * self.size + col)
+
+    def contains(self, move: Move) -> bool:
+        return 0 <= move.row < self.size and 0 <= move.col < self.size
+
+
+def get_board_shape(
+    size: int = DEFAULT_BOARD_SIZE, win_length: Optional[int] = None
+) -> BoardShape:
+    """The shared `BoardShape`, by default `win_length` is the board size."""
+    return _get_board_shape(size, size if win_length is None else win_length)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_board_shape(size: int, win_length: int) -> BoardShape:
+    return BoardShape(size, win_length)
+
+
+def board_to_bits(board: list[list[Symbol]], size: int) -> tuple[int, int]:
+    if len(board) != size or any(len(row) != size for row in board):
+        raise InvalidGameStateRequested(f"board is not {size}x{size}")
+    x_bits = 0
+    o_bits = 0
+    for row in range(size):
+        for col in range(size):
+            symbol = board[row][col]
+            if symbol is Symbol.X:
+                x_bits |= 1 << (row * size + col)
+            elif symbol is Symbol.O:
+                o_bits |= 1 << (row * size + col)
+    return x_bits, o_bits
+
+
 @dataclasses.dataclass
 class Move:
     row: int
     col: int
 
 
+PLAYER_HEADER = struct.Struct("<16sH")
+
+
 @dataclasses.dataclass
 class Player:
+    __slots__ = ("name", "token")
     name: str
     token: uuid.UUID
 
@@ -40,60 +147,328 @@ class Player:
         self.name = name
         self.token = uuid.uuid4()
 
+    @staticmethod
+    def with_token(name: str, token: uuid.UUID) -> Player:
+        player = Player(name)
+        player.token = token
+        return player
+
+    def pack(self) -> bytes:
+        name = self.name.encode()
+        return PLAYER_HEADER.pack(self.token.bytes, len(name)) + name
+
+    @staticmethod
+    def unpack_from(data: bytes, offset: int = 0) -> tuple[Player, int]:
+        """The player packed at `offset` and the offset right after it."""
+        token, name_length = PLAYER_HEADER.unpack_from(data, offset)
+        offset += PLAYER_HEADER.size
+        name = data[offset : offset + name_length].decode()
+        return Player.with_token(name, uuid.UUID(bytes=token)), offset + name_length
+
 
 class InvalidGameStateRequested(Exception):
     pass
 
 
-@dataclasses.dataclass
+# Game id, board size, win length and `PACK_*` flags.
+GAME_HEADER = struct.Struct("<16sBBB")
+PACK_FIRST_PLAYER_STARTS = 1
+PACK_AGAINST_SERVER = 2
+PACK_SECOND_PLAYER = 4
+PACK_HISTORY = 8
+
+STATUSES = ("waiting", "playing", "won", "drawn")
+# Creation time in milliseconds since the epoch, and the number of moves.
+HISTORY_HEADER = struct.Struct("<QH")
+# Move times are kept as unsigned 32-bit ints, about 49 days.
+MAX_MOVE_TIME_MS = 2**32 - 1
+
+
 class GameState:
+    """A single game. The board is kept as two bitboards, one per symbol, where
+    bit `row * size + col` is set when that symbol occupies the cell."""
+
+    __slots__ = (
+        "game_id",
+        "shape",
+        "x_bits",
+        "o_bits",
+        "runs",
+        "first_player",
+        "current_turn_first_player",
+        "first_player_starts",
+        "turns_played",
+        "winner",
+        "second_player",
+        "against_server",
+        "last_touched",
+        "version",
+        "rendered",
+        "created_at_ms",
+        "moves",
+        "move_times",
+    )
+
     game_id: uuid.UUID
-    game_state: list[list[Symbol]]
+    shape: BoardShape
+    x_bits: int
+    o_bits: int
+    # For boards without win masks: the length of the run of same symbols in
+    # each direction, stored at both ends of the run and indexed by
+    # `direction * cell_count + cell`.
+    runs: Optional[bytearray]
     first_player: Player
     current_turn_first_player: bool
     first_player_starts: bool
-    turns_played: int = 0
-    winner: Optional[Player] = None
-    second_player: Optional[Player] = None
+    turns_played: int
+    winner: Optional[Player]
+    second_player: Optional[Player]
+    # The second player is played by the server.
+    against_server: bool
+    # `time.monotonic()` of the last time the game was used.
+    last_touched: float
+    # Goes up by one with every join and move.
+    version: int
+    # The response for this game as of `version`, kept by the server.
+    rendered: Optional[tuple[int, bytes]]
+    # Milliseconds since the epoch, 0 if unknown.
+    created_at_ms: int
+    # The cell, `row * size + col`, of every move in order. Moves aren't
+    # recorded when the board is set directly.
+    moves: bytearray
+    # Milliseconds from the creation of the game to each move.
+    move_times: array.array[int]
 
-    def __init__(self, game_id: uuid.UUID, first_player_name: str) -> None:
+    def __init__(
+        self,
+        game_id: uuid.UUID,
+        first_player_name: str,
+        shape: Optional[BoardShape] = None,
+        against_server: bool = False,
+    ) -> None:
         self.game_id = game_id
-        self.game_state = [[Symbol.EMPTY] * 3 for _ in range(3)]
+        self.shape = get_board_shape() if shape is None else shape
+        self.x_bits = 0
+        self.o_bits = 0
+        self.runs = (
+            None
+            if self.shape.winning_masks_by_cell is not None
+            else bytearray(len(DIRECTIONS) * self.shape.cell_count)
+        )
         self.first_player = Player(name=first_player_name)
         self.first_player_starts = random.choice([True, False])
         self.current_turn_first_player = self.first_player_starts
+        self.turns_played = 0
+        self.winner = None
+        self.second_player = None
+        self.against_server = against_server
+        self.last_touched = time.monotonic()
+        self.version = 0
+        self.rendered = None
+        self.created_at_ms = int(time.time() * 1000)
+        self.moves = bytearray()
+        self.move_times = array.array("I")
+
+    def __repr__(self) -> str:
+        return (
+            f"GameState(game_id={self.game_id!r}, game_state={self.game_state!r}, "
+            f"turns_played={self.turns_played!r}, winner={self.winner!r})"
+        )
+
+    @property
+    def size(self) -> int:
+        return self.shape.size
+
+    @property
+    def game_state(self) -> list[list[Symbol]]:
+        size = self.shape.size
+        return [
+            [self._symbol_at(1 << (row * size + col)) for col in range(size)]
+            for row in range(size)
+        ]
+
+    @game_state.setter
+    def game_state(self, board: list[list[Symbol]]) -> None:
+        self.x_bits, self.o_bits = board_to_bits(board, self.shape.size)
+        self.version += 1
+        self._rebuild_runs()
+
+    def _rebuild_runs(self) -> None:
+        if self.runs is not None:
+            self.runs[:] = bytes(len(self.runs))
+            for row in range(self.shape.size):
+                for col in range(self.shape.size):
+                    self._update_runs(row, col)
+
+    def pack(self) -> bytes:
+        """A compact encoding of the game. Only the board, the players, who
+        started and the move history are stored, everything else is derived
+        from them. Each move takes a byte for its cell and four for its
+        time."""
+        flags = (
+            (PACK_FIRST_PLAYER_STARTS if self.first_player_starts else 0)
+            | (PACK_AGAINST_SERVER if self.against_server else 0)
+            | (PACK_SECOND_PLAYER if self.second_player is not None else 0)
+            | PACK_HISTORY
+        )
+        board_bytes = (self.shape.cell_count + 7) // 8
+        return b"".join(
+            [
+                GAME_HEADER.pack(
+                    self.game_id.bytes,
+                    self.shape.size,
+                    self.shape.win_length,
+                    flags,
+                ),
+                self.x_bits.to_bytes(board_bytes, "little"),
+                self.o_bits.to_bytes(board_bytes, "little"),
+                self.first_player.pack(),
+                b"" if self.second_player is None else self.second_player.pack(),
+                HISTORY_HEADER.pack(self.created_at_ms, len(self.moves)),
+                self.moves,
+                struct.pack(f"<{len(self.move_times)}I", *self.move_times),
+            ]
+        )
+
+    @staticmethod
+    def unpack(data: bytes) -> GameState:
+        game_id, size, win_length, flags = GAME_HEADER.unpack_from(data)
+        shape = get_board_shape(size, win_length)
+        offset = GAME_HEADER.size
+        board_bytes = (shape.cell_count + 7) // 8
+        x_bits = int.from_bytes(data[offset : offset + board_bytes], "little")
+        offset += board_bytes
+        o_bits = int.from_bytes(data[offset : offset + board_bytes], "little")
+        offset += board_bytes
+        first_player, offset = Player.unpack_from(data, offset)
+
+        game = GameState(
+            uuid.UUID(bytes=game_id),
+            first_player.name,
+            shape=shape,
+            against_server=bool(flags & PACK_AGAINST_SERVER),
+        )
+        game.first_player = first_player
+        if flags & PACK_SECOND_PLAYER:
+            game.second_player, offset = Player.unpack_from(data, offset)
+        if flags & PACK_HISTORY:
+            game.created_at_ms, move_count = HISTORY_HEADER.unpack_from(data, offset)
+            offset += HISTORY_HEADER.size
+            game.moves = bytearray(data[offset : offset + move_count])
+            offset += move_count
+            game.move_times = array.array(
+                "I", struct.unpack_from(f"<{move_count}I", data, offset)
+            )
+        else:
+            game.created_at_ms = 0
+        game.first_player_starts = bool(flags & PACK_FIRST_PLAYER_STARTS)
+        game.x_bits = x_bits
+        game.o_bits = o_bits
+        game.turns_played = bin(x_bits | o_bits).count("1")
+        game.version = game.turns_played + (game.second_player is not None)
+        game.current_turn_first_player = game.first_player_starts == (
+            game.turns_played % 2 == 0
+        )
+        lines = winning_lines(size, win_length)
+        if any(x_bits & line == line for line in lines):
+            game.winner = game._player_for(Symbol.X)
+        elif any(o_bits & line == line for line in lines):
+            game.winner = game._player_for(Symbol.O)
+        game._rebuild_runs()
+        return game
+
+    def _player_for(self, symbol: Symbol) -> Optional[Player]:
+        if (symbol is Symbol.X) == self.first_player_starts:
+            return self.first_player
+        return self.second_player
+
+    def _symbol_at(self, bit: int) -> Symbol:
+        if self.x_bits & bit:
+            return Symbol.X
+        if self.o_bits & bit:
+            return Symbol.O
+        return Symbol.EMPTY
+
+    def symbol_at(self, move: Move) -> Symbol:
+        return self._symbol_at(self.shape.cell_bit(move.row, move.col))
 
     def add_second_player(self, player_name: str) -> Player:
         self.second_player = Player(player_name)
+        self.version += 1
         return self.second_player
 
+    def _update_runs(self, row: int, col: int) -> None:
+        """Merges a newly played cell with the runs of its symbol on either side
+        in every direction. Only the run ends can be extended by a later move,
+        so only they (and the new cell) are kept up to date."""
+        runs = self.runs
+        assert runs is not None
+        shape = self.shape
+        size = shape.size
+        bit = 1 << (row * size + col)
+        own = self.x_bits if self.x_bits & bit else self.o_bits
+        if not own & bit:
+            return
+        for direction, (row_step, col_step) in enumerate(DIRECTIONS):
+            offset = direction * shape.cell_count
+            before = 0
+            before_row, before_col = row - row_step, col - col_step
+            if 0 <= before_row < size and 0 <= before_col < size:
+                before_cell = before_row * size + before_col
+                if own & (1 << before_cell):
+                    before = runs[offset + before_cell]
+            after = 0
+            after_row, after_col = row + row_step, col + col_step
+            if 0 <= after_row < size and 0 <= after_col < size:
+                after_cell = after_row * size + after_col
+                if own & (1 << after_cell):
+                    after = runs[offset + after_cell]
+            length = before + 1 + after
+            runs[offset + row * size + col] = length
+            runs[
+                offset + (row - before * row_step) * size + col - before * col_step
+            ] = length
+            runs[offset + (row + after * row_step) * size + col + after * col_step] = (
+                length
+            )
+
     def _is_winning_move(self, move: Move) -> bool:
-        current_play = self.game_state[move.row][move.col]
-        assert current_play != Symbol.EMPTY
-        column_win = all(self.game_state[move.row][i] == current_play for i in range(3))
-        row_win = all(self.game_state[i][move.col] == current_play for i in range(3))
-        left_diag_win = (move.col == move.row) and all(
-            self.game_state[i][i] == current_play for i in range(3)
-        )
-        right_diag_win = (move.col + move.row == 2) and all(
-            self.game_state[i][2 - i] == current_play for i in range(3)
-        )
-        return column_win or row_win or left_diag_win or right_diag_win
+        shape = self.shape
+        cell = move.row * shape.size + move.col
+        bit = 1 << cell
+        current_play = self.x_bits if self.x_bits & bit else self.o_bits
+        assert current_play & bit
+        if shape.winning_masks_by_cell is not None:
+            return any(
+                current_play & mask == mask
+                for mask in shape.winning_masks_by_cell[cell]
+            )
+        assert self.runs is not None
+        return max(self.runs[cell :: shape.cell_count]) >= shape.win_length
 
-    def play_turn(self, move: Move) -> Optional[Player]:
-        if self.game_state[move.row][move.col] != Symbol.EMPTY:
+    def play_turn(
+        self, move: Move, elapsed_ms: Optional[int] = None
+    ) -> Optional[Player]:
+        """Plays the move for the player whose turn it is. `elapsed_ms` is the
+        time of the move since the game was created, now by default."""
+        if not self.shape.contains(move):
+            raise InvalidTurn
+        bit = self.shape.cell_bit(move.row, move.col)
+        if (self.x_bits | self.o_bits) & bit:
             raise InvalidTurn
 
-        current_play = (
-            Symbol.X
-            if (
-                (self.first_player_starts and self.current_turn_first_player)
-                or (not self.first_player_starts and not self.current_turn_first_player)
-            )
-            else Symbol.O
-        )
-        self.game_state[move.row][move.col] = current_play
+        if self.first_player_starts == self.current_turn_first_player:
+            self.x_bits |= bit
+        else:
+            self.o_bits |= bit
         self.turns_played += 1
+        self.version += 1
+        self.moves.append(move.row * self.shape.size + move.col)
+        if elapsed_ms is None:
+            elapsed_ms = int(time.time() * 1000) - self.created_at_ms
+        self.move_times.append(min(max(0, elapsed_ms), MAX_MOVE_TIME_MS))
+        if self.runs is not None:
+            self._update_runs(move.row, move.col)
 
         if self._is_winning_move(move):
             self.winner = (
@@ -107,16 +482,31 @@ class GameState:
 
     @property
     def is_drawn(self) -> bool:
-        return self.turns_played == 9 and self.winner is None
+        return self.turns_played == self.shape.cell_count and self.winner is None
+
+    @property
+    def status(self) -> str:
+        """One of `STATUSES`."""
+        if self.second_player is None:
+            return "waiting"
+        if self.winner is not None:
+            return "won"
+        if self.is_drawn:
+            return "drawn"
+        return "playing"
+
+    @property
+    def is_over(self) -> bool:
+        return self.winner is not None or self.turns_played == self.shape.cell_count
 
     def get_move_difference(self, board: list[list[Symbol]]) -> Move | None:
-        move = None
-        for row in range(3):
-            for col in range(3):
-                if board[row][col] != self.game_state[row][col]:
-                    if move is not None:
-                        raise InvalidGameStateRequested(
-                            f"more than one move difference {board} {self.game_state}"
-                        )
-                    move = Move(row=row, col=col)
-        return move
+        x_bits, o_bits = board_to_bits(board, self.shape.size)
+        difference = (x_bits ^ self.x_bits) | (o_bits ^ self.o_bits)
+        if difference == 0:
+            return None
+        if difference & (difference - 1):
+            raise InvalidGameStateRequested(
+                f"more than one move difference {board} {self.game_state}"
+            )
+        row, col = divmod(difference.bit_length() - 1, self.shape.size)
+        return Move(row=row, col=col)
@@ -1,48 +1,298 @@
-from typing import BinaryIO
+from typing import BinaryIO, NamedTuple, Optional, Protocol
+import os
+import time
+
 from PIL import Image
+import numpy as np
+import numpy.typing as npt
 import pytesseract
 
-from server.game_state import Symbol
-
+from server import metrics, ocr_pool
+from server.ocr_pool import ImageTooLarge, UnreadableImage
+from server.game_state import DEFAULT_BOARD_SIZE, Symbol
 
 BORDER_CROP = 10 / 100
 IMAGE_THRESHOLD = 100
+BINARIZE_TABLE = [255 if p > IMAGE_THRESHOLD else 0 for p in range(256)]
+
+# Images are decoded and downscaled so that their longer side is at most this
+# many pixels before they are binarized.
+WORKING_RESOLUTION = 768
+# Larger images are rejected before they are decoded. The server checks the
+# image header first, this is for formats it gets wrong.
+MAX_IMAGE_PIXELS = ocr_pool.MAX_IMAGE_PIXELS
+
+# Cells with less of their area inked than this are empty.
+MIN_INK_RATIO = 1 / 100
+# Cells with less ink than this are empty without asking the classifier. The
+# shape classifier is fully confident about them too.
+EMPTY_CELL_INK_RATIO = MIN_INK_RATIO / 2
+# Rows and columns with at least this fraction of the most ink in any of them
+# are taken to be on grid lines. Lines span the whole grid, while symbols
+# only span their own cells.
+GRID_LINE_PROFILE_RATIO = 0.5
+# Cell sides found from grid lines may differ from their mean by this
+# fraction, or the lines are taken to be wrong.
+GRID_SPACING_TOLERANCE = 0.2
+# Ink coordinate percentiles used as the symbol's bounding box, so that specks
+# don't stretch it.
+BOUNDING_BOX_PERCENTILES = (1, 99)
+# The central part of the bounding box, as fractions of its sides. An X crosses
+# there while an O has its hole there.
+CENTER_REGION = (0.35, 0.65)
+# Center ink densities at and above which a symbol is an X, and at and below
+# which it is an O. Densities in between are classified with low confidence.
+X_CENTER_DENSITY = 0.3
+O_CENTER_DENSITY = 0.1
+# Classifications below this confidence are handed to the fallback classifier.
+FALLBACK_CONFIDENCE = 0.5
+
+
+# A binarized image or cell, ink is 0 and background 255.
+Pixels = npt.NDArray[np.uint8]
 
 
 def preprocess_image(image: Image.Image) -> Image.Image:
+    """Grayscales, downscales and binarizes a freshly opened image. JPEGs are
+    decoded straight to grayscale at a reduced scale."""
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"{image.width}x{image.height}")
+    image.draft("L", (WORKING_RESOLUTION, WORKING_RESOLUTION))
     grayscaled_image = image.convert("L")
-    binarized_image = grayscaled_image.point(
-        lambda p: 255 if p > IMAGE_THRESHOLD else 0
+    factor = -(-max(grayscaled_image.size) // WORKING_RESOLUTION)
+    if factor > 1:
+        grayscaled_image = grayscaled_image.reduce(factor)
+    return grayscaled_image.point(BINARIZE_TABLE)
+
+
+class Grid(NamedTuple):
+    # The `size + 1` cell boundaries along each axis, in pixels.
+    rows: tuple[int, ...]
+    cols: tuple[int, ...]
+
+
+def even_grid(pixels: Pixels, size: int = DEFAULT_BOARD_SIZE) -> Grid:
+    """The grid for an image that is exactly the board."""
+    height = pixels.shape[0] // size
+    width = pixels.shape[1] // size
+    return Grid(
+        tuple(height * line for line in range(size + 1)),
+        tuple(width * line for line in range(size + 1)),
     )
-    return binarized_image
-
-
-def crop_cell(image: Image.Image, *, row: int, col: int) -> Image.Image:
-    cropped_height = image.height // 3
-    cropped_width = image.width // 3
-    return image.crop(
-        (
-            int((col + BORDER_CROP) * cropped_width),
-            int((row + BORDER_CROP) * cropped_height),
-            int(((col + 1) - BORDER_CROP) * cropped_width),
-            int(((row + 1) - BORDER_CROP) * cropped_height),
+
+
+def _grid_lines(
+    profile: npt.NDArray[np.uint16], size: int
+) -> Optional[tuple[int, ...]]:
+    """The cell boundaries along an axis from its ink projection profile, or
+    None if the lines can't be told apart. Either the inner `size - 1` lines
+    are found and the outer ones are a cell further out, or all `size + 1`
+    lines are."""
+    is_line = profile >= max(1, GRID_LINE_PROFILE_RATIO * int(profile.max()))
+    padded = np.concatenate(([False], is_line, [False]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    centers: list[float] = ((changes[::2] + changes[1::2] - 1) / 2).tolist()
+    if len(centers) == size - 1:
+        spacing = (centers[-1] - centers[0]) / (size - 2)
+        centers = [centers[0] - spacing, *centers, centers[-1] + spacing]
+    elif len(centers) != size + 1:
+        return None
+    mean_gap = (centers[-1] - centers[0]) / size
+    slack = GRID_SPACING_TOLERANCE * mean_gap
+    # The grid has to fit in the image, give or take the slack.
+    if (
+        any(
+            abs(end - start - mean_gap) > slack
+            for start, end in zip(centers, centers[1:])
         )
+        or centers[0] < -slack
+        or centers[-1] > len(profile) + slack
+    ):
+        return None
+    return tuple(int(min(max(center, 0), len(profile))) for center in centers)
+
+
+def find_grid(pixels: Pixels, size: int = DEFAULT_BOARD_SIZE) -> Grid:
+    """Locates the grid lines with the row and column ink projection profiles
+    of the binarized pixels. Falls back to `even_grid` along an axis where
+    they aren't clear."""
+    # Preprocessed images are at most `WORKING_RESOLUTION` pixels a side, so
+    # the counts fit in 16 bits, which sum faster than wider integers.
+    ink = (pixels == 0).view(np.uint8)
+    fallback = even_grid(pixels, size)
+    rows = _grid_lines(ink.sum(axis=1, dtype=np.uint16), size)
+    cols = _grid_lines(ink.sum(axis=0, dtype=np.uint16), size)
+    return Grid(
+        fallback.rows if rows is None else rows,
+        fallback.cols if cols is None else cols,
     )
 
 
+def crop_cell(
+    pixels: Pixels,
+    *,
+    row: int,
+    col: int,
+    size: int = DEFAULT_BOARD_SIZE,
+    grid: Optional[Grid] = None,
+) -> Pixels:
+    """A view of the cell, without its border, in the binarized pixels. The
+    cells are the even split of the image unless the grid is given."""
+    if grid is None:
+        height = pixels.shape[0] // size
+        width = pixels.shape[1] // size
+        top, bottom = row * height, (row + 1) * height
+        left, right = col * width, (col + 1) * width
+    else:
+        top, bottom = grid.rows[row], grid.rows[row + 1]
+        left, right = grid.cols[col], grid.cols[col + 1]
+    border_height = BORDER_CROP * (bottom - top)
+    border_width = BORDER_CROP * (right - left)
+    return pixels[
+        int(top + border_height) : int(bottom - border_height),
+        int(left + border_width) : int(right - border_width),
+    ]
+
+
+def is_empty_cell(cell: Pixels) -> bool:
+    # Ink is 0 and background 255.
+    ink = cell.size - np.count_nonzero(cell)
+    return bool(ink < EMPTY_CELL_INK_RATIO * cell.size)
+
+
 def get_char_from_image(image: Image.Image) -> Symbol:
-    char = str(pytesseract.image_to_string(image, config="--psm 10", lang="eng"))
+    start = time.perf_counter()
+    try:
+        char = str(pytesseract.image_to_string(image, config="--psm 10", lang="eng"))
+    finally:
+        metrics.observe_stage(metrics.STAGE_TESSERACT, time.perf_counter() - start)
     return Symbol.from_char(char[0] if len(char) > 0 else " ")
 
 
-def get_board_from_file(file: BinaryIO) -> list[list[Symbol]]:
-    with Image.open(file) as uploaded_image:
-        preprocessed_image = preprocess_image(uploaded_image)
-        image_array: list[list[Symbol]] = []
-        for row in range(3):
-            column_array: list[Symbol] = []
-            for col in range(3):
-                cell = crop_cell(preprocessed_image, row=row, col=col)
-                column_array.append(get_char_from_image(cell))
-            image_array.append(column_array)
+class CellClassification(NamedTuple):
+    symbol: Symbol
+    # Between 0 and 1.
+    confidence: float
+
+
+class CellClassifier(Protocol):
+    def classify(self, cell: Pixels) -> CellClassification: ...
+
+
+class ShapeClassifier:
+    """Tells the symbols apart by the ink in the middle of their bounding box,
+    working on the binarized cell in process."""
+
+    def classify(self, cell: Pixels) -> CellClassification:
+        ink = cell == 0
+        ink_ratio = float(ink.mean()) if ink.size else 0.0
+        if ink_ratio < MIN_INK_RATIO:
+            return CellClassification(
+                Symbol.EMPTY, min(1.0, 2 - 2 * ink_ratio / MIN_INK_RATIO)
+            )
+
+        rows, cols = np.nonzero(ink)
+        top, bottom = np.percentile(rows, BOUNDING_BOX_PERCENTILES).astype(int)
+        left, right = np.percentile(cols, BOUNDING_BOX_PERCENTILES).astype(int)
+        height = bottom - top + 1
+        width = right - left + 1
+        start, end = CENTER_REGION
+        center = ink[
+            top + int(height * start) : top + int(height * end) + 1,
+            left + int(width * start) : left + int(width * end) + 1,
+        ]
+        density = float(center.mean())
+
+        boundary = (X_CENTER_DENSITY + O_CENTER_DENSITY) / 2
+        margin = (X_CENTER_DENSITY - O_CENTER_DENSITY) / 2
+        confidence = min(1.0, abs(density - boundary) / margin)
+        return CellClassification(
+            Symbol.X if density >= boundary else Symbol.O, confidence
+        )
+
+
+class TesseractClassifier:
+    """Runs tesseract on the cell. This spawns a subprocess per cell."""
+
+    def classify(self, cell: Pixels) -> CellClassification:
+        return CellClassification(get_char_from_image(Image.fromarray(cell)), 1.0)
+
+
+class FallbackClassifier:
+    """Uses `fallback` for the cells `primary` isn't confident about. If the
+    fallback fails, e.g. because tesseract isn't installed, the primary
+    classification stands."""
+
+    def __init__(
+        self,
+        primary: CellClassifier,
+        fallback: CellClassifier,
+        min_confidence: float = FALLBACK_CONFIDENCE,
+    ) -> None:
+        self.primary = primary
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+
+    def classify(self, cell: Pixels) -> CellClassification:
+        classification = self.primary.classify(cell)
+        if classification.confidence >= self.min_confidence:
+            return classification
+        try:
+            return self.fallback.classify(cell)
+        except (pytesseract.TesseractNotFoundError, pytesseract.TesseractError):
+            return classification
+
+
+CLASSIFIERS: dict[str, CellClassifier] = {
+    "shape": ShapeClassifier(),
+    "tesseract": TesseractClassifier(),
+    "shape+tesseract": FallbackClassifier(ShapeClassifier(), TesseractClassifier()),
+}
+
+# Picked with the T3_CELL_CLASSIFIER environment variable.
+DEFAULT_CLASSIFIER = CLASSIFIERS[
+    os.environ.get("T3_CELL_CLASSIFIER", "shape+tesseract")
+]
+
+
+def decode_image(file: BinaryIO) -> Pixels:
+    """The preprocessed pixels of an image file. Raises `UnreadableImage` if
+    it is corrupt or truncated."""
+    try:
+        with Image.open(file) as uploaded_image:
+            return np.asarray(preprocess_image(uploaded_image))
+    # PIL raises SyntaxError for some malformed headers.
+    except (OSError, SyntaxError) as error:
+        raise UnreadableImage(str(error)) from error
+
+
+def get_board_from_file(
+    file: BinaryIO,
+    size: int = DEFAULT_BOARD_SIZE,
+    classifier: Optional[CellClassifier] = None,
+) -> list[list[Symbol]]:
+    classifier = DEFAULT_CLASSIFIER if classifier is None else classifier
+    start = time.perf_counter()
+    pixels = decode_image(file)
+    preprocessed = time.perf_counter()
+    grid = find_grid(pixels, size)
+    crop_seconds = time.perf_counter() - preprocessed
+    image_array: list[list[Symbol]] = []
+    for row in range(size):
+        column_array: list[Symbol] = []
+        for col in range(size):
+            crop_start = time.perf_counter()
+            cell = crop_cell(pixels, row=row, col=col, size=size, grid=grid)
+            empty = is_empty_cell(cell)
+            crop_seconds += time.perf_counter() - crop_start
+            # Most cells are empty for most of a game.
+            column_array.append(
+                Symbol.EMPTY if empty else classifier.classify(cell).symbol
+            )
+        image_array.append(column_array)
+    end = time.perf_counter()
+    metrics.observe_stage(metrics.STAGE_PREPROCESS, preprocessed - start)
+    metrics.observe_stage(metrics.STAGE_CROP, crop_seconds)
+    metrics.observe_stage(metrics.STAGE_CLASSIFY, end - preprocessed - crop_seconds)
+    metrics.observe_stage(metrics.STAGE_BOARD, end - start)
     return image_array
@@ -0,0 +1,27 @@
+"""Per-game locks, so that concurrent requests for one game are applied one at
+a time without serializing unrelated games."""
+
+from __future__ import annotations
+import os
+import threading
+import uuid
+
+
+class LockStripes:
+    """A fixed set of locks shared by all games. Two games only contend when
+    they map to the same stripe."""
+
+    def __init__(self, stripes: int) -> None:
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def from_env() -> LockStripes:
+        return LockStripes(int(os.environ.get("T3_LOCK_STRIPES", 1024)))
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def for_game(self, game_id: uuid.UUID) -> threading.Lock:
+        # The low bits pick the worker that owns the game (see
+        # `server.affinity`), so all games in a worker share them.
+        return self._locks[(game_id.int >> 64) % len(self._locks)]
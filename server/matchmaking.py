@@ -0,0 +1,127 @@
+"""Pairs players who ask for a game without them exchanging game ids.
+
+Each board shape has a FIFO queue of games waiting for a second player. A
+player either takes the oldest waiting game or starts a game and queues it,
+so pairing never looks at the game table. The queues are only used from the
+event loop thread, so a ticket is handed out at most once without a lock. A
+player who stops waiting cancels their ticket, so that asking again doesn't
+pair them with their own game.
+"""
+
+from __future__ import annotations
+from typing import Optional
+import asyncio
+import collections
+import dataclasses
+import os
+import uuid
+
+from server import storage
+
+# Board size and win length.
+ShapeKey = tuple[int, int]
+
+
+@dataclasses.dataclass(frozen=True)
+class MatchmakingSettings:
+    # Queued games older than this aren't handed out any more, since their
+    # player has likely given up on them.
+    ticket_ttl_seconds: float = 60.0
+    # The longest a request may wait for an opponent.
+    max_wait_seconds: float = 30.0
+
+    @staticmethod
+    def from_env() -> MatchmakingSettings:
+        defaults = MatchmakingSettings()
+        return MatchmakingSettings(
+            ticket_ttl_seconds=float(
+                os.environ.get(
+                    "T3_MATCHMAKING_TICKET_TTL_SECONDS", defaults.ticket_ttl_seconds
+                )
+            ),
+            max_wait_seconds=float(
+                os.environ.get(
+                    "T3_MATCHMAKING_MAX_WAIT_SECONDS", defaults.max_wait_seconds
+                )
+            ),
+        )
+
+
+class Ticket:
+    __slots__ = ("game_id", "expires", "waiter", "taken", "cancelled")
+
+    def __init__(
+        self,
+        game_id: uuid.UUID,
+        expires: float,
+        waiter: Optional[asyncio.Future[None]],
+    ) -> None:
+        self.game_id = game_id
+        # `time.monotonic()` after which the ticket isn't handed out.
+        self.expires = expires
+        # Set once an opponent joins, or fails to, if the first player is
+        # waiting.
+        self.waiter = waiter
+        self.taken = False
+        self.cancelled = False
+
+
+class Matchmaker:
+    def __init__(self, settings: MatchmakingSettings) -> None:
+        self.settings = settings
+        self._queues: dict[ShapeKey, collections.deque[Ticket]] = {}
+
+    @staticmethod
+    def from_env() -> Matchmaker:
+        return Matchmaker(MatchmakingSettings.from_env())
+
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def take(
+        self, shape: ShapeKey, active_games: storage.GamesDict, now: float
+    ) -> Optional[Ticket]:
+        """The oldest game of the shape that still waits for a second player.
+        Tickets that expired or were cancelled, and those of games that were
+        removed or joined by id, are dropped on the way."""
+        queue = self._queues.get(shape)
+        while queue:
+            ticket = queue.popleft()
+            if ticket.cancelled or ticket.expires <= now:
+                continue
+            game = active_games.get(ticket.game_id)
+            if game is not None and game.second_player is None:
+                ticket.taken = True
+                return ticket
+        return None
+
+    def enqueue(
+        self,
+        shape: ShapeKey,
+        game_id: uuid.UUID,
+        waiter: Optional[asyncio.Future[None]],
+        now: float,
+    ) -> Ticket:
+        queue = self._queues.setdefault(shape, collections.deque())
+        # All tickets live equally long, so expired ones are at the front.
+        while queue and (queue[0].expires <= now or queue[0].cancelled):
+            queue.popleft()
+        ticket = Ticket(game_id, now + self.settings.ticket_ttl_seconds, waiter)
+        queue.append(ticket)
+        return ticket
+
+    @staticmethod
+    def cancel(ticket: Ticket) -> bool:
+        """Stops the ticket from being handed out. Returns False if it already
+        was, and an opponent may be joining."""
+        if ticket.taken:
+            return False
+        ticket.cancelled = True
+        return True
+
+    @staticmethod
+    def resolve(ticket: Ticket) -> None:
+        """Wakes the waiting first player once the opponent is done joining,
+        whether or not that worked."""
+        if ticket.waiter is not None and not ticket.waiter.done():
+            ticket.waiter.set_result(None)
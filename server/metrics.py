@@ -0,0 +1,310 @@
+"""Request and image recognition metrics, exposed in the Prometheus text
+format.
+
+Histograms have fixed buckets and preallocated counters, so recording a value
+is a bisect and two array updates. Request histograms are only recorded from
+the event loop thread, so they take no locks.
+
+Image recognition runs in the OCR pool's worker processes. There the stage
+timings are collected per image with `collect_stages` and sent back with the
+board, to be recorded by the server process. `get_board_from_file` can also
+be called directly, from any thread, so stage histograms are recorded under a
+lock.
+
+Behind `server.dispatcher` every worker has its own metrics. The dispatcher
+scrapes all of them and `merge`s them, with a `worker` label on every sample.
+"""
+
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Iterator, MutableMapping, Optional
+import array
+import bisect
+import contextlib
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+STAGE_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+# `image_processing` stages. `classify` includes the tesseract calls, which are
+# also timed on their own.
+STAGE_PREPROCESS = "preprocess"
+STAGE_CROP = "crop"
+STAGE_CLASSIFY = "classify"
+STAGE_TESSERACT = "tesseract"
+STAGE_BOARD = "get_board_from_file"
+STAGES = (STAGE_PREPROCESS, STAGE_CROP, STAGE_CLASSIFY, STAGE_TESSERACT, STAGE_BOARD)
+
+# Requests that didn't match a route.
+UNMATCHED_ROUTE = "unmatched"
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "total")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        # One count per bucket, the last one for values above every bound.
+        self.counts = array.array("Q", bytes(8 * (len(bounds) + 1)))
+        self.total = array.array("d", [0.0])
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total[0] += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class HistogramFamily:
+    """Histograms by label values. A histogram is created the first time its
+    labels are seen, and reused after."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...],
+        bounds: tuple[float, ...],
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.bounds = bounds
+        self.histograms: dict[tuple[str, ...], Histogram] = {}
+
+    def labels(self, *values: str) -> Histogram:
+        histogram = self.histograms.get(values)
+        if histogram is None:
+            histogram = self.histograms.setdefault(values, Histogram(self.bounds))
+        return histogram
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, histogram in sorted(self.histograms.items()):
+            labels = ",".join(
+                f'{name}="{escape(value)}"'
+                for name, value in zip(self.label_names, values)
+            )
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.bounds, histogram.counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+            cumulative += histogram.counts[-1]
+            yield f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}'
+            yield f"{self.name}_sum{{{labels}}} {histogram.total[0]}"
+            yield f"{self.name}_count{{{labels}}} {cumulative}"
+
+
+class Sample:
+    """A gauge or counter read when the metrics are scraped."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        kind: str,
+        values: dict[str, float],
+        label_name: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.help = help
+        # "gauge" or "counter"
+        self.kind = kind
+        # By label value, or a single value under "" without a label.
+        self.values = values
+        self.label_name = label_name
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for label, value in sorted(self.values.items()):
+            labels = (
+                "" if self.label_name is None else f'{{{self.label_name}="{label}"}}'
+            )
+            yield f"{self.name}{labels} {value}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = HistogramFamily(
+    "t3_http_request_duration_seconds",
+    "Time to answer requests, by route and status code.",
+    ("route", "status"),
+    REQUEST_BUCKETS,
+)
+IMAGE_STAGE_SECONDS = HistogramFamily(
+    "t3_image_stage_duration_seconds",
+    "Time spent in each image recognition stage, per image or tesseract call.",
+    ("stage",),
+    STAGE_BUCKETS,
+)
+for _stage in STAGES:
+    IMAGE_STAGE_SECONDS.labels(_stage)
+_stage_lock = threading.Lock()
+
+
+def render(samples: list[Sample]) -> bytes:
+    with _stage_lock:
+        stage_lines = list(IMAGE_STAGE_SECONDS.render())
+    lines = [
+        *REQUEST_SECONDS.render(),
+        *stage_lines,
+        *(line for sample in samples for line in sample.render()),
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def _with_label(line: str, label: str) -> str:
+    name_end = min(index for index in (line.find("{"), line.find(" ")) if index >= 0)
+    if line[name_end] != "{":
+        return f"{line[:name_end]}{{{label}}}{line[name_end:]}"
+    rest = line[name_end + 1 :]
+    return f"{line[:name_end]}{{{label}{'' if rest.startswith('}') else ','}{rest}"
+
+
+def merge(texts: list[bytes], label_name: str = "worker") -> bytes:
+    """Scrapes of several processes as one, with each sample labelled by the
+    index of the process it came from. Every family keeps one HELP and TYPE
+    line, followed by the samples of all processes."""
+    families: dict[str, tuple[list[str], list[str]]] = {}
+    for index, text in enumerate(texts):
+        label = f'{label_name}="{index}"'
+        family: Optional[tuple[list[str], list[str]]] = None
+        for line in text.decode().splitlines():
+            if line.startswith("# "):
+                # "# HELP <name> <text>" or "# TYPE <name> <kind>"
+                family = families.setdefault(line.split(" ", 3)[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line:
+                if family is None:
+                    family = families.setdefault(
+                        line.split("{")[0].split()[0], ([], [])
+                    )
+                family[1].append(_with_label(line, label))
+    lines = [
+        line for headers, samples in families.values() for line in [*headers, *samples]
+    ]
+    return ("\n".join(lines) + "\n").encode()
+
+
+class _Collector(threading.local):
+    observations: Optional[list[tuple[str, float]]] = None
+
+
+_collector = _Collector()
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Records a stage timing, or collects it if `collect_stages` is on in
+    this thread."""
+    observations = _collector.observations
+    if observations is None:
+        with _stage_lock:
+            IMAGE_STAGE_SECONDS.labels(stage).observe(seconds)
+    else:
+        observations.append((stage, seconds))
+
+
+@contextlib.contextmanager
+def collect_stages() -> Iterator[list[tuple[str, float]]]:
+    """Collects the stage timings in this thread instead of recording them."""
+    observations: list[tuple[str, float]] = []
+    _collector.observations = observations
+    try:
+        yield observations
+    finally:
+        _collector.observations = None
+
+
+def record_stages(observations: list[tuple[str, float]]) -> None:
+    with _stage_lock:
+        for stage, seconds in observations:
+            IMAGE_STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+class MetricsMiddleware:
+    """Times every request by its route template, so that all games share the
+    same histograms."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        # Histograms by route and status code, looked up without building a
+        # label tuple per request.
+        self._histograms: dict[str, dict[int, Histogram]] = {}
+
+    def histogram(self, route: str, status: int) -> Histogram:
+        by_status = self._histograms.get(route)
+        if by_status is None:
+            by_status = self._histograms.setdefault(route, {})
+        histogram = by_status.get(status)
+        if histogram is None:
+            histogram = by_status.setdefault(
+                status, REQUEST_SECONDS.labels(route, str(status))
+            )
+        return histogram
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            self.histogram(
+                UNMATCHED_ROUTE if route is None else route.path, status
+            ).observe(time.perf_counter() - start)
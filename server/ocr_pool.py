@@ -0,0 +1,182 @@
+"""Runs image recognition on a dedicated process pool, so that image turns
+can't starve the threads serving the rest of the API.
+
+Only the worker processes import `image_processing`, with PIL, numpy and
+pytesseract, and only once they get their first image. Set
+`T3_OCR_PREWARM=1` to start the workers and import it when the server starts
+instead.
+"""
+
+from __future__ import annotations
+from typing import Any, Optional
+import asyncio
+import atexit
+import concurrent.futures
+import dataclasses
+import io
+import multiprocessing
+import os
+import threading
+
+from server import game_state, metrics
+
+# Larger images are rejected before they are decoded.
+MAX_IMAGE_PIXELS = int(os.environ.get("T3_MAX_IMAGE_PIXELS", 50_000_000))
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class RecognitionTimeout(Exception):
+    pass
+
+
+class WorkerCrashed(Exception):
+    """A worker process died, e.g. because it ran out of memory. The pool is
+    replaced for the next images."""
+
+
+class ImageTooLarge(Exception):
+    """Raised by `image_processing`, and defined here so that the server
+    process can catch it without importing the image stack."""
+
+
+class UnreadableImage(Exception):
+    """Raised by `image_processing` for corrupt or truncated images, like
+    `ImageTooLarge`."""
+
+
+@dataclasses.dataclass(frozen=True)
+class OcrPoolSettings:
+    workers: int = os.cpu_count() or 1
+    # Images being recognized or waiting for a worker. Beyond this new images
+    # are turned away.
+    max_pending: int = 2 * (os.cpu_count() or 1)
+    timeout_seconds: float = 10.0
+    retry_after_seconds: int = 1
+    # Start the workers and load the image stack at startup, rather than on
+    # the first image.
+    prewarm: bool = False
+
+    @staticmethod
+    def from_env() -> OcrPoolSettings:
+        defaults = OcrPoolSettings()
+        return OcrPoolSettings(
+            workers=int(os.environ.get("T3_OCR_WORKERS", defaults.workers)),
+            max_pending=int(os.environ.get("T3_OCR_MAX_PENDING", defaults.max_pending)),
+            timeout_seconds=float(
+                os.environ.get("T3_OCR_TIMEOUT_SECONDS", defaults.timeout_seconds)
+            ),
+            retry_after_seconds=int(
+                os.environ.get(
+                    "T3_OCR_RETRY_AFTER_SECONDS", defaults.retry_after_seconds
+                )
+            ),
+            prewarm=os.environ.get("T3_OCR_PREWARM", "") not in ("", "0"),
+        )
+
+
+def recognize_board(
+    data: bytes, size: int
+) -> tuple[list[list[game_state.Symbol]], list[tuple[str, float]]]:
+    """The board and the timings of the recognition stages, which are
+    recorded by the server process."""
+    from server import image_processing
+
+    with metrics.collect_stages() as stages:
+        board = image_processing.get_board_from_file(io.BytesIO(data), size=size)
+    return board, stages
+
+
+def load_image_processing() -> None:
+    from server import image_processing
+
+
+class OcrPool:
+    """A process pool with bounded admission. The worker processes are started
+    on the first image, or by `prewarm`."""
+
+    def __init__(self, settings: OcrPoolSettings) -> None:
+        self.settings = settings
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._shutdown_registered = False
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.settings.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            if not self._shutdown_registered:
+                atexit.register(self.shutdown)
+                self._shutdown_registered = True
+        return self._executor
+
+    def _drop_executor(self, executor: concurrent.futures.ProcessPoolExecutor) -> None:
+        """Replaces a broken executor with a new one for the next image,
+        unless that already happened."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def prewarm(self) -> None:
+        """Starts the workers and has them import the image stack, without
+        waiting for them."""
+        with self._lock:
+            executor = self._get_executor()
+        # The executor starts a worker per task while none is idle.
+        for _ in range(self.settings.workers):
+            executor.submit(load_image_processing)
+
+    def _release(self, _: concurrent.futures.Future[Any]) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def recognize(
+        self, data: bytes, size: int = game_state.DEFAULT_BOARD_SIZE
+    ) -> list[list[game_state.Symbol]]:
+        """Raises `PoolSaturated` if too many images are pending,
+        `RecognitionTimeout` if this one takes too long and `WorkerCrashed` if
+        a worker died while it was pending."""
+        with self._lock:
+            if self._pending >= self.settings.max_pending:
+                raise PoolSaturated
+            self._pending += 1
+            executor = self._get_executor()
+        # A timed out image keeps its worker busy, so it stays pending until it
+        # is actually done.
+        try:
+            future = executor.submit(recognize_board, data, size)
+        except Exception as error:
+            with self._lock:
+                self._pending -= 1
+            if isinstance(error, concurrent.futures.BrokenExecutor):
+                self._drop_executor(executor)
+                raise WorkerCrashed from error
+            raise
+        future.add_done_callback(self._release)
+        try:
+            board, stages = await asyncio.wait_for(
+                asyncio.wrap_future(future), self.settings.timeout_seconds
+            )
+        except asyncio.TimeoutError:
+            raise RecognitionTimeout
+        except concurrent.futures.BrokenExecutor as error:
+            self._drop_executor(executor)
+            raise WorkerCrashed from error
+        metrics.record_stages(stages)
+        return board
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,147 @@
+"""Removes finished and abandoned games from the live games, so that memory
+use stays bounded. Finished games are moved to the archive, which can still
+answer `GET /{game_id}` for them. The removals of a pass are written to the
+store together, with a single wait for them to be durable."""
+
+from __future__ import annotations
+from typing import Any, Iterator, Optional
+import asyncio
+import contextlib
+import dataclasses
+import heapq
+import logging
+import os
+import time
+
+from server import game_state, locks, storage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class ReaperSettings:
+    interval_seconds: float = 30.0
+    # Games not touched for this long are removed.
+    idle_ttl_seconds: float = 60 * 60.0
+    # Games without a second player not touched for this long are removed.
+    unjoined_ttl_seconds: float = 10 * 60.0
+    # Finished games not touched for this long are archived.
+    finished_ttl_seconds: float = 60.0
+    max_live_games: int = 100_000
+    max_archived_games: int = 1_000_000
+
+    @staticmethod
+    def from_env() -> ReaperSettings:
+        """Each setting can be overridden with `T3_<SETTING NAME>`."""
+        values: dict[str, Any] = {}
+        for field in dataclasses.fields(ReaperSettings):
+            value = os.environ.get(f"T3_{field.name.upper()}")
+            if value is not None:
+                values[field.name] = int(value) if field.type == "int" else float(value)
+        return ReaperSettings(**values)
+
+
+@dataclasses.dataclass
+class ReapStats:
+    archived: int = 0
+    removed: int = 0
+
+
+def touch(game: game_state.GameState) -> None:
+    game.last_touched = time.monotonic()
+
+
+@contextlib.contextmanager
+def _removing(store: storage.GameStore) -> Iterator[None]:
+    """Lets the removals in the block share fsyncs, and waits once until all
+    of them are durable."""
+    with store.deferred():
+        yield
+    sequence = store.last_record()
+    if store.wait_durable(sequence) < sequence:
+        raise storage.StoreFailed("writing game removals failed")
+
+
+def _remove(
+    games: storage.GamesDict,
+    archive: storage.GameArchive,
+    store: storage.GameStore,
+    game_locks: locks.LockStripes,
+    game: game_state.GameState,
+    stats: ReapStats,
+) -> None:
+    with game_locks.for_game(game.game_id):
+        if games.pop(game.game_id, None) is None:
+            return
+        archived = game.is_over
+        if archived:
+            archive.add(game.game_id, game.pack())
+            stats.archived += 1
+        else:
+            stats.removed += 1
+        store.record_remove(game.game_id, archived)
+
+
+def reap(
+    games: storage.GamesDict,
+    archive: storage.GameArchive,
+    store: storage.GameStore,
+    game_locks: locks.LockStripes,
+    settings: ReaperSettings,
+    now: Optional[float] = None,
+) -> ReapStats:
+    now = time.monotonic() if now is None else now
+    stats = ReapStats()
+    with _removing(store):
+        for game in list(games.values()):
+            idle = now - game.last_touched
+            if (
+                (game.is_over and idle >= settings.finished_ttl_seconds)
+                or (
+                    game.second_player is None and idle >= settings.unjoined_ttl_seconds
+                )
+                or idle >= settings.idle_ttl_seconds
+            ):
+                _remove(games, archive, store, game_locks, game, stats)
+    enforce_cap(games, archive, store, game_locks, settings, stats)
+    return stats
+
+
+def enforce_cap(
+    games: storage.GamesDict,
+    archive: storage.GameArchive,
+    store: storage.GameStore,
+    game_locks: locks.LockStripes,
+    settings: ReaperSettings,
+    stats: Optional[ReapStats] = None,
+) -> None:
+    """Removes the least recently touched games once there are more than
+    `max_live_games`. It goes a tenth below the cap, so that the scan this
+    needs doesn't happen on every new game."""
+    excess = len(games) - settings.max_live_games
+    if excess <= 0:
+        return
+    excess += settings.max_live_games // 10
+    stats = ReapStats() if stats is None else stats
+    with _removing(store):
+        for game in heapq.nsmallest(
+            excess, list(games.values()), key=lambda game: game.last_touched
+        ):
+            _remove(games, archive, store, game_locks, game, stats)
+
+
+async def run(
+    games: storage.GamesDict,
+    archive: storage.GameArchive,
+    store: storage.GameStore,
+    game_locks: locks.LockStripes,
+    settings: ReaperSettings,
+) -> None:
+    """Reaps every `interval_seconds`, off the event loop, until cancelled. A
+    failed pass is logged and the next one tries again."""
+    while True:
+        await asyncio.sleep(settings.interval_seconds)
+        try:
+            await asyncio.to_thread(reap, games, archive, store, game_locks, settings)
+        except Exception:
+            logger.exception("Reaping games failed")
@@ -1,74 +1,671 @@
-from typing import Any
+from typing import Any, AsyncIterator, Callable, Iterator, Literal, Optional, TypeVar
+import asyncio
+import collections
+import contextlib
+import time
 import uuid
 import fastapi
+import orjson
 import pydantic
 
-from server import game_state, image_processing
-from server.dependencies import GamesDict, get_active_games, get_current_game
+from server import (
+    affinity,
+    board_cache,
+    dependencies,
+    events,
+    export,
+    game_state,
+    locks,
+    matchmaking,
+    metrics,
+    ocr_pool,
+    reaper,
+    solver,
+    storage,
+    uploads,
+)
+from server.dependencies import (
+    GamesDict,
+    get_active_games,
+    get_board_cache,
+    get_current_game,
+    get_game_archive,
+    get_game_events,
+    get_game_locks,
+    get_game_store,
+    get_matchmaker,
+    get_ocr_pool,
+    get_reaper_settings,
+    get_upload_settings,
+    get_worker_slot,
+)
 
 PLAYER_NAME_MAX_LENGTH = 100
 TOKEN_LENGTH = 16
+SERVER_PLAYER_NAME = "server"
+MAX_BATCH_SIZE = 1000
+GAME_NOT_SAVED = "Game could not be saved"
 
-app = fastapi.FastAPI()
+BatchItem = TypeVar("BatchItem", bound=pydantic.BaseModel)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI) -> AsyncIterator[None]:
+    get_game_store().load(dependencies.ALL_GAMES, get_game_archive())
+    reaper_task = asyncio.create_task(
+        reaper.run(
+            dependencies.ALL_GAMES,
+            get_game_archive(),
+            get_game_store(),
+            get_game_locks(),
+            get_reaper_settings(),
+        )
+    )
+    if get_ocr_pool().settings.prewarm:
+        get_ocr_pool().prewarm()
+    yield
+    reaper_task.cancel()
+    get_ocr_pool().shutdown()
+    get_game_store().close()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+app.add_middleware(
+    uploads.BodyLimitMiddleware, max_bytes=dependencies.UPLOAD_SETTINGS.max_bytes
+)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(storage.StoreFailed)
+def store_failed(
+    request: fastapi.Request, error: storage.StoreFailed
+) -> fastapi.responses.JSONResponse:
+    # The change may be applied in memory, but it isn't acknowledged since it
+    # wouldn't survive a restart.
+    return fastapi.responses.JSONResponse(
+        {"detail": GAME_NOT_SAVED},
+        status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
 
 
 class GameBody(pydantic.BaseModel):
     player_name: str = pydantic.Field(max_length=PLAYER_NAME_MAX_LENGTH)
 
 
+class BoardBody(GameBody):
+    board_size: int = pydantic.Field(
+        default=game_state.DEFAULT_BOARD_SIZE,
+        ge=game_state.MIN_BOARD_SIZE,
+        le=game_state.MAX_BOARD_SIZE,
+    )
+    win_length: Optional[int] = pydantic.Field(
+        default=None, ge=game_state.MIN_WIN_LENGTH, le=game_state.MAX_BOARD_SIZE
+    )
+
+
+class NewGameBody(BoardBody):
+    against_server: bool = False
+
+
+class MatchmakeBody(BoardBody):
+    # How long to wait for an opponent if there's no one waiting yet. Capped
+    # by the server.
+    wait_seconds: float = pydantic.Field(default=0.0, ge=0)
+
+
+class PlayTurnBody(pydantic.BaseModel):
+    row: int = pydantic.Field(ge=0, lt=game_state.MAX_BOARD_SIZE)
+    column: int = pydantic.Field(ge=0, lt=game_state.MAX_BOARD_SIZE)
+
+
+class JoinItem(GameBody):
+    game_id: uuid.UUID
+
+
+class PlayTurnItem(PlayTurnBody):
+    game_id: uuid.UUID
+    player_token: str
+
+
+class BatchBody(pydantic.BaseModel):
+    # Items are validated one at a time, so that an invalid one only fails
+    # itself.
+    items: list[dict[str, Any]] = pydantic.Field(max_items=MAX_BATCH_SIZE)
+
+
+def current_turn(game: game_state.GameState) -> str:
+    return "first_player" if game.current_turn_first_player else "second_player"
+
+
+def game_result(game: game_state.GameState) -> dict[str, str]:
+    if game.winner is not None:
+        return {"result": "won", "winner": game.winner.name}
+    elif game.is_drawn:
+        return {"result": "draw"}
+    return {}
+
+
+def publish_move(
+    game_events: events.GameEvents,
+    game: game_state.GameState,
+    move: game_state.Move,
+) -> None:
+    data: dict[str, Any] = {
+        "version": game.version,
+        "row": move.row,
+        "column": move.col,
+        "symbol": game.symbol_at(move).value,
+        "current_turn": current_turn(game),
+        **game_result(game),
+    }
+    game_events.publish(game.game_id, events.encode("move", data), final=game.is_over)
+
+
+def play_server_turn(
+    game: game_state.GameState,
+    store: storage.GameStore,
+    game_events: events.GameEvents,
+) -> dict[str, int]:
+    move, _ = solver.best_move(game)
+    game.play_turn(move)
+    store.record_move(game, move)
+    publish_move(game_events, game, move)
+    return {"row": move.row, "column": move.col}
+
+
+def create_game(
+    body: NewGameBody,
+    active_games: GamesDict,
+    store: storage.GameStore,
+    worker_slot: affinity.WorkerSlot,
+) -> game_state.GameState:
+    try:
+        shape = game_state.get_board_shape(body.board_size, body.win_length)
+    except ValueError as error:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail=str(error)
+        )
+    new_game_uid = worker_slot.new_game_id()
+    game = game_state.GameState(
+        game_id=new_game_uid,
+        first_player_name=body.player_name,
+        shape=shape,
+        against_server=body.against_server,
+    )
+    if body.against_server:
+        if not solver.supports(game):
+            raise fastapi.exceptions.HTTPException(
+                status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+                detail="Playing against the server needs a 3x3 board.",
+            )
+        game.add_second_player(SERVER_PLAYER_NAME)
+        if not game.current_turn_first_player:
+            move, _ = solver.best_move(game)
+            game.play_turn(move)
+    active_games[new_game_uid] = game
+    store.record_create(game)
+    return game
+
+
 @app.post("/new_game")
 def new_game(
-    body: GameBody, active_games: GamesDict = fastapi.Depends(get_active_games)
+    body: NewGameBody,
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    archive: storage.GameArchive = fastapi.Depends(get_game_archive),
+    reaper_settings: reaper.ReaperSettings = fastapi.Depends(get_reaper_settings),
+    worker_slot: affinity.WorkerSlot = fastapi.Depends(get_worker_slot),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
 ) -> Any:
-    new_game_uid = uuid.uuid4()
-    active_games[new_game_uid] = game_state.GameState(
-        game_id=new_game_uid, first_player_name=body.player_name
-    )
+    game = create_game(body, active_games, store, worker_slot)
+    reaper.enforce_cap(active_games, archive, store, game_locks, reaper_settings)
     return {
-        "game_id": new_game_uid,
-        "player_token": active_games[new_game_uid].first_player.token,
+        "game_id": game.game_id,
+        "player_token": game.first_player.token,
     }
 
 
-@app.get("/{game_id}")
-def get_game_state(
-    game_id: uuid.UUID, active_games: GamesDict = fastapi.Depends(get_active_games)
+def unsaved_result() -> dict[str, Any]:
+    return {
+        "status_code": fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+        "body": {"detail": GAME_NOT_SAVED},
+    }
+
+
+def run_batch(
+    items: list[dict[str, Any]],
+    model: type[BatchItem],
+    apply: Callable[[BatchItem], Any],
+    store: storage.GameStore,
+) -> fastapi.Response:
+    """Applies the items one after another. Each result has the status code
+    and body the item would have gotten as a request of its own. The items'
+    records are made durable together, and items whose records weren't get
+    503."""
+    results: list[dict[str, Any]] = []
+    # The last record made for each item.
+    records: list[int] = []
+    with store.deferred():
+        for item in items:
+            try:
+                body = apply(model(**item))
+            except pydantic.ValidationError as error:
+                results.append(
+                    {
+                        "status_code": 422,
+                        "body": {
+                            "detail": fastapi.encoders.jsonable_encoder(error.errors())
+                        },
+                    }
+                )
+            except fastapi.exceptions.HTTPException as error:
+                results.append(
+                    {
+                        "status_code": error.status_code,
+                        "body": {"detail": error.detail},
+                    }
+                )
+            except storage.StoreFailed:
+                results.append(unsaved_result())
+            else:
+                results.append(
+                    {"status_code": fastapi.status.HTTP_200_OK, "body": body}
+                )
+            records.append(store.last_record())
+    durable = store.wait_durable(store.last_record())
+    for index, record in enumerate(records):
+        if record > durable and results[index]["status_code"] == 200:
+            results[index] = unsaved_result()
+    return fastapi.Response(
+        orjson.dumps({"results": results}), media_type="application/json"
+    )
+
+
+@app.post("/batch/new_game")
+def batch_new_game(
+    body: BatchBody,
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    archive: storage.GameArchive = fastapi.Depends(get_game_archive),
+    reaper_settings: reaper.ReaperSettings = fastapi.Depends(get_reaper_settings),
+    worker_slot: affinity.WorkerSlot = fastapi.Depends(get_worker_slot),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+) -> fastapi.Response:
+    def apply(item: NewGameBody) -> dict[str, uuid.UUID]:
+        game = create_game(item, active_games, store, worker_slot)
+        return {"game_id": game.game_id, "player_token": game.first_player.token}
+
+    response = run_batch(body.items, NewGameBody, apply, store)
+    reaper.enforce_cap(active_games, archive, store, game_locks, reaper_settings)
+    return response
+
+
+@app.post("/batch/join")
+def batch_join(
+    body: BatchBody,
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
+) -> fastapi.Response:
+    def apply(item: JoinItem) -> dict[str, uuid.UUID]:
+        new_player, _ = add_player(
+            item.game_id,
+            item.player_name,
+            active_games,
+            store,
+            game_locks,
+            game_events,
+        )
+        return {"game_id": item.game_id, "player_token": new_player.token}
+
+    return run_batch(body.items, JoinItem, apply, store)
+
+
+@app.post("/batch/play_turn")
+def batch_play_turn(
+    body: BatchBody,
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
+) -> fastapi.Response:
+    def apply(item: PlayTurnItem) -> Any:
+        game = get_current_game(item.game_id, active_games)
+        with game_locks.for_game(game.game_id):
+            return play_game_turn(
+                item.player_token,
+                game,
+                game_state.Move(row=item.row, col=item.column),
+                store,
+                game_events,
+            )
+
+    return run_batch(body.items, PlayTurnItem, apply, store)
+
+
+@app.post("/matchmake")
+async def matchmake(
+    body: MatchmakeBody,
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    archive: storage.GameArchive = fastapi.Depends(get_game_archive),
+    reaper_settings: reaper.ReaperSettings = fastapi.Depends(get_reaper_settings),
+    worker_slot: affinity.WorkerSlot = fastapi.Depends(get_worker_slot),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
+    matchmaker: matchmaking.Matchmaker = fastapi.Depends(get_matchmaker),
 ) -> Any:
+    """Joins the game that has waited longest for an opponent on the same
+    board, or starts one and waits up to `wait_seconds` for an opponent.
+    The queue is only touched from the event loop, while joining and creating
+    games wait for the store and run in a thread."""
     try:
-        current_game = active_games[game_id]
-    except KeyError:
+        shape = game_state.get_board_shape(body.board_size, body.win_length)
+    except ValueError as error:
         raise fastapi.exceptions.HTTPException(
-            status_code=fastapi.status.HTTP_404_NOT_FOUND
+            status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail=str(error)
+        )
+    shape_key = (shape.size, shape.win_length)
+    now = time.monotonic()
+    while (ticket := matchmaker.take(shape_key, active_games, now)) is not None:
+        try:
+            player, _ = await asyncio.to_thread(
+                add_player,
+                ticket.game_id,
+                body.player_name,
+                active_games,
+                store,
+                game_locks,
+                game_events,
+            )
+        except fastapi.exceptions.HTTPException:
+            # Joined by id, or removed, in the meantime.
+            continue
+        finally:
+            matchmaker.resolve(ticket)
+        return {
+            "game_id": ticket.game_id,
+            "player_token": player.token,
+            "player": "second_player",
+            "matched": True,
+        }
+
+    def start_game() -> game_state.GameState:
+        game = create_game(
+            NewGameBody(
+                player_name=body.player_name,
+                board_size=body.board_size,
+                win_length=body.win_length,
+            ),
+            active_games,
+            store,
+            worker_slot,
         )
-    second_player = current_game.second_player
+        reaper.enforce_cap(active_games, archive, store, game_locks, reaper_settings)
+        return game
+
+    game = await asyncio.to_thread(start_game)
+    wait_seconds = min(body.wait_seconds, matchmaker.settings.max_wait_seconds)
+    waiter = asyncio.get_running_loop().create_future() if wait_seconds > 0 else None
+    ticket = matchmaker.enqueue(shape_key, game.game_id, waiter, now)
+    if waiter is not None:
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), wait_seconds)
+        except asyncio.TimeoutError:
+            if not matchmaker.cancel(ticket):
+                # Taken just before the timeout, the join is about to finish.
+                await waiter
+        except asyncio.CancelledError:
+            # The client went away.
+            matchmaker.cancel(ticket)
+            raise
     return {
-        "game_state": current_game.game_state,
-        "first_player_name": current_game.first_player.name,
+        "game_id": game.game_id,
+        "player_token": game.first_player.token,
+        "player": "first_player",
+        "matched": game.second_player is not None,
+    }
+
+
+@app.get("/metrics")
+def get_metrics(
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    archive: storage.GameArchive = fastapi.Depends(get_game_archive),
+    pool: ocr_pool.OcrPool = fastapi.Depends(get_ocr_pool),
+    cache: board_cache.BoardCache = fastapi.Depends(get_board_cache),
+    matchmaker: matchmaking.Matchmaker = fastapi.Depends(get_matchmaker),
+) -> fastapi.Response:
+    statuses = collections.Counter(game.status for game in list(active_games.values()))
+    samples = [
+        metrics.Sample(
+            "t3_games", "Games in memory.", "gauge", {"": len(active_games)}
+        ),
+        metrics.Sample(
+            "t3_games_by_status",
+            "Games in memory by status.",
+            "gauge",
+            {status: statuses[status] for status in game_state.STATUSES},
+            label_name="status",
+        ),
+        metrics.Sample(
+            "t3_archived_games",
+            "Finished games evicted from memory.",
+            "gauge",
+            {"": len(archive)},
+        ),
+        metrics.Sample(
+            "t3_ocr_pending_images",
+            "Images being recognized or waiting for an OCR worker.",
+            "gauge",
+            {"": pool.pending},
+        ),
+        metrics.Sample(
+            "t3_matchmaking_queued_games",
+            "Games queued for matchmaking, including expired and cancelled ones.",
+            "gauge",
+            {"": matchmaker.waiting()},
+        ),
+        metrics.Sample(
+            "t3_board_cache_entries", "Boards in the cache.", "gauge", {"": len(cache)}
+        ),
+        metrics.Sample(
+            "t3_board_cache_bytes",
+            "Estimated memory used by the board cache.",
+            "gauge",
+            {"": cache.memory_bytes},
+        ),
+        metrics.Sample(
+            "t3_board_cache_lookups_total",
+            "Board cache lookups by result.",
+            "counter",
+            {"hit": cache.stats.hits, "miss": cache.stats.misses},
+            label_name="result",
+        ),
+        metrics.Sample(
+            "t3_board_cache_evictions_total",
+            "Boards evicted from the cache.",
+            "counter",
+            {"": cache.stats.evictions},
+        ),
+    ]
+    return fastapi.Response(metrics.render(samples), media_type=metrics.CONTENT_TYPE)
+
+
+def exported_games(
+    active_games: GamesDict,
+    archive: storage.GameArchive,
+    game_locks: locks.LockStripes,
+    encode: export.Encoder,
+) -> Iterator[bytes]:
+    """Every live and archived game, encoded one at a time. Games created
+    after the export started may be left out."""
+    for game_id in list(active_games):
+        game = active_games.get(game_id)
+        if game is not None:
+            with game_locks.for_game(game_id):
+                record = encode(game, False)
+            yield record
+    for _, packed_game in archive.items():
+        yield encode(game_state.GameState.unpack(packed_game), True)
+
+
+@app.get("/export")
+def export_games(
+    export_format: Literal["ndjson", "binary"] = fastapi.Query(
+        default=export.FORMAT_NDJSON, alias="format"
+    ),
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    archive: storage.GameArchive = fastapi.Depends(get_game_archive),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+) -> fastapi.responses.StreamingResponse:
+    """Streams all games with their moves, see `server.export`."""
+    records = exported_games(
+        active_games, archive, game_locks, export.ENCODERS[export_format]
+    )
+    return fastapi.responses.StreamingResponse(
+        export.chunked(records), media_type=export.MEDIA_TYPES[export_format]
+    )
+
+
+def version_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def etag(game: game_state.GameState) -> str:
+    return version_etag(game.version)
+
+
+def listed_etags(header: str) -> set[str]:
+    return {tag.strip() for tag in header.split(",")}
+
+
+def check_precondition(if_match: Optional[str], game: game_state.GameState) -> None:
+    """Lets a client make a request conditional on the game not having
+    changed since it last saw it, by sending that version's ETag in
+    `If-Match`."""
+    if if_match is None:
+        return
+    tags = listed_etags(if_match)
+    if "*" not in tags and etag(game) not in tags:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_412_PRECONDITION_FAILED,
+            detail="Game has changed",
+            headers={"ETag": etag(game)},
+        )
+
+
+def render_game(game: game_state.GameState) -> dict[str, Any]:
+    second_player = game.second_player
+    return {
+        "game_state": game.game_state,
+        "first_player_name": game.first_player.name,
         "second_player_name": None if second_player is None else second_player.name,
-        "current_turn": "first_player"
-        if current_game.current_turn_first_player
-        else "second_player",
+        "board_size": game.shape.size,
+        "win_length": game.shape.win_length,
+        "current_turn": current_turn(game),
+        "version": game.version,
     }
 
 
-@app.post("/{game_id}/join")
-def join_game(
+def rendered_game(
+    game: game_state.GameState, game_locks: locks.LockStripes
+) -> tuple[int, bytes]:
+    """The version and JSON for `GET /{game_id}`, only rendered again after
+    the game changed."""
+    rendered = game.rendered
+    if rendered is None or rendered[0] != game.version:
+        with game_locks.for_game(game.game_id):
+            rendered = (game.version, orjson.dumps(render_game(game)))
+        game.rendered = rendered
+    return rendered
+
+
+@app.get("/{game_id}")
+def get_game_state(
     game_id: uuid.UUID,
-    body: GameBody,
+    if_none_match: Optional[str] = fastapi.Header(default=None),
     active_games: GamesDict = fastapi.Depends(get_active_games),
-) -> Any:
+    archive: storage.GameArchive = fastapi.Depends(get_game_archive),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+) -> fastapi.Response:
+    current_game = active_games.get(game_id)
+    if current_game is None:
+        current_game = archive.get(game_id)
+    else:
+        reaper.touch(current_game)
+    if current_game is None:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_404_NOT_FOUND
+        )
+    tag = etag(current_game)
+    # If-None-Match compares weakly.
+    if if_none_match is not None and not listed_etags(if_none_match).isdisjoint(
+        {tag, "W/" + tag, "*"}
+    ):
+        return fastapi.Response(
+            status_code=fastapi.status.HTTP_304_NOT_MODIFIED, headers={"ETag": tag}
+        )
+    version, content = rendered_game(current_game, game_locks)
+    return fastapi.Response(
+        content, media_type="application/json", headers={"ETag": version_etag(version)}
+    )
+
+
+def add_player(
+    game_id: uuid.UUID,
+    player_name: str,
+    active_games: GamesDict,
+    store: storage.GameStore,
+    game_locks: locks.LockStripes,
+    game_events: events.GameEvents,
+) -> tuple[game_state.Player, int]:
+    """Joins `player_name` as the second player. Returns the player and the
+    version of the game after joining."""
     try:
         current_game = active_games[game_id]
     except KeyError:
         raise fastapi.exceptions.HTTPException(
             status_code=fastapi.status.HTTP_404_NOT_FOUND
         )
-    if current_game.second_player is not None:
-        raise fastapi.exceptions.HTTPException(
-            status_code=fastapi.status.HTTP_400_BAD_REQUEST,
-            detail="Game is full.",
+    with game_locks.for_game(game_id):
+        if current_game.second_player is not None:
+            raise fastapi.exceptions.HTTPException(
+                status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+                detail="Game is full.",
+            )
+        new_player = current_game.add_second_player(player_name)
+        store.record_join(current_game)
+        game_events.publish(
+            game_id,
+            events.encode(
+                "join",
+                {
+                    "version": current_game.version,
+                    "second_player_name": new_player.name,
+                    "current_turn": current_turn(current_game),
+                },
+            ),
         )
-    new_player = current_game.add_second_player(body.player_name)
+        version = current_game.version
+    reaper.touch(current_game)
+    return new_player, version
+
+
+@app.post("/{game_id}/join")
+def join_game(
+    game_id: uuid.UUID,
+    body: GameBody,
+    response: fastapi.Response,
+    active_games: GamesDict = fastapi.Depends(get_active_games),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
+) -> Any:
+    new_player, version = add_player(
+        game_id, body.player_name, active_games, store, game_locks, game_events
+    )
+    response.headers["ETag"] = version_etag(version)
     return {
         "game_id": game_id,
         "player_token": new_player.token,
@@ -96,8 +693,13 @@ def validate_player_turn(token: str, game: game_state.GameState) -> bool:
 
 
 def play_game_turn(
-    player_token: str, game: game_state.GameState, move: game_state.Move
+    player_token: str,
+    game: game_state.GameState,
+    move: game_state.Move,
+    store: storage.GameStore,
+    game_events: events.GameEvents,
 ) -> Any:
+    """Must be called with the game locked."""
     if not validate_token(player_token, game):
         raise fastapi.exceptions.HTTPException(
             status_code=fastapi.status.HTTP_401_UNAUTHORIZED
@@ -114,42 +716,213 @@ def play_game_turn(
         raise fastapi.exceptions.HTTPException(
             status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Invalid turn"
         )
+    store.record_move(game, move)
+    publish_move(game_events, game, move)
     if winner is not None:
         return {"result": "won", "winner": winner.name}
     elif game.is_drawn:
         return {"result": "draw"}
+    elif game.against_server:
+        server_move = play_server_turn(game, store, game_events)
+        if game.winner is not None:
+            return {
+                "result": "won",
+                "winner": game.winner.name,
+                "server_move": server_move,
+            }
+        elif game.is_drawn:
+            return {"result": "draw", "server_move": server_move}
+        return {"server_move": server_move}
     else:
         return None
 
 
-class PlayTurnBody(pydantic.BaseModel):
-    row: int = pydantic.Field(ge=0, le=2)
-    column: int = pydantic.Field(ge=0, le=2)
+@app.get("/{game_id}/best_move")
+def get_best_move(
+    current_game: game_state.GameState = fastapi.Depends(get_current_game),
+) -> Any:
+    if not solver.supports(current_game):
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+            detail="Only 3x3 boards can be solved.",
+        )
+    if current_game.is_over:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Game is over"
+        )
+    move, score = solver.best_move(current_game)
+    return {"row": move.row, "column": move.col, "score": score}
+
+
+@app.get("/{game_id}/events")
+async def subscribe_to_game(
+    current_game: game_state.GameState = fastapi.Depends(get_current_game),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
+) -> fastapi.responses.StreamingResponse:
+    """Server-sent events: the full game as a `state` event, then a `join` or
+    `move` event with only what changed after every update. The stream ends
+    with the move that finishes the game."""
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    subscription = game_events.new_subscription(current_game.game_id)
+
+    def subscribe() -> tuple[bytes, bool]:
+        """The game's state, and whether events follow it."""
+        # Nothing can change between the state and the subscription.
+        with game_locks.for_game(current_game.game_id):
+            state = events.encode(
+                "state",
+                fastapi.encoders.jsonable_encoder(
+                    {**render_game(current_game), **game_result(current_game)}
+                ),
+            )
+            if current_game.is_over:
+                return state, False
+            game_events.add(subscription)
+            return state, True
+
+    # Requests hold the game's lock while they wait for the store, which
+    # mustn't hold up the event loop.
+    state, subscribed = await asyncio.to_thread(subscribe)
+    if not subscribed:
+        return fastapi.responses.StreamingResponse(
+            iter([state]), media_type="text/event-stream", headers=headers
+        )
+    return fastapi.responses.StreamingResponse(
+        game_events.stream(subscription, state),
+        media_type="text/event-stream",
+        headers=headers,
+    )
 
 
 @app.post("/{game_id}/play_turn")
 def play_turn(
     body: PlayTurnBody,
+    response: fastapi.Response,
     x_player_token: str = fastapi.Header(default=None),
+    if_match: Optional[str] = fastapi.Header(default=None),
     current_game: game_state.GameState = fastapi.Depends(get_current_game),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
 ) -> Any:
-    return play_game_turn(
-        x_player_token,
-        current_game,
-        game_state.Move(col=body.column, row=body.row),
-    )
+    with game_locks.for_game(current_game.game_id):
+        check_precondition(if_match, current_game)
+        result = play_game_turn(
+            x_player_token,
+            current_game,
+            game_state.Move(col=body.column, row=body.row),
+            store,
+            game_events,
+        )
+        response.headers["ETag"] = etag(current_game)
+    return result
+
+
+def check_image(data: memoryview, settings: uploads.UploadSettings) -> None:
+    try:
+        uploads.check_image(data, settings)
+    except uploads.UnsupportedImage:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Not an image in a supported format",
+        )
+    except ocr_pool.ImageTooLarge:
+        raise fastapi.exceptions.HTTPException(
+            status_code=uploads.HTTP_413_CONTENT_TOO_LARGE,
+            detail="Image has too many pixels",
+        )
+
+
+async def recognize_image(
+    pool: ocr_pool.OcrPool, data: bytes, size: int
+) -> list[list[game_state.Symbol]]:
+    retry_after = {"Retry-After": str(pool.settings.retry_after_seconds)}
+    try:
+        return await pool.recognize(data, size=size)
+    except ocr_pool.PoolSaturated:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many images are being processed",
+            headers=retry_after,
+        )
+    except ocr_pool.RecognitionTimeout:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Image recognition timed out",
+            headers=retry_after,
+        )
+    except ocr_pool.WorkerCrashed:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Image recognition failed",
+            headers=retry_after,
+        )
+    except ocr_pool.ImageTooLarge:
+        raise fastapi.exceptions.HTTPException(
+            status_code=uploads.HTTP_413_CONTENT_TOO_LARGE,
+            detail="Image has too many pixels",
+        )
+    except ocr_pool.UnreadableImage:
+        raise fastapi.exceptions.HTTPException(
+            status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+            detail="Image could not be read",
+        )
 
 
 @app.post("/{game_id}/play_turn_image")
-def play_turn_image(
+async def play_turn_image(
     image_file: fastapi.UploadFile,
+    response: fastapi.Response,
     x_player_token: str = fastapi.Header(default=None),
+    if_match: Optional[str] = fastapi.Header(default=None),
     current_game: game_state.GameState = fastapi.Depends(get_current_game),
+    pool: ocr_pool.OcrPool = fastapi.Depends(get_ocr_pool),
+    cache: board_cache.BoardCache = fastapi.Depends(get_board_cache),
+    store: storage.GameStore = fastapi.Depends(get_game_store),
+    game_locks: locks.LockStripes = fastapi.Depends(get_game_locks),
+    game_events: events.GameEvents = fastapi.Depends(get_game_events),
+    upload_settings: uploads.UploadSettings = fastapi.Depends(get_upload_settings),
 ) -> Any:
-    desired_board_state = image_processing.get_board_from_file(image_file.file)
-    move = current_game.get_move_difference(desired_board_state)
-    if move is None:
+    # Checked before the image is, so that unauthorized requests don't take
+    # up the pool. `play_game_turn` checks it again with the game locked.
+    if not validate_token(x_player_token, current_game):
         raise fastapi.exceptions.HTTPException(
-            status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Invalid move"
+            status_code=fastapi.status.HTTP_401_UNAUTHORIZED
         )
-    return play_game_turn(x_player_token, current_game, move)
+    # The image is only copied out of the upload to be sent to a worker.
+    with uploads.mapped(image_file.file) as data:
+        check_image(data, upload_settings)
+        cache_key = cache.key(data, current_game.size)
+        cached_board = cache.get(cache_key)
+        if cached_board is None:
+            desired_board_state = await recognize_image(
+                pool, bytes(data), current_game.size
+            )
+            cache.put(cache_key, desired_board_state)
+        else:
+            desired_board_state = cached_board
+
+    def play_recognized_turn() -> Any:
+        # The game may have changed while the image was being recognized, so
+        # the move is only worked out once the game is locked.
+        with game_locks.for_game(current_game.game_id):
+            check_precondition(if_match, current_game)
+            try:
+                move = current_game.get_move_difference(desired_board_state)
+            except game_state.InvalidGameStateRequested:
+                move = None
+            if move is None:
+                raise fastapi.exceptions.HTTPException(
+                    status_code=fastapi.status.HTTP_400_BAD_REQUEST,
+                    detail="Invalid move",
+                )
+            result = play_game_turn(
+                x_player_token, current_game, move, store, game_events
+            )
+            response.headers["ETag"] = etag(current_game)
+        return result
+
+    # Waiting for the game's lock, saving the move and the server's reply
+    # block, so they don't run on the event loop.
+    return await asyncio.to_thread(play_recognized_turn)
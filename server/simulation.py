@@ -0,0 +1,288 @@
+"""Vectorized self-play for tuning bots and generating load test fixtures.
+
+Thousands of games are held in one array and advance in lock step, using the
+rules of `GameState`: X moves first, symbols alternate, the first player to get
+`win_length` in a row wins and a full board is a draw.
+
+Run `python -m server.simulation --help` for the command line interface.
+"""
+
+from __future__ import annotations
+from typing import Callable, Optional
+import argparse
+import dataclasses
+import functools
+import time
+
+import numpy as np
+import numpy.typing as npt
+
+from server import game_state
+
+EMPTY = 0
+X = 1
+O = 2
+# Cells before a game started or after it finished in a move record.
+NO_MOVE = -1
+
+Boards = npt.NDArray[np.int8]
+Cells = npt.NDArray[np.intp]
+Policy = Callable[["BatchGames", Cells, np.random.Generator], Cells]
+
+
+class BatchGames:
+    """A batch of games on the same board shape. `boards` holds one row per
+    game with a cell per column, plus a last column that always stays empty so
+    that padded line tables can point at it."""
+
+    def __init__(self, count: int, shape: game_state.BoardShape) -> None:
+        self.shape = shape
+        self.boards: Boards = np.zeros((count, shape.cell_count + 1), dtype=np.int8)
+        self.winners = np.zeros(count, dtype=np.int8)
+        self.finished = np.zeros(count, dtype=bool)
+        self.turns_played = 0
+        self.line_cells, self.lines_by_cell, self.line_incidence = _line_tables(
+            shape.size, shape.win_length
+        )
+
+    @property
+    def count(self) -> int:
+        return int(self.boards.shape[0])
+
+    @property
+    def symbol_to_move(self) -> int:
+        return X if self.turns_played % 2 == 0 else O
+
+    def empty_cells(self, games: Optional[Cells] = None) -> npt.NDArray[np.bool_]:
+        boards = self.boards if games is None else self.boards[games]
+        empty: npt.NDArray[np.bool_] = boards[:, :-1] == EMPTY
+        return empty
+
+    def play(self, games: Cells, cells: Cells) -> None:
+        """Plays `cells[i]` in game `games[i]` for the symbol to move. All the
+        games must be unfinished and the cells empty."""
+        symbol = self.symbol_to_move
+        assert not self.finished[games].any()
+        assert (self.boards[games, cells] == EMPTY).all()
+        self.boards[games, cells] = symbol
+
+        lines = self.lines_by_cell[cells]
+        line_boards = self.boards[games[:, None, None], self.line_cells[lines]]
+        won = (line_boards == symbol).all(axis=2).any(axis=1)
+        self.winners[games[won]] = symbol
+        self.turns_played += 1
+        self.finished[games[won]] = True
+        if self.turns_played == self.shape.cell_count:
+            self.finished[:] = True
+
+    def line_counts(
+        self, games: Cells, symbol: int
+    ) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.float32]]:
+        """How many cells of every line `symbol` and the empty cells hold."""
+        boards = self.boards[games, :-1]
+        line_incidence = self.line_incidence.T
+        return (
+            (boards == symbol).astype(np.float32) @ line_incidence,
+            (boards == EMPTY).astype(np.float32) @ line_incidence,
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def _line_tables(
+    size: int, win_length: int
+) -> tuple[Cells, Cells, npt.NDArray[np.float32]]:
+    """The cells of each winning line, the lines through each cell padded with
+    a dummy line made of the always empty cell, and a line by cell incidence
+    matrix."""
+    cell_count = size * size
+    masks = game_state.winning_lines(size, win_length)
+    line_cells = np.array(
+        [[cell for cell in range(cell_count) if mask >> cell & 1] for mask in masks]
+        + [[cell_count] * win_length],
+        dtype=np.intp,
+    )
+    dummy_line = len(masks)
+    by_cell = [
+        [line for line, mask in enumerate(masks) if mask >> cell & 1]
+        for cell in range(cell_count)
+    ]
+    widest = max(len(lines) for lines in by_cell)
+    lines_by_cell = np.array(
+        [lines + [dummy_line] * (widest - len(lines)) for lines in by_cell],
+        dtype=np.intp,
+    )
+    incidence = np.zeros((len(masks), cell_count), dtype=np.float32)
+    for line, cells in enumerate(line_cells[:-1]):
+        incidence[line, cells] = 1
+    return line_cells, lines_by_cell, incidence
+
+
+def random_policy(batch: BatchGames, games: Cells, rng: np.random.Generator) -> Cells:
+    scores = rng.random((len(games), batch.shape.cell_count))
+    scores[~batch.empty_cells(games)] = -1
+    cells: Cells = np.argmax(scores, axis=1)
+    return cells
+
+
+def greedy_policy(batch: BatchGames, games: Cells, rng: np.random.Generator) -> Cells:
+    """Completes a line if it can, otherwise blocks the opponent from
+    completing one, otherwise plays randomly."""
+    symbol = batch.symbol_to_move
+    opponent = O if symbol == X else X
+    win_length = batch.shape.win_length
+    scores = rng.random((len(games), batch.shape.cell_count))
+    for candidate, bonus in ((opponent, 1.0), (symbol, 2.0)):
+        own, empty = batch.line_counts(games, candidate)
+        open_lines = ((own == win_length - 1) & (empty == 1)).astype(np.float32)
+        scores += bonus * (open_lines @ batch.line_incidence > 0)
+    scores[~batch.empty_cells(games)] = -1
+    cells: Cells = np.argmax(scores, axis=1)
+    return cells
+
+
+@functools.lru_cache(maxsize=None)
+def _solver_moves() -> Cells:
+    """The solver's best move for every 3x3 position, indexed by the base 3
+    encoding of the board. Positions that can't be played are -1."""
+    from server import solver
+
+    cell_count = solver.CELL_COUNT
+    moves = np.full(3**cell_count, NO_MOVE, dtype=np.intp)
+    perfect = solver.get_solver()
+    for code in range(3**cell_count):
+        x_bits = o_bits = 0
+        remainder = code
+        for cell in range(cell_count):
+            remainder, symbol = divmod(remainder, 3)
+            if symbol == X:
+                x_bits |= 1 << cell
+            elif symbol == O:
+                o_bits |= 1 << cell
+        x_count, o_count = bin(x_bits).count("1"), bin(o_bits).count("1")
+        if x_count - o_count not in (0, 1):
+            continue
+        try:
+            move, _ = perfect.best_move(x_bits, o_bits)
+        except ValueError:
+            continue
+        moves[code] = move.row * solver.SIZE + move.col
+    return moves
+
+
+def solver_policy(batch: BatchGames, games: Cells, rng: np.random.Generator) -> Cells:
+    if batch.shape.size != game_state.DEFAULT_BOARD_SIZE:
+        raise ValueError("the solver policy needs a 3x3 board")
+    powers = 3 ** np.arange(batch.shape.cell_count, dtype=np.intp)
+    codes = batch.boards[games, :-1].astype(np.intp) @ powers
+    cells: Cells = _solver_moves()[codes]
+    return cells
+
+
+POLICIES: dict[str, Policy] = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+    "solver": solver_policy,
+}
+
+
+@dataclasses.dataclass
+class SimulationResult:
+    games: int
+    x_wins: int
+    o_wins: int
+    draws: int
+    seconds: float
+    # One row per game with the cell played on each turn, if requested.
+    moves: Optional[Cells] = None
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.seconds if self.seconds > 0 else float("inf")
+
+
+def simulate_batch(
+    count: int,
+    x_policy: Policy,
+    o_policy: Policy,
+    shape: game_state.BoardShape,
+    rng: np.random.Generator,
+) -> tuple[BatchGames, Cells]:
+    batch = BatchGames(count, shape)
+    moves = np.full((count, shape.cell_count), NO_MOVE, dtype=np.intp)
+    while not batch.finished.all():
+        games = np.flatnonzero(~batch.finished)
+        policy = x_policy if batch.symbol_to_move == X else o_policy
+        cells = policy(batch, games, rng)
+        moves[games, batch.turns_played] = cells
+        batch.play(games, cells)
+    return batch, moves
+
+
+def simulate(
+    games: int,
+    x_policy: str = "random",
+    o_policy: str = "random",
+    shape: Optional[game_state.BoardShape] = None,
+    batch_size: int = 10_000,
+    seed: Optional[int] = None,
+    keep_moves: bool = False,
+) -> SimulationResult:
+    """Plays `games` games in batches of at most `batch_size`."""
+    shape = game_state.get_board_shape() if shape is None else shape
+    rng = np.random.default_rng(seed)
+    x_wins = o_wins = 0
+    all_moves = []
+    start = time.perf_counter()
+    for batch_start in range(0, games, batch_size):
+        count = min(batch_size, games - batch_start)
+        batch, moves = simulate_batch(
+            count, POLICIES[x_policy], POLICIES[o_policy], shape, rng
+        )
+        x_wins += int((batch.winners == X).sum())
+        o_wins += int((batch.winners == O).sum())
+        if keep_moves:
+            all_moves.append(moves)
+    seconds = time.perf_counter() - start
+    return SimulationResult(
+        games=games,
+        x_wins=x_wins,
+        o_wins=o_wins,
+        draws=games - x_wins - o_wins,
+        seconds=seconds,
+        moves=np.concatenate(all_moves) if keep_moves and all_moves else None,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Batch tic tac toe self-play.")
+    parser.add_argument("--games", type=int, default=100_000)
+    parser.add_argument("--x-policy", choices=sorted(POLICIES), default="random")
+    parser.add_argument("--o-policy", choices=sorted(POLICIES), default="random")
+    parser.add_argument("--board-size", type=int, default=game_state.DEFAULT_BOARD_SIZE)
+    parser.add_argument("--win-length", type=int)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--output", help="save the moves of every game to this .npy file"
+    )
+    args = parser.parse_args()
+
+    result = simulate(
+        args.games,
+        x_policy=args.x_policy,
+        o_policy=args.o_policy,
+        shape=game_state.get_board_shape(args.board_size, args.win_length),
+        batch_size=args.batch_size,
+        seed=args.seed,
+        keep_moves=args.output is not None,
+    )
+    print(f"games: {result.games}")
+    print(f"X wins: {result.x_wins}, O wins: {result.o_wins}, draws: {result.draws}")
+    print(f"{result.games_per_second:,.0f} games/s ({result.seconds:.2f}s)")
+    if args.output is not None:
+        assert result.moves is not None
+        np.save(args.output, result.moves)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Perfect play for the classic 3x3 board.
+
+Positions are keyed by `x_bits | o_bits << 9`, using the same bitboards as
+`GameState`. The transposition table folds the 8 rotations and reflections of
+a board into one canonical key, and is shared by all games.
+"""
+
+from __future__ import annotations
+from typing import Callable, Optional
+import functools
+
+from server import game_state
+
+SIZE = game_state.DEFAULT_BOARD_SIZE
+CELL_COUNT = SIZE * SIZE
+BOARD_MASK = (1 << CELL_COUNT) - 1
+
+_SHAPE = game_state.get_board_shape(SIZE)
+assert _SHAPE.winning_masks_by_cell is not None
+WINNING_MASKS = game_state.winning_lines(SIZE, SIZE)
+WINNING_MASKS_BY_CELL = _SHAPE.winning_masks_by_cell
+
+
+def _symmetries() -> list[list[int]]:
+    """The 8 symmetries of the square, each as a map from cell to cell."""
+    transforms: list[Callable[[int, int], tuple[int, int]]] = [
+        lambda row, col: (row, col),
+        lambda row, col: (col, SIZE - 1 - row),
+        lambda row, col: (SIZE - 1 - row, SIZE - 1 - col),
+        lambda row, col: (SIZE - 1 - col, row),
+        lambda row, col: (row, SIZE - 1 - col),
+        lambda row, col: (SIZE - 1 - row, col),
+        lambda row, col: (col, row),
+        lambda row, col: (SIZE - 1 - col, SIZE - 1 - row),
+    ]
+    symmetries = []
+    for transform in transforms:
+        mapping = []
+        for cell in range(CELL_COUNT):
+            row, col = transform(*divmod(cell, SIZE))
+            mapping.append(row * SIZE + col)
+        symmetries.append(mapping)
+    return symmetries
+
+
+def _permutation_table(mapping: list[int]) -> tuple[int, ...]:
+    """Applies `mapping` to every possible 9 bit mask."""
+    table = []
+    for mask in range(1 << CELL_COUNT):
+        permuted = 0
+        for cell in range(CELL_COUNT):
+            if mask >> cell & 1:
+                permuted |= 1 << mapping[cell]
+        table.append(permuted)
+    return tuple(table)
+
+
+def _is_win(bits: int, cell: int) -> bool:
+    return any(bits & mask == mask for mask in WINNING_MASKS_BY_CELL[cell])
+
+
+class Solver:
+    """Minimax values of 3x3 positions, from the point of view of the player to
+    move. A win scores one more than the number of cells left empty after it,
+    so quicker wins and slower losses are preferred. A draw scores 0."""
+
+    def __init__(self) -> None:
+        self._permutations = [_permutation_table(mapping) for mapping in _symmetries()]
+        self._table: dict[int, int] = {}
+        # Solving the empty board fills the table with every reachable position.
+        self.value(0, 0)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def canonical_key(self, x_bits: int, o_bits: int) -> int:
+        return min(
+            permutation[x_bits] | permutation[o_bits] << CELL_COUNT
+            for permutation in self._permutations
+        )
+
+    def value(self, x_bits: int, o_bits: int) -> int:
+        """The value of a position that isn't won yet. Positions missing from
+        the table are solved and added to it, concurrent callers can at worst
+        solve the same position twice."""
+        key = self.canonical_key(x_bits, o_bits)
+        try:
+            return self._table[key]
+        except KeyError:
+            pass
+        best = self._best_move(x_bits, o_bits)
+        value = 0 if best is None else best[1]
+        self._table[key] = value
+        return value
+
+    def _best_move(self, x_bits: int, o_bits: int) -> Optional[tuple[int, int]]:
+        x_to_move = bin(x_bits).count("1") == bin(o_bits).count("1")
+        own, other = (x_bits, o_bits) if x_to_move else (o_bits, x_bits)
+        empty = BOARD_MASK & ~(x_bits | o_bits)
+        empty_count = bin(empty).count("1")
+        best: Optional[tuple[int, int]] = None
+        for cell in range(CELL_COUNT):
+            bit = 1 << cell
+            if not empty & bit:
+                continue
+            played = own | bit
+            if _is_win(played, cell):
+                score = empty_count
+            elif empty_count == 1:
+                score = 0
+            elif x_to_move:
+                score = -self.value(played, other)
+            else:
+                score = -self.value(other, played)
+            if best is None or score > best[1]:
+                best = (cell, score)
+        return best
+
+    def best_move(self, x_bits: int, o_bits: int) -> tuple[game_state.Move, int]:
+        """The best move for the player to move and its value. Raises
+        `ValueError` if the game is already over."""
+        if (x_bits | o_bits) == BOARD_MASK or any(
+            bits & mask == mask for bits in (x_bits, o_bits) for mask in WINNING_MASKS
+        ):
+            raise ValueError("the game is over")
+        best = self._best_move(x_bits, o_bits)
+        assert best is not None
+        row, col = divmod(best[0], SIZE)
+        return game_state.Move(row=row, col=col), best[1]
+
+
+@functools.lru_cache(maxsize=None)
+def get_solver() -> Solver:
+    return Solver()
+
+
+def supports(game: game_state.GameState) -> bool:
+    return game.shape is _SHAPE
+
+
+def best_move(game: game_state.GameState) -> tuple[game_state.Move, int]:
+    if not supports(game):
+        raise ValueError("only the classic 3x3 board can be solved")
+    return get_solver().best_move(game.x_bits, game.o_bits)
@@ -0,0 +1,460 @@
+"""Durable storage for games.
+
+The in-memory games dict stays the source of truth while the server runs. A
+`LogGameStore` additionally appends every game creation, join, move and
+removal to a log. A background thread writes and fsyncs the records in
+batches, and each `record_*` call returns once its batch is durable (group
+commit): records appended while one batch is being fsynced make up the next.
+Callers that make many records at once, like batch requests, can defer the
+waiting and wait once for the last of them.
+If a write fails, the store stops accepting records and raises `StoreFailed`,
+since whatever follows a torn record would be lost on replay anyway.
+Every so often the log is rotated and all games are written to a compact
+snapshot, after which the older log segments are deleted. The snapshot is
+written on a thread of its own, since it packs each game under its game lock
+and requests hold those while waiting for their records. On startup the
+snapshot is loaded and the newer log segments replayed on top of it.
+
+Records are framed as `<length><crc32><payload>`, so a torn write at the end
+of a segment is detected and ignored on replay.
+"""
+
+from __future__ import annotations
+from typing import BinaryIO, Iterator, Optional, Protocol
+import collections
+import contextlib
+import logging
+import os
+import pathlib
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from server import game_state, locks
+
+GamesDict = dict[uuid.UUID, game_state.GameState]
+
+FRAME = struct.Struct("<II")
+# Game id, row, column and milliseconds since the game was created. Logs
+# written before move times were recorded lack the time.
+MOVE = struct.Struct("<16sBBI")
+UNTIMED_MOVE = struct.Struct("<16sBB")
+REMOVE = struct.Struct("<16s?")
+# The first log segment not covered by the snapshot, and the number of games.
+SNAPSHOT_HEADER = struct.Struct("<QQ")
+
+RECORD_CREATE = 1
+RECORD_JOIN = 2
+RECORD_MOVE = 3
+RECORD_REMOVE = 4
+
+SNAPSHOT_LIVE = 1
+SNAPSHOT_ARCHIVED = 2
+
+SNAPSHOT_FILENAME = "snapshot"
+LOG_PREFIX = "log-"
+
+logger = logging.getLogger(__name__)
+
+
+class StoreFailed(Exception):
+    """A record could not be made durable."""
+
+
+class GameArchive:
+    """Finished games that are no longer live, kept packed. When full, the
+    oldest archived games are dropped."""
+
+    def __init__(self, max_games: int) -> None:
+        self.max_games = max_games
+        self._games: collections.OrderedDict[uuid.UUID, bytes] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    def add(self, game_id: uuid.UUID, packed_game: bytes) -> None:
+        with self._lock:
+            self._games[game_id] = packed_game
+            while len(self._games) > self.max_games:
+                self._games.popitem(last=False)
+
+    def get(self, game_id: uuid.UUID) -> Optional[game_state.GameState]:
+        packed_game = self._games.get(game_id)
+        if packed_game is None:
+            return None
+        return game_state.GameState.unpack(packed_game)
+
+    def items(self) -> list[tuple[uuid.UUID, bytes]]:
+        with self._lock:
+            return list(self._games.items())
+
+
+class GameStore(Protocol):
+    def load(self, games: GamesDict, archive: GameArchive) -> None:
+        """Fills `games` and `archive` with the stored games."""
+
+    def record_create(self, game: game_state.GameState) -> None: ...
+
+    def record_join(self, game: game_state.GameState) -> None: ...
+
+    def record_move(
+        self, game: game_state.GameState, move: game_state.Move
+    ) -> None: ...
+
+    def record_remove(self, game_id: uuid.UUID, archived: bool) -> None: ...
+
+    def deferred(self) -> contextlib.AbstractContextManager[None]:
+        """Records made by this thread in the block don't wait until they are
+        durable, so that they share fsyncs. Raises `StoreFailed` only if the
+        store already failed."""
+
+    def last_record(self) -> int:
+        """The sequence number of the last record made by this thread."""
+
+    def wait_durable(self, sequence: int) -> int:
+        """Waits until the records up to `sequence` are durable, or writing
+        them failed. Returns how many records are durable."""
+
+    def close(self) -> None: ...
+
+
+class MemoryGameStore:
+    """Keeps nothing beyond the games dict itself."""
+
+    def load(self, games: GamesDict, archive: GameArchive) -> None:
+        pass
+
+    def record_create(self, game: game_state.GameState) -> None:
+        pass
+
+    def record_join(self, game: game_state.GameState) -> None:
+        pass
+
+    def record_move(self, game: game_state.GameState, move: game_state.Move) -> None:
+        pass
+
+    def record_remove(self, game_id: uuid.UUID, archived: bool) -> None:
+        pass
+
+    @contextlib.contextmanager
+    def deferred(self) -> Iterator[None]:
+        yield
+
+    def last_record(self) -> int:
+        return 0
+
+    def wait_durable(self, sequence: int) -> int:
+        return sequence
+
+    def close(self) -> None:
+        pass
+
+
+def _frame(payload: bytes) -> bytes:
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_frames(data: bytes) -> Iterator[bytes]:
+    offset = 0
+    while offset + FRAME.size <= len(data):
+        length, checksum = FRAME.unpack_from(data, offset)
+        payload = data[offset + FRAME.size : offset + FRAME.size + length]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            return
+        yield payload
+        offset += FRAME.size + length
+
+
+def apply_record(games: GamesDict, archive: GameArchive, payload: bytes) -> None:
+    """Replays a log record. Records already reflected in the snapshot, which
+    can happen for the ones written while it was taken, are skipped."""
+    kind = payload[0]
+    if kind == RECORD_CREATE:
+        game = game_state.GameState.unpack(payload[1:])
+        games.setdefault(game.game_id, game)
+    elif kind == RECORD_JOIN:
+        game_id = uuid.UUID(bytes=payload[1:17])
+        player, _ = game_state.Player.unpack_from(payload, 17)
+        joined_game = games.get(game_id)
+        if joined_game is not None and joined_game.second_player is None:
+            joined_game.second_player = player
+            joined_game.version += 1
+    elif kind == RECORD_MOVE:
+        elapsed_ms: Optional[int] = None
+        if len(payload) - 1 >= MOVE.size:
+            game_id, row, col, elapsed_ms = MOVE.unpack_from(payload, 1)
+        else:
+            game_id, row, col = UNTIMED_MOVE.unpack_from(payload, 1)
+        played_game = games.get(uuid.UUID(bytes=game_id))
+        if played_game is not None and not (
+            played_game.x_bits | played_game.o_bits
+        ) & played_game.shape.cell_bit(row, col):
+            played_game.play_turn(game_state.Move(row=row, col=col), elapsed_ms)
+    elif kind == RECORD_REMOVE:
+        game_id, archived = REMOVE.unpack_from(payload, 1)
+        removed_game = games.pop(uuid.UUID(bytes=game_id), None)
+        if removed_game is not None and archived:
+            archive.add(removed_game.game_id, removed_game.pack())
+    else:
+        raise ValueError(f"unknown log record {kind}")
+
+
+class LogGameStore:
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        flush_interval_seconds: float = 0.0,
+        snapshot_every_records: int = 100_000,
+        game_locks: Optional[locks.LockStripes] = None,
+    ) -> None:
+        self.directory = directory
+        self.flush_interval_seconds = flush_interval_seconds
+        self.snapshot_every_records = snapshot_every_records
+        # The locks games are changed under. Without them, games must not be
+        # changed while the store is open.
+        self.game_locks = locks.LockStripes(1) if game_locks is None else game_locks
+        self._games: Optional[GamesDict] = None
+        self._archive: Optional[GameArchive] = None
+        self._buffer = bytearray()
+        # Records appended so far, and how many of them are durable.
+        self._appended = 0
+        self._durable = 0
+        self._failure: Optional[BaseException] = None
+        self._condition = threading.Condition()
+        # Whether the thread defers waiting, and its last record.
+        self._local = threading.local()
+        self._closed = False
+        self._records_since_snapshot = 0
+        self._segment = 0
+        self._log: Optional[BinaryIO] = None
+        self._writer = threading.Thread(
+            target=self._write_loop, name="game-store-writer", daemon=True
+        )
+        self._snapshotter: Optional[threading.Thread] = None
+
+    def _segment_path(self, segment: int) -> pathlib.Path:
+        return self.directory / f"{LOG_PREFIX}{segment:016d}"
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(path.name[len(LOG_PREFIX) :])
+            for path in self.directory.glob(f"{LOG_PREFIX}*")
+        )
+
+    def load(self, games: GamesDict, archive: GameArchive) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        first_segment = 0
+        snapshot_path = self.directory / SNAPSHOT_FILENAME
+        if snapshot_path.exists():
+            data = snapshot_path.read_bytes()
+            first_segment, _ = SNAPSHOT_HEADER.unpack_from(data)
+            for payload in _read_frames(data[SNAPSHOT_HEADER.size :]):
+                if payload[0] == SNAPSHOT_ARCHIVED:
+                    archive.add(uuid.UUID(bytes=payload[1:17]), payload[1:])
+                else:
+                    game = game_state.GameState.unpack(payload[1:])
+                    games[game.game_id] = game
+        segments = self._segments()
+        for segment in segments:
+            if segment >= first_segment:
+                for payload in _read_frames(self._segment_path(segment).read_bytes()):
+                    apply_record(games, archive, payload)
+
+        self._games = games
+        self._archive = archive
+        self._open_segment(max([first_segment - 1, *segments]) + 1)
+        self._writer.start()
+
+    def _open_segment(self, segment: int) -> None:
+        self._segment = segment
+        self._log = open(self._segment_path(segment), "ab")
+        _fsync_directory(self.directory)
+
+    def _append(self, payload: bytes) -> None:
+        """Waits until the record is durable, unless waiting is deferred.
+        Raises `StoreFailed` if it can't be made durable."""
+        with self._condition:
+            if self._failure is not None or self._closed:
+                raise StoreFailed("game store is not accepting records")
+            self._buffer += _frame(payload)
+            self._appended += 1
+            sequence = self._appended
+            self._condition.notify_all()
+        self._local.sequence = sequence
+        if getattr(self._local, "deferred", False):
+            return
+        if self.wait_durable(sequence) < sequence:
+            raise StoreFailed("writing the game log failed") from self._failure
+
+    @contextlib.contextmanager
+    def deferred(self) -> Iterator[None]:
+        previous = getattr(self._local, "deferred", False)
+        self._local.deferred = True
+        try:
+            yield
+        finally:
+            self._local.deferred = previous
+
+    def last_record(self) -> int:
+        return getattr(self._local, "sequence", 0)
+
+    def wait_durable(self, sequence: int) -> int:
+        with self._condition:
+            while self._durable < sequence and self._failure is None:
+                self._condition.wait()
+            return self._durable
+
+    def record_create(self, game: game_state.GameState) -> None:
+        self._append(bytes([RECORD_CREATE]) + game.pack())
+
+    def record_join(self, game: game_state.GameState) -> None:
+        assert game.second_player is not None
+        self._append(
+            bytes([RECORD_JOIN]) + game.game_id.bytes + game.second_player.pack()
+        )
+
+    def record_move(self, game: game_state.GameState, move: game_state.Move) -> None:
+        self._append(
+            bytes([RECORD_MOVE])
+            + MOVE.pack(game.game_id.bytes, move.row, move.col, game.move_times[-1])
+        )
+
+    def record_remove(self, game_id: uuid.UUID, archived: bool) -> None:
+        self._append(bytes([RECORD_REMOVE]) + REMOVE.pack(game_id.bytes, archived))
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._buffer and not self._closed:
+                    self._condition.wait()
+                closed = self._closed
+            # Optionally let more records pile up so they share one fsync.
+            if not closed and self.flush_interval_seconds:
+                time.sleep(self.flush_interval_seconds)
+            with self._condition:
+                batch, self._buffer = self._buffer, bytearray()
+                sequence = self._appended
+            try:
+                self._write(batch)
+            except Exception as error:
+                logger.exception("Writing the game log failed, refusing new records")
+                with self._condition:
+                    self._failure = error
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._records_since_snapshot += sequence - self._durable
+                self._durable = sequence
+                self._condition.notify_all()
+            if (
+                self._records_since_snapshot >= self.snapshot_every_records
+                and not closed
+                and (self._snapshotter is None or not self._snapshotter.is_alive())
+            ):
+                # The records are already durable in the log, so a failed
+                # snapshot is only retried later.
+                try:
+                    self._rotate()
+                except Exception:
+                    logger.exception("Rotating the game log failed")
+                else:
+                    self._snapshotter = threading.Thread(
+                        target=self._write_snapshot_logged,
+                        args=(self._segment,),
+                        name="game-store-snapshot",
+                        daemon=True,
+                    )
+                    self._snapshotter.start()
+            if closed:
+                return
+
+    def _write(self, batch: bytearray) -> None:
+        assert self._log is not None
+        if not batch:
+            return
+        self._log.write(batch)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def snapshot(self) -> None:
+        """Rotates the log, writes every game to a new snapshot and deletes
+        the log segments it covers. Only called when the writer thread isn't
+        running."""
+        self._write_snapshot(self._rotate())
+
+    def _rotate(self) -> int:
+        """Starts a new log segment, and returns it. Records appended from
+        now on go to it, so a snapshot taken afterwards contains at least
+        everything in the older ones. Only called from the writer thread, or
+        when it isn't running."""
+        assert self._log is not None
+        self._log.close()
+        self._open_segment(self._segment + 1)
+        self._records_since_snapshot = 0
+        return self._segment
+
+    def _write_snapshot(self, first_segment: int) -> None:
+        assert self._games is not None and self._archive is not None
+        # The copy is made without releasing the GIL, so games added meanwhile
+        # can't break it off.
+        games = self._games.copy()
+        archived_games = self._archive.items()
+        temporary_path = self.directory / (SNAPSHOT_FILENAME + ".tmp")
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(
+                SNAPSHOT_HEADER.pack(first_segment, len(games) + len(archived_games))
+            )
+            for game_id, game in games.items():
+                # A move changes several fields, which have to be packed
+                # together.
+                with self.game_locks.for_game(game_id):
+                    packed_game = game.pack()
+                snapshot_file.write(_frame(bytes([SNAPSHOT_LIVE]) + packed_game))
+            for _, packed_game in archived_games:
+                snapshot_file.write(_frame(bytes([SNAPSHOT_ARCHIVED]) + packed_game))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.directory / SNAPSHOT_FILENAME)
+        _fsync_directory(self.directory)
+        for segment in self._segments():
+            if segment < first_segment:
+                self._segment_path(segment).unlink()
+
+    def _write_snapshot_logged(self, first_segment: int) -> None:
+        try:
+            self._write_snapshot(first_segment)
+        except Exception:
+            logger.exception("Taking a game snapshot failed")
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._writer.is_alive():
+            self._writer.join()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def store_from_env(game_locks: locks.LockStripes) -> GameStore:
+    """A `LogGameStore` in `T3_DATA_DIR` if it is set."""
+    directory = os.environ.get("T3_DATA_DIR")
+    if directory is None:
+        return MemoryGameStore()
+    return LogGameStore(pathlib.Path(directory), game_locks=game_locks)
+
+
+def _fsync_directory(directory: pathlib.Path) -> None:
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
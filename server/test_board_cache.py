@@ -0,0 +1,40 @@
+from server import board_cache
+from server.game_state import Symbol
+
+BOARD = [
+    [Symbol.X, Symbol.O, Symbol.EMPTY],
+    [Symbol.X, Symbol.O, Symbol.EMPTY],
+    [Symbol.X, Symbol.EMPTY, Symbol.EMPTY],
+]
+
+
+def test_hit_and_miss() -> None:
+    cache = board_cache.BoardCache(max_entries=10, max_bytes=10_000)
+    key = cache.key(b"image", 3)
+    assert cache.get(key) is None
+    cache.put(key, BOARD)
+    assert cache.get(key) == BOARD
+    assert cache.get(cache.key(b"image", 4)) is None
+    assert cache.stats == board_cache.CacheStats(hits=1, misses=2, evictions=0)
+
+
+def test_evicts_least_recently_used() -> None:
+    cache = board_cache.BoardCache(max_entries=2, max_bytes=10_000)
+    first, second, third = (cache.key(data, 3) for data in [b"1", b"2", b"3"])
+    cache.put(first, BOARD)
+    cache.put(second, BOARD)
+    assert cache.get(first) == BOARD
+    cache.put(third, BOARD)
+    assert cache.get(second) is None
+    assert cache.get(first) == BOARD
+    assert cache.stats.evictions == 1
+
+
+def test_memory_cap() -> None:
+    entry_bytes = board_cache.DIGEST_SIZE + 1 + 9 + board_cache.ENTRY_OVERHEAD_BYTES
+    cache = board_cache.BoardCache(max_entries=100, max_bytes=3 * entry_bytes)
+    for data in range(10):
+        cache.put(cache.key(bytes([data]), 3), BOARD)
+    assert len(cache) == 3
+    assert cache.memory_bytes <= 3 * entry_bytes
+    assert cache.stats.evictions == 7
@@ -0,0 +1,189 @@
+import json
+import pathlib
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from typing import AsyncIterator, Callable, Iterator
+import httpx
+import pytest
+from fastapi import testclient
+
+from server import affinity, dispatcher
+
+
+def test_new_game_ids_are_owned() -> None:
+    slot = affinity.WorkerSlot(index=2, count=3)
+    for _ in range(20):
+        assert affinity.owner(slot.new_game_id(), 3) == 2
+
+
+def test_worker_for(tmp_path: pathlib.Path) -> None:
+    game_dispatcher = dispatcher.Dispatcher(tmp_path, worker_count=3)
+    game_id = affinity.WorkerSlot(index=1, count=3).new_game_id()
+    assert game_dispatcher.worker_for(f"/{game_id}") == 1
+    assert game_dispatcher.worker_for(f"/{game_id}/play_turn") == 1
+    assert [game_dispatcher.worker_for("/new_game") for _ in range(4)] == [0, 1, 2, 0]
+    assert [game_dispatcher.worker_for("/matchmake") for _ in range(2)] == [0, 0]
+
+
+@pytest.fixture(scope="module")
+def url() -> Iterator[str]:
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        port = free_socket.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "server.dispatcher",
+            "--workers=2",
+            "--dispatchers=1",
+            f"--port={port}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            httpx.get(f"{url}/{uuid.uuid4()}")
+            break
+        except httpx.TransportError:
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+    yield url
+    process.terminate()
+    process.wait()
+
+
+def test_games_on_several_workers(url: str) -> None:
+    with httpx.Client(base_url=url) as client:
+        game_ids = set()
+        for _ in range(4):
+            game = client.post("/new_game", json={"player_name": "player1"}).json()
+            game_ids.add(affinity.owner(uuid.UUID(game["game_id"]), 2))
+            response = client.post(
+                f"/{game['game_id']}/join", json={"player_name": "player2"}
+            )
+            assert response.status_code == 200
+            response = client.get(f"/{game['game_id']}")
+            assert response.json()["second_player_name"] == "player2"
+        assert game_ids == {0, 1}
+
+
+def test_batches_are_split_by_worker(url: str) -> None:
+    with httpx.Client(base_url=url) as client:
+        response = client.post(
+            "/batch/new_game",
+            json={"items": [{"player_name": "player1"} for _ in range(8)]},
+        )
+        game_ids = [result["body"]["game_id"] for result in response.json()["results"]]
+        # The whole batch goes to one worker.
+        assert len({affinity.owner(uuid.UUID(game_id), 2) for game_id in game_ids}) == 1
+        game_ids += [
+            client.post("/new_game", json={"player_name": "player1"}).json()["game_id"]
+        ]
+
+        response = client.post(
+            "/batch/join",
+            json={
+                "items": [
+                    {"game_id": game_id, "player_name": "player2"}
+                    for game_id in game_ids
+                ]
+                + [{"player_name": "player2"}]
+            },
+        )
+        results = response.json()["results"]
+        assert [result["status_code"] for result in results] == [200] * 9 + [422]
+        assert [result["body"]["game_id"] for result in results[:-1]] == game_ids
+
+
+def test_export_from_all_workers(url: str) -> None:
+    with httpx.Client(base_url=url) as client:
+        game_ids = {
+            client.post("/new_game", json={"player_name": "player1"}).json()["game_id"]
+            for _ in range(4)
+        }
+        response = client.get("/export")
+        exported = {json.loads(line)["game_id"] for line in response.text.splitlines()}
+        assert game_ids <= exported
+
+
+def test_metrics_are_merged(url: str) -> None:
+    body = httpx.get(f"{url}/metrics").text
+    assert body.count("# TYPE t3_games gauge") == 1
+    assert 't3_games{worker="0"}' in body and 't3_games{worker="1"}' in body
+
+
+def mock_workers(
+    tmp_path: pathlib.Path, handlers: list[Callable[[httpx.Request], httpx.Response]]
+) -> dispatcher.Dispatcher:
+    workers = dispatcher.Dispatcher(tmp_path, worker_count=len(handlers))
+    workers.clients = [
+        httpx.AsyncClient(
+            transport=httpx.MockTransport(handler), base_url="http://worker"
+        )
+        for handler in handlers
+    ]
+    return workers
+
+
+class Body(httpx.AsyncByteStream):
+    """A streamed body, like a worker's, that can break off."""
+
+    def __init__(self, content: bytes, broken: bool = False) -> None:
+        self.content = content
+        self.broken = broken
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self.content
+        if self.broken:
+            raise httpx.RemoteProtocolError("worker went away")
+
+
+def answer(
+    status_code: int, content: bytes, broken: bool = False
+) -> Callable[[httpx.Request], httpx.Response]:
+    return lambda request: httpx.Response(status_code, stream=Body(content, broken))
+
+
+def test_export_fails_when_any_worker_fails(tmp_path: pathlib.Path) -> None:
+    app = dispatcher.app
+    app.state.dispatcher = mock_workers(
+        tmp_path, [answer(200, b"a\n"), answer(200, b"b\n")]
+    )
+    response = testclient.TestClient(app).get("/export")
+    assert (response.status_code, response.text) == (200, "a\nb\n")
+
+    app.state.dispatcher = mock_workers(
+        tmp_path, [answer(200, b"a\n"), answer(500, b"failed")]
+    )
+    response = testclient.TestClient(app).get("/export")
+    assert (response.status_code, response.text) == (500, "failed")
+
+
+def test_export_aborts_when_a_worker_fails_mid_stream(tmp_path: pathlib.Path) -> None:
+    app = dispatcher.app
+    app.state.dispatcher = mock_workers(
+        tmp_path, [answer(200, b"a\n"), answer(200, b"b\n", broken=True)]
+    )
+    with pytest.raises(httpx.RemoteProtocolError):
+        testclient.TestClient(app).get("/export")
+
+
+def test_metrics_from_all_workers(tmp_path: pathlib.Path) -> None:
+    app = dispatcher.app
+    app.state.dispatcher = mock_workers(
+        tmp_path,
+        [answer(200, b"# TYPE t3_x counter\nt3_x 1\n"), answer(200, b"t3_x 2\n")],
+    )
+    response = testclient.TestClient(app).get("/metrics")
+    assert response.text.splitlines() == [
+        "# TYPE t3_x counter",
+        't3_x{worker="0"} 1',
+        't3_x{worker="1"} 2',
+    ]
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import uuid
+
+from server import events
+
+
+async def read_all(game_events: events.GameEvents, game_id: uuid.UUID) -> list[bytes]:
+    subscription = game_events.subscribe(game_id)
+    return [event async for event in game_events.stream(subscription)]
+
+
+def test_fan_out_from_another_thread() -> None:
+    game_events = events.GameEvents(queue_size=4, keepalive_seconds=10)
+    game_id = uuid.uuid4()
+
+    async def main() -> list[list[bytes]]:
+        readers = [
+            asyncio.create_task(read_all(game_events, game_id)) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+
+        def publish() -> None:
+            game_events.publish(game_id, b"a")
+            game_events.publish(game_id, b"b", final=True)
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        publisher.join()
+        return await asyncio.gather(*readers)
+
+    assert asyncio.run(main()) == [[b"a", b"b"]] * 3
+    assert game_events.subscribers(game_id) == 0
+
+
+def test_slow_subscriber_is_dropped() -> None:
+    game_events = events.GameEvents(queue_size=2, keepalive_seconds=10)
+    game_id = uuid.uuid4()
+
+    async def main() -> list[bytes]:
+        subscription = game_events.subscribe(game_id)
+        for event in [b"a", b"b", b"c", b"d"]:
+            game_events.publish(game_id, event)
+        await asyncio.sleep(0)
+        assert game_events.subscribers(game_id) == 0
+        return [event async for event in game_events.stream(subscription)]
+
+    assert asyncio.run(main()) == [b"a", b"b"]
+
+
+def test_keepalive() -> None:
+    game_events = events.GameEvents(queue_size=2, keepalive_seconds=0.01)
+    game_id = uuid.uuid4()
+
+    async def main() -> bytes:
+        stream = game_events.stream(game_events.subscribe(game_id))
+        return await stream.__anext__()
+
+    assert asyncio.run(main()) == events.KEEPALIVE
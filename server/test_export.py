@@ -0,0 +1,38 @@
+import io
+import json
+import uuid
+
+from server import export, game_state
+
+
+def played_game() -> game_state.GameState:
+    game = game_state.GameState(uuid.uuid4(), "player1")
+    game.add_second_player("plåyer2")
+    for row, col in [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]:
+        game.play_turn(game_state.Move(row=row, col=col))
+    return game
+
+
+def test_binary_matches_ndjson() -> None:
+    games = [
+        (played_game(), True),
+        (game_state.GameState(uuid.uuid4(), "player1"), False),
+    ]
+    ndjson = b"".join(export.encode_ndjson(game, archived) for game, archived in games)
+    binary = b"".join(export.encode_binary(game, archived) for game, archived in games)
+    exported = [json.loads(line) for line in ndjson.splitlines()]
+    assert list(export.read_binary(io.BytesIO(binary))) == exported
+
+    won, waiting = exported
+    assert won["moves"] == [[0, 0], [1, 0], [0, 1], [1, 1], [0, 2]]
+    assert len(won["move_times_ms"]) == 5
+    assert won["status"] == "won" and won["archived"]
+    assert won["winner"] == (
+        "first_player" if won["first_player_starts"] else "second_player"
+    )
+    assert (waiting["status"], waiting["second_player_name"]) == ("waiting", None)
+
+
+def test_chunked() -> None:
+    records = [b"a" * 3] * 5
+    assert list(export.chunked(records, chunk_bytes=7)) == [b"a" * 9, b"a" * 6]
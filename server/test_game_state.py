@@ -36,3 +36,82 @@ def test_random_play_doesnt_win(game: game_state.GameState) -> None:
     ]
     winner = game.play_turn(game_state.Move(row=1, col=1))
     assert winner is None
+
+
+def test_play_occupied_cell(game: game_state.GameState) -> None:
+    game.play_turn(game_state.Move(row=0, col=0))
+    with pytest.raises(game_state.InvalidTurn):
+        game.play_turn(game_state.Move(row=0, col=0))
+
+
+def test_diagonal_win(game: game_state.GameState) -> None:
+    game.game_state = [
+        [game_state.Symbol.EMPTY, game_state.Symbol.O, game_state.Symbol.X],
+        [game_state.Symbol.O, game_state.Symbol.X, game_state.Symbol.EMPTY],
+        [game_state.Symbol.EMPTY, game_state.Symbol.EMPTY, game_state.Symbol.EMPTY],
+    ]
+    winner = game.play_turn(game_state.Move(row=2, col=0))
+    assert winner == game.first_player
+
+
+def test_move_difference(game: game_state.GameState) -> None:
+    game.play_turn(game_state.Move(row=1, col=1))
+    board = game.game_state
+    assert game.get_move_difference(board) is None
+
+    board[2][1] = game_state.Symbol.O
+    assert game.get_move_difference(board) == game_state.Move(row=2, col=1)
+
+    board[0][0] = game_state.Symbol.X
+    with pytest.raises(game_state.InvalidGameStateRequested):
+        game.get_move_difference(board)
+
+
+@pytest.fixture
+def large_game() -> game_state.GameState:
+    game = game_state.GameState(
+        game_id=uuid.uuid4(),
+        first_player_name="player1",
+        shape=game_state.get_board_shape(15, 5),
+    )
+    game.first_player_starts = True
+    game.current_turn_first_player = True
+    return game
+
+
+def test_large_board_win(large_game: game_state.GameState) -> None:
+    # X builds an anti-diagonal out of order while O plays along the top row.
+    for x_col, o_col in [(7, 0), (9, 1), (5, 2), (8, 3)]:
+        assert large_game.play_turn(game_state.Move(row=14 - x_col, col=x_col)) is None
+        assert large_game.play_turn(game_state.Move(row=0, col=o_col)) is None
+    winner = large_game.play_turn(game_state.Move(row=8, col=6))
+    assert winner == large_game.first_player
+
+
+def test_large_board_run_needs_win_length(large_game: game_state.GameState) -> None:
+    for x_col, o_col in [(0, 14), (1, 13), (2, 12), (3, 11)]:
+        assert large_game.play_turn(game_state.Move(row=7, col=x_col)) is None
+        assert large_game.play_turn(game_state.Move(row=7, col=o_col)) is None
+    assert large_game.play_turn(game_state.Move(row=6, col=4)) is None
+
+
+def test_large_board_out_of_bounds(large_game: game_state.GameState) -> None:
+    with pytest.raises(game_state.InvalidTurn):
+        large_game.play_turn(game_state.Move(row=15, col=0))
+
+
+def test_large_board_set_state(large_game: game_state.GameState) -> None:
+    board = large_game.game_state
+    for col in range(4):
+        board[3][col] = game_state.Symbol.X
+    large_game.game_state = board
+    assert (
+        large_game.play_turn(game_state.Move(row=3, col=4)) == large_game.first_player
+    )
+
+
+def test_version(game: game_state.GameState) -> None:
+    game.add_second_player("player2")
+    game.play_turn(game_state.Move(row=0, col=0))
+    assert game.version == 2
+    assert game_state.GameState.unpack(game.pack()).version == 2
@@ -1,4 +1,19 @@
-from server.image_processing import get_board_from_file
+import io
+
+from PIL import Image, ImageDraw
+import numpy as np
+import pytest
+
+from server import image_processing, ocr_pool
+from server.image_processing import (
+    CellClassification,
+    FallbackClassifier,
+    Grid,
+    Pixels,
+    ShapeClassifier,
+    find_grid,
+    get_board_from_file,
+)
 from server.game_state import Symbol
 
 
@@ -19,4 +34,93 @@ def test_hand_drawn() -> None:
         [Symbol.X, Symbol.O, Symbol.EMPTY],
         [Symbol.X, Symbol.O, Symbol.EMPTY],
         [Symbol.X, Symbol.EMPTY, Symbol.EMPTY],
-    ]
\ No newline at end of file
+    ]
+
+
+class ExplodingClassifier:
+    def classify(self, cell: Pixels) -> CellClassification:
+        raise AssertionError("the fallback shouldn't be needed")
+
+
+def test_shape_classifier_is_confident() -> None:
+    classifier = FallbackClassifier(ShapeClassifier(), ExplodingClassifier())
+    with open("hand_drawn.jpg", "rb") as image_file:
+        board = get_board_from_file(image_file, classifier=classifier)
+    assert board == [
+        [Symbol.X, Symbol.O, Symbol.EMPTY],
+        [Symbol.X, Symbol.O, Symbol.EMPTY],
+        [Symbol.X, Symbol.EMPTY, Symbol.EMPTY],
+    ]
+
+
+def test_pixel_budget(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(image_processing, "MAX_IMAGE_PIXELS", 1000 * 1000)
+    with open("hand_drawn.jpg", "rb") as image_file:
+        with pytest.raises(ocr_pool.ImageTooLarge):
+            get_board_from_file(image_file)
+
+
+@pytest.mark.parametrize("image", ["tic-tac-toe-example.png", "hand_drawn.jpg"])
+def test_truncated_image(image: str) -> None:
+    with open(image, "rb") as image_file:
+        data = image_file.read()
+    with pytest.raises(ocr_pool.UnreadableImage):
+        get_board_from_file(io.BytesIO(data[: len(data) // 2]))
+
+
+class CountingClassifier:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def classify(self, cell: Pixels) -> CellClassification:
+        self.calls += 1
+        return ShapeClassifier().classify(cell)
+
+
+def test_empty_cells_skip_the_classifier() -> None:
+    classifier = CountingClassifier()
+    with open("tic-tac-toe-example.png", "rb") as image_file:
+        board = get_board_from_file(image_file, classifier=classifier)
+    assert sum(symbol != Symbol.EMPTY for row in board for symbol in row) == 5
+    assert classifier.calls == 5
+
+
+def grid_image(cell: int, margin: int, frame: bool) -> Image.Image:
+    """An empty 3x3 grid with a blank margin around it, and an X in the
+    middle."""
+    side = 3 * cell + 2 * margin
+    image = Image.new("L", (side, side), 255)
+    draw = ImageDraw.Draw(image)
+    for line in range(0 if frame else 1, 4 if frame else 3):
+        offset = margin + line * cell
+        draw.line([(offset, margin), (offset, side - margin)], fill=0, width=3)
+        draw.line([(margin, offset), (side - margin, offset)], fill=0, width=3)
+    low, high = margin + cell + cell // 4, margin + 2 * cell - cell // 4
+    draw.line([(low, low), (high, high)], fill=0, width=6)
+    draw.line([(low, high), (high, low)], fill=0, width=6)
+    return image
+
+
+@pytest.mark.parametrize("frame", [False, True])
+def test_find_grid(frame: bool) -> None:
+    pixels: Pixels = np.asarray(grid_image(cell=80, margin=60, frame=frame))
+    grid = find_grid(pixels)
+    for bounds in [grid.rows, grid.cols]:
+        assert bounds == pytest.approx([60, 140, 220, 300], abs=2)
+
+
+def test_find_grid_falls_back_to_an_even_split() -> None:
+    pixels: Pixels = np.full((300, 300), 255, dtype=np.uint8)
+    assert find_grid(pixels) == Grid((0, 100, 200, 300), (0, 100, 200, 300))
+
+
+def test_board_inside_a_margin() -> None:
+    output = io.BytesIO()
+    grid_image(cell=80, margin=60, frame=False).save(output, "PNG")
+    output.seek(0)
+    board = get_board_from_file(output, classifier=ShapeClassifier())
+    assert board == [
+        [Symbol.EMPTY, Symbol.EMPTY, Symbol.EMPTY],
+        [Symbol.EMPTY, Symbol.X, Symbol.EMPTY],
+        [Symbol.EMPTY, Symbol.EMPTY, Symbol.EMPTY],
+    ]
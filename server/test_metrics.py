@@ -0,0 +1,79 @@
+import pathlib
+from fastapi import testclient
+
+from server import image_processing, metrics, server_main
+
+EXAMPLE_IMAGE = pathlib.Path(__file__).parent.parent / "tic-tac-toe-example.png"
+
+
+def test_histogram_buckets() -> None:
+    family = metrics.HistogramFamily("t3_test_seconds", "Test.", ("stage",), (1, 2))
+    histogram = family.labels("a")
+    assert family.labels("a") is histogram
+    for value in [0.5, 1, 1.5, 3]:
+        histogram.observe(value)
+    assert list(family.render()) == [
+        "# HELP t3_test_seconds Test.",
+        "# TYPE t3_test_seconds histogram",
+        't3_test_seconds_bucket{stage="a",le="1"} 2',
+        't3_test_seconds_bucket{stage="a",le="2"} 3',
+        't3_test_seconds_bucket{stage="a",le="+Inf"} 4',
+        't3_test_seconds_sum{stage="a"} 6.0',
+        't3_test_seconds_count{stage="a"} 4',
+    ]
+
+
+def test_requests_by_route() -> None:
+    client = testclient.TestClient(server_main.app)
+    game = client.post("/new_game", json={"player_name": "player1"}).json()
+    histogram = metrics.REQUEST_SECONDS.labels("/{game_id}", "200")
+    count = histogram.count
+    client.get(f"/{game['game_id']}")
+    client.get(f"/{game['game_id']}")
+    assert histogram.count == count + 2
+
+    body = client.get("/metrics").text
+    assert (
+        't3_http_request_duration_seconds_count{route="/{game_id}",status="200"}'
+        in (body)
+    )
+    assert 't3_games_by_status{status="waiting"}' in body
+    assert 't3_image_stage_duration_seconds_count{stage="tesseract"}' in body
+
+
+def test_image_stages() -> None:
+    histogram = metrics.IMAGE_STAGE_SECONDS.labels(metrics.STAGE_PREPROCESS)
+    count = histogram.count
+    with EXAMPLE_IMAGE.open("rb") as image:
+        image_processing.get_board_from_file(
+            image, classifier=image_processing.CLASSIFIERS["shape"]
+        )
+    assert histogram.count == count + 1
+
+    with metrics.collect_stages() as stages, EXAMPLE_IMAGE.open("rb") as image:
+        image_processing.get_board_from_file(
+            image, classifier=image_processing.CLASSIFIERS["shape"]
+        )
+    assert histogram.count == count + 1
+    assert [stage for stage, _ in stages] == [
+        metrics.STAGE_PREPROCESS,
+        metrics.STAGE_CROP,
+        metrics.STAGE_CLASSIFY,
+        metrics.STAGE_BOARD,
+    ]
+
+
+def test_merge() -> None:
+    scrape = metrics.render([metrics.Sample("t3_test", "Test.", "gauge", {"": 1})])
+    merged = metrics.merge([scrape, scrape]).decode().splitlines()
+    assert merged.count("# TYPE t3_test gauge") == 1
+    assert merged[-2:] == ['t3_test{worker="0"} 1', 't3_test{worker="1"} 1']
+    # Both workers' samples of a family follow its one TYPE line.
+    start = merged.index("# TYPE t3_image_stage_duration_seconds histogram")
+    end = merged.index("# HELP t3_test Test.")
+    stage_lines = merged[start + 1 : end]
+    for worker in ["0", "1"]:
+        assert (
+            f't3_image_stage_duration_seconds_count{{worker="{worker}",stage="crop"}}'
+            in " ".join(stage_lines)
+        )
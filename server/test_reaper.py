@@ -0,0 +1,179 @@
+from typing import Iterator
+import asyncio
+import uuid
+import pytest
+from fastapi import testclient
+
+from server import dependencies, game_state, locks, reaper, server_main, storage
+
+
+def new_game(
+    games: storage.GamesDict, last_touched: float, joined: bool = True
+) -> game_state.GameState:
+    game = game_state.GameState(uuid.uuid4(), "player1")
+    if joined:
+        game.add_second_player("player2")
+    game.last_touched = last_touched
+    games[game.game_id] = game
+    return game
+
+
+def finish(game: game_state.GameState) -> None:
+    for row, col in [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]:
+        game.play_turn(game_state.Move(row=row, col=col))
+
+
+@pytest.fixture
+def archive() -> storage.GameArchive:
+    return storage.GameArchive(10)
+
+
+@pytest.fixture
+def game_locks() -> locks.LockStripes:
+    return locks.LockStripes(4)
+
+
+def test_reap(archive: storage.GameArchive, game_locks: locks.LockStripes) -> None:
+    settings = reaper.ReaperSettings(
+        idle_ttl_seconds=100, unjoined_ttl_seconds=50, finished_ttl_seconds=10
+    )
+    games: storage.GamesDict = {}
+    active = new_game(games, last_touched=90)
+    finished = new_game(games, last_touched=80)
+    finish(finished)
+    unjoined = new_game(games, last_touched=40, joined=False)
+    idle = new_game(games, last_touched=0)
+
+    stats = reaper.reap(
+        games, archive, storage.MemoryGameStore(), game_locks, settings, now=100
+    )
+
+    assert stats == reaper.ReapStats(archived=1, removed=2)
+    assert games.keys() == {active.game_id}
+    archived_game = archive.get(finished.game_id)
+    assert archived_game is not None
+    assert archived_game.winner == finished.winner
+    assert archive.get(unjoined.game_id) is None
+    assert archive.get(idle.game_id) is None
+
+
+def test_enforce_cap_removes_least_recently_touched(
+    archive: storage.GameArchive, game_locks: locks.LockStripes
+) -> None:
+    settings = reaper.ReaperSettings(max_live_games=10)
+    games: storage.GamesDict = {}
+    for last_touched in range(12):
+        new_game(games, last_touched=last_touched)
+
+    reaper.enforce_cap(games, archive, storage.MemoryGameStore(), game_locks, settings)
+
+    assert sorted(game.last_touched for game in games.values()) == list(range(3, 12))
+
+
+class CountingStore(storage.MemoryGameStore):
+    def __init__(self) -> None:
+        self.removals = 0
+        self.waits = 0
+
+    def record_remove(self, game_id: uuid.UUID, archived: bool) -> None:
+        self.removals += 1
+
+    def last_record(self) -> int:
+        return self.removals
+
+    def wait_durable(self, sequence: int) -> int:
+        self.waits += 1
+        return sequence
+
+
+def test_removals_are_waited_for_once(
+    archive: storage.GameArchive, game_locks: locks.LockStripes
+) -> None:
+    games: storage.GamesDict = {}
+    for last_touched in range(30):
+        new_game(games, last_touched=last_touched)
+    store = CountingStore()
+
+    reaper.enforce_cap(
+        games, archive, store, game_locks, reaper.ReaperSettings(max_live_games=20)
+    )
+
+    assert (store.removals, store.waits) == (12, 1)
+
+
+def test_run_keeps_reaping_after_a_failure(
+    monkeypatch: pytest.MonkeyPatch,
+    archive: storage.GameArchive,
+    game_locks: locks.LockStripes,
+) -> None:
+    passes = []
+
+    def failing_reap(*args: object) -> None:
+        passes.append(args)
+        if len(passes) == 1:
+            raise storage.StoreFailed
+
+    monkeypatch.setattr(reaper, "reap", failing_reap)
+
+    async def reap_twice() -> None:
+        task = asyncio.create_task(
+            reaper.run(
+                {},
+                archive,
+                storage.MemoryGameStore(),
+                game_locks,
+                reaper.ReaperSettings(interval_seconds=0),
+            )
+        )
+        while len(passes) < 2:
+            assert not task.done()
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(reap_twice(), 10))
+
+
+def test_archive_drops_oldest() -> None:
+    archive = storage.GameArchive(2)
+    games: storage.GamesDict = {}
+    finished_games = [new_game(games, last_touched=0) for _ in range(3)]
+    for game in finished_games:
+        finish(game)
+        archive.add(game.game_id, game.pack())
+    assert len(archive) == 2
+    assert archive.get(finished_games[0].game_id) is None
+
+
+@pytest.fixture
+def served_games(
+    archive: storage.GameArchive,
+) -> Iterator[storage.GamesDict]:
+    """Live games and `archive` for the server, until the test is done."""
+    games: storage.GamesDict = {}
+    overrides = server_main.app.dependency_overrides
+    overrides[dependencies.get_active_games] = lambda: games
+    overrides[dependencies.get_game_archive] = lambda: archive
+    yield games
+    del overrides[dependencies.get_active_games]
+    del overrides[dependencies.get_game_archive]
+
+
+def test_get_archived_game(
+    archive: storage.GameArchive,
+    game_locks: locks.LockStripes,
+    served_games: storage.GamesDict,
+) -> None:
+    game = new_game(served_games, last_touched=0)
+    finish(game)
+    reaper.reap(
+        served_games,
+        archive,
+        storage.MemoryGameStore(),
+        game_locks,
+        reaper.ReaperSettings(),
+    )
+
+    response = testclient.TestClient(server_main.app).get(f"/{game.game_id}")
+
+    assert response.status_code == 200
+    assert response.json()["game_state"][0] == ["X", "X", "X"]
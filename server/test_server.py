@@ -1,9 +1,28 @@
+from typing import Any, Iterator
+import asyncio
+import concurrent.futures
+import io
+import json
+import struct
+import subprocess
+import sys
+import threading
+import time
 import uuid
 import httpx
 import pytest
 from fastapi import testclient
 
-from server import dependencies, server_main, game_state
+from server import (
+    board_cache,
+    dependencies,
+    export,
+    game_state,
+    matchmaking,
+    ocr_pool,
+    server_main,
+    storage,
+)
 
 
 @pytest.fixture
@@ -95,3 +114,518 @@ def test_whole_game(test_client: testclient.TestClient) -> None:
             files={"image_file": image_file},
         )
     assert response.json()["winner"] == ("player1" if first_player_first else "player2")
+
+
+def test_large_board(test_client: testclient.TestClient) -> None:
+    response = test_client.post(
+        "/new_game", json={"player_name": "player1", "board_size": 15, "win_length": 5}
+    )
+    assert response.status_code == 200
+    game_id = response.json()["game_id"]
+
+    response = test_client.get(f"/{game_id}")
+    assert response.status_code == 200
+    assert len(response.json()["game_state"]) == 15
+    assert response.json()["win_length"] == 5
+
+
+def test_win_length_larger_than_board(test_client: testclient.TestClient) -> None:
+    response = test_client.post(
+        "/new_game", json={"player_name": "player1", "board_size": 4, "win_length": 5}
+    )
+    assert response.status_code == 400
+
+
+def test_best_move(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    response = test_client.get(f"/{game.game_id}/best_move")
+    assert response.status_code == 200
+    assert response.json()["score"] == 0
+
+
+def test_play_against_server(test_client: testclient.TestClient) -> None:
+    response = test_client.post(
+        "/new_game", json={"player_name": "player1", "against_server": True}
+    )
+    assert response.status_code == 200
+    game_id = response.json()["game_id"]
+    player_token = response.json()["player_token"]
+
+    response = test_client.post(f"/{game_id}/join", json={"player_name": "player2"})
+    assert response.status_code == 400
+
+    result = None
+    while result is None or "result" not in result:
+        response = test_client.get(f"/{game_id}/best_move")
+        assert response.status_code == 200
+        response = test_client.post(
+            f"/{game_id}/play_turn",
+            json={"row": response.json()["row"], "column": response.json()["column"]},
+            headers={"x-player-token": player_token},
+        )
+        assert response.status_code == 200
+        result = response.json()
+    assert result["result"] == "draw"
+
+
+class FailingStore(storage.MemoryGameStore):
+    def record_create(self, game: game_state.GameState) -> None:
+        raise storage.StoreFailed
+
+
+def test_unsaved_game_is_not_acknowledged(test_client: testclient.TestClient) -> None:
+    server_main.app.dependency_overrides[dependencies.get_game_store] = FailingStore
+    try:
+        response = test_client.post("/new_game", json={"player_name": "player1"})
+    finally:
+        del server_main.app.dependency_overrides[dependencies.get_game_store]
+    assert response.status_code == 503
+
+
+class PartlyDurableStore(storage.MemoryGameStore):
+    """Only the first two records become durable, and the fourth fails."""
+
+    def __init__(self) -> None:
+        self.records = 0
+
+    def record_create(self, game: game_state.GameState) -> None:
+        if self.records == 3:
+            raise storage.StoreFailed
+        self.records += 1
+
+    def last_record(self) -> int:
+        return self.records
+
+    def wait_durable(self, sequence: int) -> int:
+        return min(sequence, 2)
+
+
+def test_unsaved_batch_items_are_not_acknowledged(
+    test_client: testclient.TestClient,
+) -> None:
+    store = PartlyDurableStore()
+    server_main.app.dependency_overrides[dependencies.get_game_store] = lambda: store
+    try:
+        response = test_client.post(
+            "/batch/new_game",
+            json={"items": [{"player_name": "player1"} for _ in range(4)] + [{}]},
+        )
+    finally:
+        del server_main.app.dependency_overrides[dependencies.get_game_store]
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 200, 503, 503, 422]
+
+
+def test_image_turn_when_saturated(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    pool = ocr_pool.OcrPool(ocr_pool.OcrPoolSettings(max_pending=0))
+    cache = board_cache.BoardCache(max_entries=0, max_bytes=0)
+    server_main.app.dependency_overrides[dependencies.get_ocr_pool] = lambda: pool
+    server_main.app.dependency_overrides[dependencies.get_board_cache] = lambda: cache
+    try:
+        with open("tic-tac-toe-example.png", "rb") as image_file:
+            response = test_client.post(
+                f"/{game.game_id}/play_turn_image",
+                headers={"x-player-token": str(game.first_player.token)},
+                files={"image_file": image_file},
+            )
+    finally:
+        del server_main.app.dependency_overrides[dependencies.get_ocr_pool]
+        del server_main.app.dependency_overrides[dependencies.get_board_cache]
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+
+
+def test_image_turn_rejects_unsupported_and_oversized_images(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    with open("tic-tac-toe-example.png", "rb") as image_file:
+        png = image_file.read()
+    # Claims 100000x100000 pixels in its header.
+    bomb = png[:16] + struct.pack(">II", 100_000, 100_000) + png[24:]
+    for data, status_code in [(b"not an image", 415), (bomb, 413)]:
+        response = test_client.post(
+            f"/{game.game_id}/play_turn_image",
+            headers={"x-player-token": str(game.first_player.token)},
+            files={"image_file": data},
+        )
+        assert response.status_code == status_code
+    assert game.turns_played == 0
+
+
+def test_image_turn_checks_token_first(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    pool = ocr_pool.OcrPool(ocr_pool.OcrPoolSettings(max_pending=0))
+    server_main.app.dependency_overrides[dependencies.get_ocr_pool] = lambda: pool
+    try:
+        with open("tic-tac-toe-example.png", "rb") as image_file:
+            response = test_client.post(
+                f"/{game.game_id}/play_turn_image",
+                headers={"x-player-token": "not a token"},
+                files={"image_file": image_file},
+            )
+    finally:
+        del server_main.app.dependency_overrides[dependencies.get_ocr_pool]
+    # Not 503, as the saturated pool would answer.
+    assert response.status_code == 401
+
+
+def test_image_stack_is_loaded_lazily() -> None:
+    # In a fresh interpreter, since the other tests load it.
+    code = (
+        "import sys, server.server_main; "
+        "print(*sorted(sys.modules.keys() & "
+        "{'PIL', 'numpy', 'pytesseract', 'server.image_processing'}))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_prewarm() -> None:
+    pool = ocr_pool.OcrPool(ocr_pool.OcrPoolSettings(workers=1))
+    try:
+        pool.prewarm()
+        with open("tic-tac-toe-example.png", "rb") as image_file:
+            board = asyncio.run(pool.recognize(image_file.read()))
+    finally:
+        pool.shutdown()
+    assert board[0][0] == game_state.Symbol.X
+
+
+def test_pool_replaces_dead_workers() -> None:
+    pool = ocr_pool.OcrPool(ocr_pool.OcrPoolSettings(workers=1))
+    with open("tic-tac-toe-example.png", "rb") as image_file:
+        data = image_file.read()
+    try:
+        asyncio.run(pool.recognize(data))
+        executor = pool._executor
+        assert executor is not None
+        for process in list(executor._processes.values()):
+            process.kill()
+        with pytest.raises(ocr_pool.WorkerCrashed):
+            asyncio.run(pool.recognize(data))
+        board = asyncio.run(pool.recognize(data))
+    finally:
+        pool.shutdown()
+    assert board[0][0] == game_state.Symbol.X
+
+
+def test_image_turn_rejects_corrupt_images(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    with open("tic-tac-toe-example.png", "rb") as image_file:
+        png = image_file.read()
+    response = test_client.post(
+        f"/{game.game_id}/play_turn_image",
+        headers={"x-player-token": str(game.first_player.token)},
+        files={"image_file": png[: len(png) // 2]},
+    )
+    assert response.status_code == 400
+    assert game.turns_played == 0
+
+
+def test_repeated_image_turn_hits_the_cache(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    cache = board_cache.BoardCache(max_entries=10, max_bytes=10_000)
+    server_main.app.dependency_overrides[dependencies.get_board_cache] = lambda: cache
+    try:
+        for _ in range(2):
+            with open("tic-tac-toe-example.png", "rb") as image_file:
+                test_client.post(
+                    f"/{game.game_id}/play_turn_image",
+                    headers={"x-player-token": str(game.first_player.token)},
+                    files={"image_file": image_file},
+                )
+    finally:
+        del server_main.app.dependency_overrides[dependencies.get_board_cache]
+    assert cache.stats == board_cache.CacheStats(hits=1, misses=1, evictions=0)
+
+
+def test_play_turn_if_match(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    game.add_second_player("player2")
+    etag = test_client.get(f"/{game.game_id}").headers["etag"]
+    assert etag == '"1"'
+
+    response = test_client.post(
+        f"/{game.game_id}/play_turn",
+        json={"row": 0, "column": 0},
+        headers={"x-player-token": str(game.first_player.token), "if-match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"2"'
+
+    assert game.second_player is not None
+    response = test_client.post(
+        f"/{game.game_id}/play_turn",
+        json={"row": 1, "column": 1},
+        headers={"x-player-token": str(game.second_player.token), "if-match": etag},
+    )
+    assert response.status_code == 412
+    assert response.headers["etag"] == '"2"'
+    assert game.turns_played == 1
+
+
+def test_concurrent_turns_for_one_player(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    game.add_second_player("player2")
+
+    def play_turn(col: int) -> int:
+        response: httpx.Response = test_client.post(
+            f"/{game.game_id}/play_turn",
+            json={"row": 0, "column": col},
+            headers={"x-player-token": str(game.first_player.token)},
+        )
+        return response.status_code
+
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        status_codes = sorted(executor.map(play_turn, range(3)))
+    assert status_codes == [200, 400, 400]
+    assert game.turns_played == 1
+
+
+def test_events(test_client: testclient.TestClient, game: game_state.GameState) -> None:
+    game_events = dependencies.get_game_events()
+
+    def read_events() -> list[str]:
+        response = test_client.get(f"/{game.game_id}/events")
+        return [line for line in response.text.splitlines() if line.startswith("event")]
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        events = executor.submit(read_events)
+        while not game_events.subscribers(game.game_id):
+            time.sleep(0.01)
+        player2 = test_client.post(
+            f"/{game.game_id}/join", json={"player_name": "player2"}
+        ).json()["player_token"]
+        for turn, col in enumerate([0, 0, 1, 1, 2]):
+            response = test_client.post(
+                f"/{game.game_id}/play_turn",
+                json={"row": turn % 2, "column": col},
+                headers={
+                    "x-player-token": (
+                        player2 if turn % 2 else str(game.first_player.token)
+                    )
+                },
+            )
+            assert response.status_code == 200
+        assert events.result(timeout=10) == [
+            "event: state",
+            "event: join",
+            *["event: move"] * 5,
+        ]
+    assert not game_events.subscribers(game.game_id)
+
+
+def test_subscribing_doesnt_block_the_event_loop(game: game_state.GameState) -> None:
+    lock = dependencies.get_game_locks().for_game(game.game_id)
+    released = threading.Lock()
+
+    def release() -> None:
+        if released.acquire(blocking=False):
+            lock.release()
+
+    async def main() -> bool:
+        transport = httpx.ASGITransport(app=server_main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://t"
+        ) as client:
+            subscribing = asyncio.create_task(client.get(f"/{game.game_id}/events"))
+            await asyncio.sleep(0.1)
+            await client.get("/metrics")
+            # Answered while the subscription still waits for the lock.
+            answered_while_locked = lock.locked()
+            release()
+            subscribing.cancel()
+            return answered_while_locked
+
+    lock.acquire()
+    # Frees the event loop if the subscription blocks it.
+    releaser = threading.Timer(5, release)
+    releaser.start()
+    try:
+        assert asyncio.run(main())
+    finally:
+        releaser.cancel()
+        release()
+
+
+def test_get_state_if_none_match(
+    test_client: testclient.TestClient, game: game_state.GameState
+) -> None:
+    response = test_client.get(f"/{game.game_id}")
+    assert response.json()["version"] == 0
+    etag = response.headers["etag"]
+
+    response = test_client.get(f"/{game.game_id}", headers={"if-none-match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    game.add_second_player("player2")
+    response = test_client.get(f"/{game.game_id}", headers={"if-none-match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"1"'
+    assert response.json()["second_player_name"] == "player2"
+
+
+def test_batches(test_client: testclient.TestClient) -> None:
+    response = test_client.post(
+        "/batch/new_game",
+        json={
+            "items": [
+                {"player_name": "player1"},
+                {"player_name": "player1", "board_size": 4, "win_length": 5},
+                {"board_size": 3},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 400, 422]
+    game_id = results[0]["body"]["game_id"]
+    first_player_token = results[0]["body"]["player_token"]
+
+    response = test_client.post(
+        "/batch/join",
+        json={
+            "items": [
+                {"game_id": game_id, "player_name": "player2"},
+                {"game_id": game_id, "player_name": "player3"},
+                {"game_id": str(uuid.uuid4()), "player_name": "player2"},
+            ]
+        },
+    )
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 400, 404]
+    second_player_token = results[0]["body"]["player_token"]
+
+    current_turn = test_client.get(f"/{game_id}").json()["current_turn"]
+    tokens = [first_player_token, second_player_token]
+    if current_turn == "second_player":
+        tokens.reverse()
+    turns = [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]
+    response = test_client.post(
+        "/batch/play_turn",
+        json={
+            "items": [
+                {"game_id": game_id, "player_token": tokens[0], "row": 2, "column": 2},
+                {"game_id": game_id, "player_token": tokens[0], "row": 2, "column": 1},
+            ]
+            + [
+                {
+                    "game_id": game_id,
+                    "player_token": tokens[turn % 2],
+                    "row": row,
+                    "column": col,
+                }
+                for turn, (row, col) in enumerate(turns, start=1)
+            ]
+        },
+    )
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 400] + [200] * 5
+    assert results[-1]["body"]["result"] == "won"
+
+
+@pytest.fixture
+def matchmaker() -> Iterator[matchmaking.Matchmaker]:
+    matchmaker = matchmaking.Matchmaker(matchmaking.MatchmakingSettings())
+    server_main.app.dependency_overrides[dependencies.get_matchmaker] = lambda: (
+        matchmaker
+    )
+    yield matchmaker
+    del server_main.app.dependency_overrides[dependencies.get_matchmaker]
+
+
+def test_matchmake(
+    test_client: testclient.TestClient, matchmaker: matchmaking.Matchmaker
+) -> None:
+    first = test_client.post("/matchmake", json={"player_name": "player1"}).json()
+    assert (first["player"], first["matched"]) == ("first_player", False)
+    large = test_client.post(
+        "/matchmake", json={"player_name": "player2", "board_size": 4}
+    ).json()
+    assert large["player"] == "first_player"
+
+    second = test_client.post("/matchmake", json={"player_name": "player3"}).json()
+    assert (second["game_id"], second["player"]) == (first["game_id"], "second_player")
+    state = test_client.get(f"/{first['game_id']}").json()
+    assert state["second_player_name"] == "player3"
+
+    # Joined by id, so it's no longer handed out.
+    third = test_client.post("/matchmake", json={"player_name": "player4"}).json()
+    test_client.post(f"/{third['game_id']}/join", json={"player_name": "player5"})
+    fourth = test_client.post("/matchmake", json={"player_name": "player6"}).json()
+    assert fourth["player"] == "first_player"
+    assert matchmaker.waiting() == 2
+
+
+def test_matchmake_waits_for_opponent(matchmaker: matchmaking.Matchmaker) -> None:
+    async def main() -> list[Any]:
+        transport = httpx.ASGITransport(app=server_main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://t"
+        ) as client:
+            waiting = asyncio.create_task(
+                client.post(
+                    "/matchmake", json={"player_name": "player1", "wait_seconds": 10}
+                )
+            )
+            while not matchmaker.waiting():
+                await asyncio.sleep(0.01)
+            second = await client.post("/matchmake", json={"player_name": "player2"})
+            return [(await waiting).json(), second.json()]
+
+    first, second = asyncio.run(main())
+    assert first["matched"] and second["matched"]
+    assert first["game_id"] == second["game_id"]
+
+
+def test_matchmake_again_after_timeout(
+    test_client: testclient.TestClient, matchmaker: matchmaking.Matchmaker
+) -> None:
+    body = {"player_name": "alice", "wait_seconds": 0.05}
+    first = test_client.post("/matchmake", json=body).json()
+    second = test_client.post("/matchmake", json=body).json()
+    assert (first["player"], first["matched"]) == ("first_player", False)
+    assert (second["player"], second["matched"]) == ("first_player", False)
+    assert second["game_id"] != first["game_id"]
+
+
+def test_matchmaking_tickets_expire() -> None:
+    matchmaker = matchmaking.Matchmaker(
+        matchmaking.MatchmakingSettings(ticket_ttl_seconds=10)
+    )
+    games = {}
+    for now in [0, 5]:
+        game = game_state.GameState(uuid.uuid4(), "player1")
+        games[game.game_id] = game
+        matchmaker.enqueue((3, 3), game.game_id, None, now)
+    ticket = matchmaker.take((3, 3), games, now=12)
+    assert ticket is not None and ticket.game_id == game.game_id
+    assert matchmaker.take((3, 3), games, now=12) is None
+    assert matchmaker.waiting() == 0
+
+
+def test_export(test_client: testclient.TestClient) -> None:
+    game = test_client.post("/new_game", json={"player_name": "player1"}).json()
+    game_id = game["game_id"]
+
+    response = test_client.get("/export")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert game_id in {game["game_id"] for game in exported}
+
+    response = test_client.get("/export", params={"format": "binary"})
+    binary = list(export.read_binary(io.BytesIO(response.content)))
+    assert sorted(binary, key=str) == sorted(exported, key=str)
+
+    assert test_client.get("/export", params={"format": "csv"}).status_code == 422
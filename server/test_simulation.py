@@ -0,0 +1,40 @@
+import uuid
+import pytest
+
+from server import game_state, simulation
+
+
+@pytest.mark.parametrize(
+    "size, win_length, policy",
+    [(3, 3, "random"), (3, 3, "greedy"), (6, 4, "random"), (6, 4, "greedy")],
+)
+def test_same_results_as_game_state(size: int, win_length: int, policy: str) -> None:
+    shape = game_state.get_board_shape(size, win_length)
+    result = simulation.simulate(
+        200, x_policy=policy, o_policy=policy, shape=shape, seed=0, keep_moves=True
+    )
+    assert result.moves is not None
+    outcomes = {"x": 0, "o": 0, "draw": 0}
+    for moves in result.moves:
+        game = game_state.GameState(uuid.uuid4(), "x", shape=shape)
+        game.first_player_starts = True
+        game.current_turn_first_player = True
+        game.add_second_player("o")
+        for cell in moves:
+            if cell == simulation.NO_MOVE:
+                break
+            assert not game.is_over
+            game.play_turn(game_state.Move(*divmod(int(cell), size)))
+        assert game.is_over
+        outcomes[game.winner.name if game.winner is not None else "draw"] += 1
+    assert outcomes == {"x": result.x_wins, "o": result.o_wins, "draw": result.draws}
+
+
+def test_solver_always_draws() -> None:
+    result = simulation.simulate(1000, x_policy="solver", o_policy="solver")
+    assert result.draws == 1000
+
+
+def test_solver_never_loses_to_random() -> None:
+    result = simulation.simulate(1000, x_policy="random", o_policy="solver", seed=0)
+    assert result.x_wins == 0
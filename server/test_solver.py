@@ -0,0 +1,64 @@
+import uuid
+import pytest
+
+from server import game_state, solver
+
+
+@pytest.fixture
+def game() -> game_state.GameState:
+    game = game_state.GameState(game_id=uuid.uuid4(), first_player_name="player1")
+    game.first_player_starts = True
+    game.current_turn_first_player = True
+    return game
+
+
+def test_empty_board_is_a_draw() -> None:
+    assert solver.get_solver().value(0, 0) == 0
+
+
+def test_symmetric_positions_share_a_key() -> None:
+    corners = [
+        game_state.get_board_shape().cell_bit(row, col)
+        for row, col in [(0, 0), (0, 2), (2, 0), (2, 2)]
+    ]
+    keys = {solver.get_solver().canonical_key(corner, 0) for corner in corners}
+    assert len(keys) == 1
+
+
+def test_takes_the_win(game: game_state.GameState) -> None:
+    game.game_state = [
+        [game_state.Symbol.X, game_state.Symbol.X, game_state.Symbol.EMPTY],
+        [game_state.Symbol.O, game_state.Symbol.O, game_state.Symbol.EMPTY],
+        [game_state.Symbol.EMPTY, game_state.Symbol.EMPTY, game_state.Symbol.EMPTY],
+    ]
+    move, score = solver.best_move(game)
+    assert move == game_state.Move(row=0, col=2)
+    assert score > 0
+
+
+def test_blocks_the_loss(game: game_state.GameState) -> None:
+    game.game_state = [
+        [game_state.Symbol.X, game_state.Symbol.EMPTY, game_state.Symbol.EMPTY],
+        [game_state.Symbol.O, game_state.Symbol.O, game_state.Symbol.EMPTY],
+        [game_state.Symbol.X, game_state.Symbol.EMPTY, game_state.Symbol.EMPTY],
+    ]
+    move, _ = solver.best_move(game)
+    assert move == game_state.Move(row=1, col=2)
+
+
+def test_solver_never_loses(game: game_state.GameState) -> None:
+    game.add_second_player("solver")
+    while not game.is_over:
+        move, _ = solver.best_move(game)
+        game.play_turn(move)
+    assert game.is_drawn
+
+
+def test_large_board_unsupported() -> None:
+    game = game_state.GameState(
+        game_id=uuid.uuid4(),
+        first_player_name="player1",
+        shape=game_state.get_board_shape(4),
+    )
+    with pytest.raises(ValueError):
+        solver.best_move(game)
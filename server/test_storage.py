@@ -0,0 +1,240 @@
+import os
+import pathlib
+import threading
+import uuid
+import pytest
+
+from server import game_state, locks, storage
+
+
+def play_game(store: storage.GameStore, games: storage.GamesDict) -> None:
+    game = game_state.GameState(
+        uuid.uuid4(), "player1", shape=game_state.get_board_shape(5, 4)
+    )
+    games[game.game_id] = game
+    store.record_create(game)
+    game.add_second_player("player2")
+    store.record_join(game)
+    for row, col in [(0, 0), (1, 1), (0, 1), (2, 2), (0, 2), (3, 3), (0, 3)]:
+        move = game_state.Move(row=row, col=col)
+        game.play_turn(move)
+        store.record_move(game, move)
+
+
+def assert_same_games(loaded: storage.GamesDict, games: storage.GamesDict) -> None:
+    assert loaded.keys() == games.keys()
+    for game_id, game in games.items():
+        assert loaded[game_id].pack() == game.pack()
+        assert loaded[game_id].winner == game.winner
+        assert loaded[game_id].turns_played == game.turns_played
+        assert (
+            loaded[game_id].current_turn_first_player == game.current_turn_first_player
+        )
+
+
+@pytest.fixture
+def store(tmp_path: pathlib.Path) -> storage.LogGameStore:
+    return storage.LogGameStore(tmp_path, flush_interval_seconds=0)
+
+
+def test_pack_round_trip() -> None:
+    game = game_state.GameState(uuid.uuid4(), "player1")
+    game.add_second_player("player2")
+    game.play_turn(game_state.Move(row=1, col=1))
+    unpacked = game_state.GameState.unpack(game.pack())
+    assert unpacked.game_state == game.game_state
+    assert unpacked.first_player == game.first_player
+    assert unpacked.second_player == game.second_player
+    assert unpacked.current_turn_first_player == game.current_turn_first_player
+    assert (unpacked.created_at_ms, unpacked.moves, unpacked.move_times) == (
+        game.created_at_ms,
+        bytearray([4]),
+        game.move_times,
+    )
+
+
+def test_replay_untimed_move() -> None:
+    game = game_state.GameState(uuid.uuid4(), "player1")
+    games = {game.game_id: game}
+    storage.apply_record(
+        games,
+        storage.GameArchive(10),
+        bytes([storage.RECORD_MOVE])
+        + storage.UNTIMED_MOVE.pack(game.game_id.bytes, 2, 1),
+    )
+    assert list(game.moves) == [7]
+    assert len(game.move_times) == 1
+
+
+def test_replay_log(tmp_path: pathlib.Path, store: storage.LogGameStore) -> None:
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    for _ in range(3):
+        play_game(store, games)
+    store.close()
+
+    loaded: storage.GamesDict = {}
+    storage.LogGameStore(tmp_path).load(loaded, storage.GameArchive(10))
+    assert_same_games(loaded, games)
+    assert all(game.winner is not None for game in loaded.values())
+
+
+def test_snapshot_and_log(tmp_path: pathlib.Path) -> None:
+    store = storage.LogGameStore(
+        tmp_path, flush_interval_seconds=0, snapshot_every_records=5
+    )
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    for _ in range(3):
+        play_game(store, games)
+    store.close()
+    assert (tmp_path / storage.SNAPSHOT_FILENAME).exists()
+
+    loaded: storage.GamesDict = {}
+    reloaded_store = storage.LogGameStore(tmp_path)
+    reloaded_store.load(loaded, storage.GameArchive(10))
+    reloaded_store.close()
+    assert_same_games(loaded, games)
+
+
+def test_torn_tail_is_ignored(
+    tmp_path: pathlib.Path, store: storage.LogGameStore
+) -> None:
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    play_game(store, games)
+    store.close()
+    (segment,) = tmp_path.glob(f"{storage.LOG_PREFIX}*")
+    with open(segment, "ab") as log:
+        log.write(storage.FRAME.pack(100, 0) + b"partial")
+
+    loaded: storage.GamesDict = {}
+    storage.LogGameStore(tmp_path).load(loaded, storage.GameArchive(10))
+    assert_same_games(loaded, games)
+
+
+def test_removed_games_are_archived(tmp_path: pathlib.Path) -> None:
+    store = storage.LogGameStore(
+        tmp_path, flush_interval_seconds=0, snapshot_every_records=20
+    )
+    games: storage.GamesDict = {}
+    archive = storage.GameArchive(10)
+    store.load(games, archive)
+    play_game(store, games)
+    play_game(store, games)
+    play_game(store, games)
+    finished_id, abandoned_id, _ = games
+    archive.add(finished_id, games.pop(finished_id).pack())
+    store.record_remove(finished_id, True)
+    games.pop(abandoned_id)
+    store.record_remove(abandoned_id, False)
+    store.close()
+
+    loaded: storage.GamesDict = {}
+    loaded_archive = storage.GameArchive(10)
+    storage.LogGameStore(tmp_path).load(loaded, loaded_archive)
+    assert_same_games(loaded, games)
+    archived_game = loaded_archive.get(finished_id)
+    assert archived_game is not None
+    assert archived_game.pack() == archive.items()[0][1]
+    assert loaded_archive.get(abandoned_id) is None
+
+
+def test_records_are_durable_when_recorded(
+    tmp_path: pathlib.Path, store: storage.LogGameStore
+) -> None:
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    play_game(store, games)
+
+    # Read while the store is still open, as after a crash.
+    loaded: storage.GamesDict = {}
+    (segment,) = tmp_path.glob(f"{storage.LOG_PREFIX}*")
+    for payload in storage._read_frames(segment.read_bytes()):
+        storage.apply_record(loaded, storage.GameArchive(10), payload)
+    store.close()
+    assert_same_games(loaded, games)
+
+
+def test_deferred_records_share_fsyncs(
+    monkeypatch: pytest.MonkeyPatch, store: storage.LogGameStore
+) -> None:
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    released = threading.Event()
+    fsyncs = []
+
+    def blocked_fsync(descriptor: int) -> None:
+        # Holds up the first write, so the remaining records pile up.
+        assert released.wait(10)
+        fsyncs.append(descriptor)
+
+    monkeypatch.setattr(os, "fsync", blocked_fsync)
+    with store.deferred():
+        for _ in range(10):
+            play_game(store, games)
+    released.set()
+    assert store.wait_durable(store.last_record()) == store.last_record() == 90
+    assert len(fsyncs) <= 2
+    store.close()
+
+
+def test_failed_write_is_raised(
+    monkeypatch: pytest.MonkeyPatch, store: storage.LogGameStore
+) -> None:
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    play_game(store, games)
+
+    def fail(descriptor: int) -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(storage.StoreFailed):
+        play_game(store, games)
+    # Nothing is accepted after a record that may be torn.
+    game_id = next(iter(games))
+    with pytest.raises(storage.StoreFailed):
+        store.record_remove(game_id, False)
+    store.close()
+
+
+def test_failed_snapshot_keeps_writing(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path
+) -> None:
+    store = storage.LogGameStore(tmp_path, snapshot_every_records=5)
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+
+    def fail(source: pathlib.Path, destination: pathlib.Path) -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    for _ in range(3):
+        play_game(store, games)
+    store.close()
+
+    loaded: storage.GamesDict = {}
+    storage.LogGameStore(tmp_path).load(loaded, storage.GameArchive(10))
+    assert_same_games(loaded, games)
+
+
+def test_snapshot_waits_for_game_locks(tmp_path: pathlib.Path) -> None:
+    # All games share the one lock.
+    game_locks = locks.LockStripes(1)
+    store = storage.LogGameStore(
+        tmp_path, snapshot_every_records=5, game_locks=game_locks
+    )
+    games: storage.GamesDict = {}
+    store.load(games, storage.GameArchive(10))
+    with game_locks.for_game(uuid.uuid4()):
+        # Records are still written while the snapshot waits.
+        for _ in range(3):
+            play_game(store, games)
+        assert not (tmp_path / storage.SNAPSHOT_FILENAME).exists()
+    store.close()
+    assert (tmp_path / storage.SNAPSHOT_FILENAME).exists()
+
+    loaded: storage.GamesDict = {}
+    storage.LogGameStore(tmp_path).load(loaded, storage.GameArchive(10))
+    assert_same_games(loaded, games)
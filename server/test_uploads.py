@@ -0,0 +1,118 @@
+import hashlib
+import io
+import tempfile
+
+import fastapi
+import pytest
+from fastapi import testclient
+from PIL import Image
+
+from server import ocr_pool, server_main, uploads
+
+
+def encoded(image_format: str, size: tuple[int, int], **options: object) -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", size, "white").save(output, image_format, **options)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize(
+    "image_format,options,expected",
+    [
+        ("PNG", {}, uploads.FORMAT_PNG),
+        ("JPEG", {}, uploads.FORMAT_JPEG),
+        # Metadata before the frame header.
+        ("JPEG", {"exif": b"Exif\x00\x00" + bytes(40_000)}, uploads.FORMAT_JPEG),
+        ("GIF", {}, uploads.FORMAT_GIF),
+        ("BMP", {}, uploads.FORMAT_BMP),
+        ("WEBP", {}, uploads.FORMAT_WEBP),
+        ("WEBP", {"lossless": True}, uploads.FORMAT_WEBP),
+    ],
+)
+def test_sniff(image_format: str, options: dict[str, object], expected: str) -> None:
+    data = encoded(image_format, (301, 217), **options)
+    assert uploads.sniff(memoryview(data)) == uploads.ImageInfo(expected, 301, 217)
+
+
+def test_sniff_rejects_other_data() -> None:
+    assert uploads.sniff(memoryview(b"")) is None
+    assert uploads.sniff(memoryview(b"not an image")) is None
+    assert uploads.sniff(memoryview(encoded("PNG", (10, 10))[:20])) is None
+    # A JPEG cut off before its frame header.
+    assert uploads.sniff(memoryview(encoded("JPEG", (10, 10))[:10])) is None
+
+
+def test_check_image() -> None:
+    settings = uploads.UploadSettings(
+        max_pixels=100 * 100, formats=frozenset([uploads.FORMAT_PNG])
+    )
+    uploads.check_image(memoryview(encoded("PNG", (100, 100))), settings)
+    with pytest.raises(ocr_pool.ImageTooLarge):
+        uploads.check_image(memoryview(encoded("PNG", (101, 100))), settings)
+    with pytest.raises(uploads.UnsupportedImage):
+        uploads.check_image(memoryview(encoded("GIF", (10, 10))), settings)
+
+
+@pytest.mark.parametrize("size", [0, 10, 1000])
+def test_mapped(size: int) -> None:
+    data = bytes(range(256)) * size
+    # Rolled over to disk past 2560 bytes.
+    with tempfile.SpooledTemporaryFile(max_size=2560) as file:
+        file.write(data)
+        with uploads.mapped(file) as view:
+            assert view == data
+
+
+@pytest.mark.parametrize(
+    "size",
+    # Starlette spools uploads over 1 MiB to disk.
+    [0, 100, 2 * 1024 * 1024],
+)
+def test_mapped_upload(size: int) -> None:
+    app = fastapi.FastAPI()
+
+    @app.post("/upload")
+    def upload(image_file: fastapi.UploadFile) -> str:
+        with uploads.mapped(image_file.file) as view:
+            return hashlib.sha256(view).hexdigest()
+
+    data = bytes(range(256)) * (size // 256)
+    response = testclient.TestClient(app).post(
+        "/upload", files={"image_file": ("board.png", data)}
+    )
+    assert response.json() == hashlib.sha256(data).hexdigest()
+
+
+def test_mapped_without_file_descriptor() -> None:
+    data = b"board" * 100
+    with uploads.mapped(io.BufferedReader(io.BytesIO(data))) as view:
+        assert view == data
+
+
+@pytest.fixture
+def limited_client() -> testclient.TestClient:
+    return testclient.TestClient(
+        uploads.BodyLimitMiddleware(server_main.app, max_bytes=1000)
+    )
+
+
+def test_body_limit(limited_client: testclient.TestClient) -> None:
+    response = limited_client.post("/new_game", json={"player_name": "x" * 2000})
+    assert response.status_code == 413
+    response = limited_client.post("/new_game", json={"player_name": "player1"})
+    assert response.status_code == 200
+
+
+def test_body_limit_without_content_length(
+    limited_client: testclient.TestClient,
+) -> None:
+    game_id = limited_client.post("/new_game", json={"player_name": "p"}).json()[
+        "game_id"
+    ]
+    chunks = iter([b"--boundary\r\n", bytes(2000)])
+    response = limited_client.post(
+        f"/{game_id}/play_turn_image",
+        content=chunks,
+        headers={"content-type": "multipart/form-data; boundary=boundary"},
+    )
+    assert response.status_code == 413
@@ -0,0 +1,242 @@
+"""Bounds uploaded images before they reach the OCR pool.
+
+Request bodies are capped by `BodyLimitMiddleware`, which turns away a body
+with a larger `Content-Length` before reading any of it, and stops reading
+one without a length as soon as it goes over. Starlette spools the uploaded
+file to disk once it is large, and the handler reads it through a memory map
+of that file. The format and dimensions are read from the image header by
+`sniff`, in the server process and without PIL, so unsupported and oversized
+images are rejected without a full decode or a trip to a worker.
+"""
+
+from __future__ import annotations
+from typing import IO, Callable, Iterator, NamedTuple, Optional
+import contextlib
+import dataclasses
+import io
+import mmap
+import os
+import struct
+
+import fastapi
+
+from server import metrics, ocr_pool
+
+FORMAT_PNG = "png"
+FORMAT_JPEG = "jpeg"
+FORMAT_GIF = "gif"
+FORMAT_BMP = "bmp"
+FORMAT_WEBP = "webp"
+FORMATS = (FORMAT_PNG, FORMAT_JPEG, FORMAT_GIF, FORMAT_BMP, FORMAT_WEBP)
+
+# JPEG start of frame markers, which hold the dimensions. 0xC4, 0xC8 and 0xCC
+# are other markers in the same range.
+JPEG_FRAME_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers without a length and payload.
+JPEG_STANDALONE_MARKERS = frozenset([0x01, *range(0xD0, 0xD8)])
+JPEG_START_OF_SCAN = 0xDA
+
+# Starlette deprecates HTTP_413_REQUEST_ENTITY_TOO_LARGE, and only newer
+# versions have HTTP_413_CONTENT_TOO_LARGE.
+HTTP_413_CONTENT_TOO_LARGE = 413
+
+
+@dataclasses.dataclass(frozen=True)
+class UploadSettings:
+    # Largest accepted request body, multipart framing included.
+    max_bytes: int = 16 * 1024 * 1024
+    max_pixels: int = ocr_pool.MAX_IMAGE_PIXELS
+    formats: frozenset[str] = frozenset(FORMATS)
+
+    @staticmethod
+    def from_env() -> UploadSettings:
+        defaults = UploadSettings()
+        formats = os.environ.get("T3_IMAGE_FORMATS")
+        return UploadSettings(
+            max_bytes=int(os.environ.get("T3_MAX_UPLOAD_BYTES", defaults.max_bytes)),
+            formats=(
+                defaults.formats
+                if formats is None
+                else frozenset(name.strip().lower() for name in formats.split(","))
+            ),
+        )
+
+
+class ImageInfo(NamedTuple):
+    format: str
+    width: int
+    height: int
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+def _sniff_png(data: memoryview) -> Optional[ImageInfo]:
+    if len(data) < 24 or data[12:16].tobytes() != b"IHDR":
+        return None
+    width, height = struct.unpack_from(">II", data, 16)
+    return ImageInfo(FORMAT_PNG, width, height)
+
+
+def _sniff_jpeg(data: memoryview) -> Optional[ImageInfo]:
+    # The frame header can come after large metadata segments, which are
+    # skipped by their lengths without being read.
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+        elif marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+        elif marker == JPEG_START_OF_SCAN:
+            return None
+        elif marker in JPEG_FRAME_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return ImageInfo(FORMAT_JPEG, width, height)
+        else:
+            (length,) = struct.unpack_from(">H", data, offset + 2)
+            offset += 2 + length
+    return None
+
+
+def _sniff_gif(data: memoryview) -> Optional[ImageInfo]:
+    if len(data) < 10:
+        return None
+    width, height = struct.unpack_from("<HH", data, 6)
+    return ImageInfo(FORMAT_GIF, width, height)
+
+
+def _sniff_bmp(data: memoryview) -> Optional[ImageInfo]:
+    if len(data) < 26:
+        return None
+    (header_size,) = struct.unpack_from("<I", data, 14)
+    if header_size == 12:
+        width, height = struct.unpack_from("<HH", data, 18)
+    else:
+        # Top-down bitmaps have a negative height.
+        width, height = struct.unpack_from("<ii", data, 18)
+    return ImageInfo(FORMAT_BMP, abs(width), abs(height))
+
+
+def _sniff_webp(data: memoryview) -> Optional[ImageInfo]:
+    if len(data) < 30:
+        return None
+    chunk = data[12:16].tobytes()
+    if chunk == b"VP8 " and data[23:26].tobytes() == b"\x9d\x01\x2a":
+        width, height = struct.unpack_from("<HH", data, 26)
+        return ImageInfo(FORMAT_WEBP, width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L" and data[20] == 0x2F:
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return ImageInfo(FORMAT_WEBP, (bits & 0x3FFF) + 1, (bits >> 14 & 0x3FFF) + 1)
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return ImageInfo(FORMAT_WEBP, width, height)
+    return None
+
+
+SNIFFERS: list[tuple[bytes, Callable[[memoryview], Optional[ImageInfo]]]] = [
+    (b"\x89PNG\r\n\x1a\n", _sniff_png),
+    (b"\xff\xd8", _sniff_jpeg),
+    (b"GIF87a", _sniff_gif),
+    (b"GIF89a", _sniff_gif),
+    (b"BM", _sniff_bmp),
+    (b"RIFF", _sniff_webp),
+]
+
+
+def sniff(data: memoryview) -> Optional[ImageInfo]:
+    """The format and dimensions from the image header, or None if the data
+    doesn't start like an image of a known format."""
+    for signature, sniffer in SNIFFERS:
+        if data[: len(signature)].tobytes() == signature:
+            return sniffer(data)
+    return None
+
+
+def check_image(data: memoryview, settings: UploadSettings) -> ImageInfo:
+    """Raises `UnsupportedImage` for data that isn't an image in one of the
+    accepted formats and `ocr_pool.ImageTooLarge` for too many pixels."""
+    info = sniff(data)
+    if info is None or info.format not in settings.formats:
+        raise UnsupportedImage
+    if info.width * info.height > settings.max_pixels:
+        raise ocr_pool.ImageTooLarge(f"{info.width}x{info.height}")
+    return info
+
+
+@contextlib.contextmanager
+def mapped(file: IO[bytes]) -> Iterator[memoryview]:
+    """The contents of an uploaded file without copying them, from the
+    in-memory buffer for small uploads and from a memory map of the spool
+    file for large ones. Files that are neither are read into memory."""
+    # The spooled file's buffer, since its `fileno()` would write it to disk.
+    # `_file` is private to `SpooledTemporaryFile`, so without it the file is
+    # used as it is.
+    raw = getattr(file, "_file", file)
+    if isinstance(raw, io.BytesIO):
+        with raw.getbuffer() as view:
+            yield view
+        return
+    try:
+        raw.flush()
+        descriptor = raw.fileno()
+    except (AttributeError, OSError):
+        file.seek(0)
+        yield memoryview(file.read())
+        return
+    if os.fstat(descriptor).st_size == 0:
+        yield memoryview(b"")
+        return
+    with mmap.mmap(descriptor, 0, access=mmap.ACCESS_READ) as mapping:
+        with memoryview(mapping) as view:
+            yield view
+
+
+class BodyLimitMiddleware:
+    """Answers 413 to request bodies over `max_bytes`."""
+
+    def __init__(self, app: metrics.ASGIApp, max_bytes: int) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(
+        self, scope: metrics.Scope, receive: metrics.Receive, send: metrics.Send
+    ) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if (
+                name == b"content-length"
+                and value.isdigit()
+                and int(value) > self.max_bytes
+            ):
+                response = fastapi.responses.JSONResponse(
+                    {"detail": "Request body too large"},
+                    status_code=HTTP_413_CONTENT_TOO_LARGE,
+                    headers={"Connection": "close"},
+                )
+                await response(scope, receive, send)
+                return
+        received = 0
+
+        async def limited_receive() -> metrics.Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Handlers reading the body pass HTTP errors through.
+                    raise fastapi.exceptions.HTTPException(
+                        status_code=HTTP_413_CONTENT_TOO_LARGE,
+                        detail="Request body too large",
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
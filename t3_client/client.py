@@ -0,0 +1,368 @@
+"""A client library for the tic tac toe server.
+
+`Client` keeps a pool of keep-alive connections, and `AsyncClient` does the
+same on asyncio, to drive many games at once from one process. Both return
+typed results and raise `httpx.HTTPStatusError` for error responses.
+"""
+
+from __future__ import annotations
+from typing import Any, AsyncGenerator, Generator, Optional, Union
+import contextlib
+import dataclasses
+import json
+import pathlib
+
+import httpx
+
+DEFAULT_URL = "http://localhost:8000"
+DEFAULT_TIMEOUT_SECONDS = 30.0
+FIRST_PLAYER = "first_player"
+SECOND_PLAYER = "second_player"
+
+
+@dataclasses.dataclass(frozen=True)
+class Seat:
+    """A player's place in a game."""
+
+    game_id: str
+    player_token: str
+    # `FIRST_PLAYER` or `SECOND_PLAYER`
+    role: str
+
+
+@dataclasses.dataclass(frozen=True)
+class GameView:
+    board: list[list[str]]
+    first_player_name: str
+    second_player_name: Optional[str]
+    board_size: int
+    win_length: int
+    current_turn: str
+    version: int
+
+    @staticmethod
+    def from_json(data: dict[str, Any]) -> GameView:
+        return GameView(
+            board=data["game_state"],
+            first_player_name=data["first_player_name"],
+            second_player_name=data["second_player_name"],
+            board_size=data["board_size"],
+            win_length=data["win_length"],
+            current_turn=data["current_turn"],
+            version=data["version"],
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class TurnResult:
+    # "won", "draw" or None while the game goes on.
+    result: Optional[str] = None
+    winner: Optional[str] = None
+    # The server's reply in games against the server, as (row, column).
+    server_move: Optional[tuple[int, int]] = None
+
+    @property
+    def is_over(self) -> bool:
+        return self.result is not None
+
+    @staticmethod
+    def from_json(data: Optional[dict[str, Any]]) -> TurnResult:
+        if data is None:
+            return TurnResult()
+        server_move = data.get("server_move")
+        return TurnResult(
+            result=data.get("result"),
+            winner=data.get("winner"),
+            server_move=(
+                None
+                if server_move is None
+                else (server_move["row"], server_move["column"])
+            ),
+        )
+
+
+def _new_game_body(
+    player_name: str,
+    board_size: Optional[int],
+    win_length: Optional[int],
+    against_server: bool,
+) -> dict[str, Any]:
+    body: dict[str, Any] = {"player_name": player_name}
+    if board_size is not None:
+        body["board_size"] = board_size
+    if win_length is not None:
+        body["win_length"] = win_length
+    if against_server:
+        body["against_server"] = True
+    return body
+
+
+def _seat(response: httpx.Response, role: str) -> Seat:
+    response.raise_for_status()
+    data = response.json()
+    return Seat(data["game_id"], data["player_token"], role)
+
+
+def _waiting_timeout(timeout: httpx.Timeout, wait_seconds: float) -> httpx.Timeout:
+    read = None if timeout.read is None else timeout.read + wait_seconds
+    return httpx.Timeout(
+        connect=timeout.connect, read=read, write=timeout.write, pool=timeout.pool
+    )
+
+
+def _matched_seat(response: httpx.Response) -> tuple[Seat, bool]:
+    response.raise_for_status()
+    data = response.json()
+    return Seat(data["game_id"], data["player_token"], data["player"]), data["matched"]
+
+
+def _turn_result(response: httpx.Response) -> TurnResult:
+    response.raise_for_status()
+    return TurnResult.from_json(response.json())
+
+
+def _event_data(line: str) -> Optional[dict[str, Any]]:
+    if not line.startswith("data:"):
+        return None
+    data: dict[str, Any] = json.loads(line[len("data:") :])
+    return data
+
+
+def _ends_wait(event: dict[str, Any], seat: Seat) -> bool:
+    return "result" in event or event["current_turn"] == seat.role
+
+
+class _StateCache:
+    """The last state seen of every game, so that unchanged games are
+    answered with an empty 304."""
+
+    def __init__(self) -> None:
+        self._states: dict[str, tuple[str, GameView]] = {}
+
+    def headers(self, game_id: str) -> dict[str, str]:
+        cached = self._states.get(game_id)
+        return {} if cached is None else {"If-None-Match": cached[0]}
+
+    def view(self, game_id: str, response: httpx.Response) -> GameView:
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            return self._states[game_id][1]
+        response.raise_for_status()
+        view = GameView.from_json(response.json())
+        etag = response.headers.get("ETag")
+        if etag is not None:
+            self._states[game_id] = (etag, view)
+        return view
+
+
+class Client:
+    def __init__(
+        self,
+        url: str = DEFAULT_URL,
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+        http: Optional[httpx.Client] = None,
+    ) -> None:
+        self.http = (
+            httpx.Client(base_url=url, timeout=timeout_seconds)
+            if http is None
+            else http
+        )
+        self._states = _StateCache()
+
+    def __enter__(self) -> Client:
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.http.close()
+
+    def new_game(
+        self,
+        player_name: str,
+        board_size: Optional[int] = None,
+        win_length: Optional[int] = None,
+        against_server: bool = False,
+    ) -> Seat:
+        response = self.http.post(
+            "/new_game",
+            json=_new_game_body(player_name, board_size, win_length, against_server),
+        )
+        return _seat(response, FIRST_PLAYER)
+
+    def join(self, game_id: str, player_name: str) -> Seat:
+        response = self.http.post(f"/{game_id}/join", json={"player_name": player_name})
+        return _seat(response, SECOND_PLAYER)
+
+    def matchmake(
+        self,
+        player_name: str,
+        board_size: Optional[int] = None,
+        win_length: Optional[int] = None,
+        wait_seconds: float = 0.0,
+    ) -> tuple[Seat, bool]:
+        """A seat in a game with another player waiting, or in a new game.
+        Also returns whether an opponent has joined."""
+        body = _new_game_body(player_name, board_size, win_length, False)
+        body["wait_seconds"] = wait_seconds
+        response = self.http.post(
+            "/matchmake",
+            json=body,
+            timeout=_waiting_timeout(self.http.timeout, wait_seconds),
+        )
+        return _matched_seat(response)
+
+    def state(self, game_id: str) -> GameView:
+        response = self.http.get(f"/{game_id}", headers=self._states.headers(game_id))
+        return self._states.view(game_id, response)
+
+    def play_turn(self, seat: Seat, row: int, column: int) -> TurnResult:
+        response = self.http.post(
+            f"/{seat.game_id}/play_turn",
+            headers={"x-player-token": seat.player_token},
+            json={"row": row, "column": column},
+        )
+        return _turn_result(response)
+
+    def play_image_turn(
+        self, seat: Seat, image: Union[pathlib.Path, bytes]
+    ) -> TurnResult:
+        data = image.read_bytes() if isinstance(image, pathlib.Path) else image
+        response = self.http.post(
+            f"/{seat.game_id}/play_turn_image",
+            headers={"x-player-token": seat.player_token},
+            files={"image_file": data},
+        )
+        return _turn_result(response)
+
+    def export(self, export_format: str = "ndjson") -> Generator[bytes, None, None]:
+        """Every game on the server, streamed as chunks of NDJSON or binary
+        records (see `server.export`)."""
+        with self.http.stream(
+            "GET", "/export", params={"format": export_format}, timeout=None
+        ) as response:
+            response.raise_for_status()
+            yield from response.iter_bytes()
+
+    def events(self, game_id: str) -> Generator[dict[str, Any], None, None]:
+        """The game's events, until the server ends the stream."""
+        with self.http.stream("GET", f"/{game_id}/events", timeout=None) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                event = _event_data(line)
+                if event is not None:
+                    yield event
+
+    def wait_for_turn(self, seat: Seat) -> None:
+        """Blocks until it's the seat's turn or the game is over."""
+        # The server may end the stream early, when this client falls behind.
+        while True:
+            with contextlib.closing(self.events(seat.game_id)) as events:
+                if any(_ends_wait(event, seat) for event in events):
+                    return
+
+
+class AsyncClient:
+    def __init__(
+        self,
+        url: str = DEFAULT_URL,
+        timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+        max_connections: int = 100,
+        http: Optional[httpx.AsyncClient] = None,
+    ) -> None:
+        self.http = (
+            httpx.AsyncClient(
+                base_url=url,
+                timeout=timeout_seconds,
+                limits=httpx.Limits(max_connections=max_connections),
+            )
+            if http is None
+            else http
+        )
+        self._states = _StateCache()
+
+    async def __aenter__(self) -> AsyncClient:
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await self.http.aclose()
+
+    async def new_game(
+        self,
+        player_name: str,
+        board_size: Optional[int] = None,
+        win_length: Optional[int] = None,
+        against_server: bool = False,
+    ) -> Seat:
+        response = await self.http.post(
+            "/new_game",
+            json=_new_game_body(player_name, board_size, win_length, against_server),
+        )
+        return _seat(response, FIRST_PLAYER)
+
+    async def join(self, game_id: str, player_name: str) -> Seat:
+        response = await self.http.post(
+            f"/{game_id}/join", json={"player_name": player_name}
+        )
+        return _seat(response, SECOND_PLAYER)
+
+    async def matchmake(
+        self,
+        player_name: str,
+        board_size: Optional[int] = None,
+        win_length: Optional[int] = None,
+        wait_seconds: float = 0.0,
+    ) -> tuple[Seat, bool]:
+        body = _new_game_body(player_name, board_size, win_length, False)
+        body["wait_seconds"] = wait_seconds
+        response = await self.http.post(
+            "/matchmake",
+            json=body,
+            timeout=_waiting_timeout(self.http.timeout, wait_seconds),
+        )
+        return _matched_seat(response)
+
+    async def state(self, game_id: str) -> GameView:
+        response = await self.http.get(
+            f"/{game_id}", headers=self._states.headers(game_id)
+        )
+        return self._states.view(game_id, response)
+
+    async def play_turn(self, seat: Seat, row: int, column: int) -> TurnResult:
+        response = await self.http.post(
+            f"/{seat.game_id}/play_turn",
+            headers={"x-player-token": seat.player_token},
+            json={"row": row, "column": column},
+        )
+        return _turn_result(response)
+
+    async def play_image_turn(self, seat: Seat, image: bytes) -> TurnResult:
+        response = await self.http.post(
+            f"/{seat.game_id}/play_turn_image",
+            headers={"x-player-token": seat.player_token},
+            files={"image_file": image},
+        )
+        return _turn_result(response)
+
+    async def events(self, game_id: str) -> AsyncGenerator[dict[str, Any], None]:
+        async with self.http.stream(
+            "GET", f"/{game_id}/events", timeout=None
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                event = _event_data(line)
+                if event is not None:
+                    yield event
+
+    async def wait_for_turn(self, seat: Seat) -> None:
+        while True:
+            events = self.events(seat.game_id)
+            try:
+                async for event in events:
+                    if _ends_wait(event, seat):
+                        return
+            finally:
+                await events.aclose()
@@ -1,10 +1,20 @@
-# TODO: This lacks any error handling
+"""The command line client.
+
+Only argument parsing happens at import, so that `--help` and usage errors
+are quick. httpx is imported once a command runs, and PIL and asyncio only
+for `loadtest`.
+"""
+
+from __future__ import annotations
+import contextlib
 import dataclasses
 import argparse
 import pathlib
-from typing import Optional
+import sys
+from typing import TYPE_CHECKING, Optional
 
-import requests
+if TYPE_CHECKING:
+    from t3_client import client
 
 CLIENT_CACHE_FILENAME = "t3_cache"
 
@@ -14,90 +24,137 @@ class Game:
     url: str
     game_id: str
     player_token: str
+    # `client.FIRST_PLAYER` or `client.SECOND_PLAYER`
+    role: Optional[str] = None
 
-    def print_game_state(self) -> None:
-        response = requests.get(self.url + f"/{self.game_id}")
-        response.raise_for_status()
-
-        json_response = response.json()
-        first_player_name = json_response["first_player_name"]
-        second_player_name = (
-            json_response["second_player_name"]
-            if json_response["second_player_name"] is not None
-            else "[EMPTY]"
-        )
-        print(first_player_name, "vs", second_player_name)
-
-        print("Current turn: " + json_response["current_turn"])
-        for line in json_response["game_state"]:
-            print(line)
-
-
-    def _handle_turn_response(self, response: requests.Response) -> None:
-        response.raise_for_status()
-        json_response: Optional[dict[str, str]] = response.json()
-        if json_response is not None:
-            result = json_response.get("result", None)
-            if result == "draw":
-                self.print_game_state()
-                print("Game is drawn")
-            else:
-                winner = json_response.get("winner")
-                self.print_game_state()
-                print(f"{winner} won the game")
-
-    def play_turn(self, row: int, column: int) -> None:
-        response = requests.post(
-            self.url + f"/{self.game_id}/play_turn",
-            headers={"x-player-token": self.player_token},
-            json={"row": row, "column": column},
-        )
-        self._handle_turn_response(response)
-        
-
-    def play_image_turn(self, image_file: pathlib.Path) -> None:
-        with open(image_file, "rb") as opened_file:
-            response = requests.post(
-                self.url + f"/{self.game_id}/play_turn_image",
-            headers={"x-player-token": self.player_token},
-                files={"image_file": opened_file},
-            )
-        self._handle_turn_response(response)
-
-
-def handle_game_response(url: str, response: requests.Response) -> Game:
-    response.raise_for_status()
-    json_response = response.json()
-    return Game(
-        url=url,
-        game_id=json_response["game_id"],
-        player_token=json_response["player_token"],
-    )
+    @staticmethod
+    def from_seat(url: str, seat: client.Seat) -> Game:
+        return Game(url, seat.game_id, seat.player_token, seat.role)
 
+    @property
+    def seat(self) -> client.Seat:
+        from t3_client import client
 
-def start_game(url: str, player_name: str) -> Game:
-    response = requests.post(url + "/new_game", json={"player_name": player_name})
-    return handle_game_response(url=url, response=response)
+        return client.Seat(self.game_id, self.player_token, self.role or "")
 
 
-def join_game(url: str, player_name: str, game_id: str) -> Game:
-    response = requests.post(
-        url + f"/{game_id}/join", json={"player_name": player_name}
+def print_game_state(view: client.GameView) -> None:
+    second_player_name = (
+        view.second_player_name if view.second_player_name is not None else "[EMPTY]"
     )
-    return handle_game_response(url=url, response=response)
+    print(view.first_player_name, "vs", second_player_name)
+
+    print("Current turn: " + view.current_turn)
+    for line in view.board:
+        print(line)
+
+
+def print_turn_result(t3: client.Client, game: Game, result: client.TurnResult) -> None:
+    if result.server_move is not None:
+        print("Server played", *result.server_move)
+    if not result.is_over:
+        return
+    print_game_state(t3.state(game.game_id))
+    if result.result == "draw":
+        print("Game is drawn")
+    else:
+        print(f"{result.winner} won the game")
 
 
 def save_game_info(game: Game, cache_file: pathlib.Path) -> None:
-    cache_file.write_text(game.url + "\n" + game.game_id + "\n" + game.player_token)
+    cache_file.write_text(
+        "\n".join([game.url, game.game_id, game.player_token, game.role or ""])
+    )
 
 
 def load_game_info(cache_file: pathlib.Path) -> Game:
     try:
-        game_url, game_id, player_token = cache_file.read_text().splitlines()
+        # Files saved by older clients don't have the role.
+        game_url, game_id, player_token, *role = cache_file.read_text().splitlines()
     except FileNotFoundError:
         print("No game info saved. Please start or join a game first.")
         exit(1)
-    return Game(game_url, game_id, player_token)
+    return Game(game_url, game_id, player_token, role[0] if role and role[0] else None)
+
+
+async def run_loadtest(args: argparse.Namespace) -> None:
+    from t3_client import client, loadtest
+
+    settings = loadtest.LoadSettings(
+        matches=args.matches,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        image_turns=args.image_turns,
+        polls_per_turn=args.polls_per_turn,
+        seed=args.seed,
+    )
+    async with client.AsyncClient(args.url, max_connections=args.concurrency) as t3:
+        report = await loadtest.run(t3, settings)
+    print(report.format())
+
+
+def run(args: argparse.Namespace) -> None:
+    from t3_client import client
+
+    cache_file = pathlib.Path(args.cache_location)
+    # The parser can't use the default, since it runs before the client is
+    # imported.
+    if "url" in args and args.url is None:
+        args.url = client.DEFAULT_URL
+
+    if args.subparser_name == "loadtest":
+        import asyncio
+
+        asyncio.run(run_loadtest(args))
+        return
+
+    if args.subparser_name == "export":
+        output = (
+            open(args.output, "wb")
+            if args.output
+            else contextlib.nullcontext(sys.stdout.buffer)
+        )
+        try:
+            with client.Client(args.url) as t3, output as file:
+                for chunk in t3.export(args.format):
+                    file.write(chunk)
+        except BaseException:
+            # A partial export must not pass for a whole one.
+            if args.output:
+                pathlib.Path(args.output).unlink(missing_ok=True)
+            raise
+        return
+
+    if args.subparser_name == "start":
+        with client.Client(args.url) as t3:
+            seat = t3.new_game(args.name, args.board_size, args.win_length)
+        save_game_info(Game.from_seat(args.url, seat), cache_file)
+        print("Game ID:", seat.game_id)
+        return
+
+    if args.subparser_name == "join":
+        with client.Client(args.url) as t3:
+            seat = t3.join(args.game_id, args.name)
+        save_game_info(Game.from_seat(args.url, seat), cache_file)
+        return
+
+    game = load_game_info(cache_file)
+    with client.Client(game.url) as t3:
+        if args.subparser_name == "state":
+            print_game_state(t3.state(game.game_id))
+
+        if args.subparser_name == "wait":
+            if game.role is None:
+                print("Don't know which player you are. Please start or join again.")
+                exit(1)
+            t3.wait_for_turn(game.seat)
+            print_game_state(t3.state(game.game_id))
+
+        if args.subparser_name == "turn":
+            print_turn_result(t3, game, t3.play_turn(game.seat, args.row, args.column))
+
+        if args.subparser_name == "image-turn":
+            print_turn_result(t3, game, t3.play_image_turn(game.seat, args.image))
 
 
 def main() -> None:
@@ -109,15 +166,15 @@ def main() -> None:
     subparsers = parser.add_subparsers(dest="subparser_name")
 
     start_parser = subparsers.add_parser("start")
+    start_parser.add_argument("--url", help="server url")
+    start_parser.add_argument("--name", required=True)
+    start_parser.add_argument("--board-size", type=int, help="board side length")
     start_parser.add_argument(
-        "--url", default="http://localhost:8000", help="server url"
+        "--win-length", type=int, help="symbols in a row needed to win"
     )
-    start_parser.add_argument("--name", required=True)
 
     join_parser = subparsers.add_parser("join")
-    join_parser.add_argument(
-        "--url", default="http://localhost:8000", help="server url"
-    )
+    join_parser.add_argument("--url", help="server url")
     join_parser.add_argument("--name", required=True, help="player name")
     join_parser.add_argument("--game-id", required=True)
 
@@ -125,36 +182,65 @@ def main() -> None:
     turn_parser.add_argument("row", type=int)
     turn_parser.add_argument("column", type=int)
 
-    state_parser = subparsers.add_parser("state", help="print game state")
+    subparsers.add_parser("state", help="print game state")
+
+    subparsers.add_parser("wait", help="wait until it's your turn or the game is over")
 
     image_turn_parser = subparsers.add_parser("image-turn", help="play an image turn")
     image_turn_parser.add_argument("image", type=pathlib.Path)
 
-    args = parser.parse_args()
-
-    CACHE_FILE = pathlib.Path(args.cache_location)
-
-    if args.subparser_name == "start":
-        game = start_game(args.url, args.name)
-        save_game_info(game, CACHE_FILE)
-        print("Game ID:", game.game_id)
-        return
-
-    if args.subparser_name == "join":
-        game = join_game(args.url, args.name, args.game_id)
-        save_game_info(game, CACHE_FILE)
-        return
-
-    game = load_game_info(CACHE_FILE)
+    loadtest_parser = subparsers.add_parser(
+        "loadtest", help="play many matches at once and report latencies"
+    )
+    loadtest_parser.add_argument("--url", help="server url")
+    loadtest_parser.add_argument("--matches", type=int, default=100)
+    loadtest_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="matches played at once, and the connection limit",
+    )
+    loadtest_parser.add_argument(
+        "--rate",
+        type=float,
+        help="matches started per second, regardless of how many are running",
+    )
+    loadtest_parser.add_argument(
+        "--image-turns",
+        type=float,
+        default=0.0,
+        help="fraction of turns played with an image",
+    )
+    loadtest_parser.add_argument(
+        "--polls-per-turn",
+        type=float,
+        default=0.0,
+        help="average state polls before every turn",
+    )
+    loadtest_parser.add_argument("--seed", type=int)
 
-    if args.subparser_name == "state":
-        game.print_game_state()
+    export_parser = subparsers.add_parser(
+        "export", help="download all games with their moves"
+    )
+    export_parser.add_argument("--url", help="server url")
+    export_parser.add_argument(
+        "--format", choices=["ndjson", "binary"], default="ndjson"
+    )
+    export_parser.add_argument(
+        "--output", type=pathlib.Path, help="file to write, stdout by default"
+    )
 
-    if args.subparser_name == "turn":
-        game.play_turn(args.row, args.column)
+    args = parser.parse_args()
+    import httpx
 
-    if args.subparser_name == "image-turn":
-        game.play_image_turn(args.image)
+    try:
+        run(args)
+    except httpx.HTTPStatusError as error:
+        print(f"Server answered {error.response.status_code}: {error.response.text}")
+        sys.exit(1)
+    except httpx.TransportError as error:
+        print(f"Could not reach the server: {error}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+"""Plays many matches against a server at once and reports the throughput and
+latency percentiles of every endpoint, to find where the server saturates.
+
+Without a rate, `concurrency` matches are kept going, each starting as soon
+as another one ends (closed loop). With a rate, matches are started on a
+fixed schedule however slowly the server answers (open loop), so queueing
+shows up in the latencies instead of in a lower request rate.
+
+    python -m t3_client.client_main loadtest --url http://localhost:8000 \\
+        --matches 500 --concurrency 50 --image-turns 0.2 --polls-per-turn 1
+"""
+
+from __future__ import annotations
+from typing import Awaitable, Callable, Optional, TypeVar
+import asyncio
+import collections
+import dataclasses
+import io
+import math
+import random
+import time
+
+import httpx
+from PIL import Image, ImageDraw
+
+from t3_client import client
+
+# A 3x3 game that is drawn, so it takes the most turns.
+DRAWN_GAME = [(0, 0), (1, 1), (2, 2), (0, 1), (2, 1), (2, 0), (0, 2), (1, 2), (1, 0)]
+BOARD_SIZE = 3
+CELL_PIXELS = 96
+LINE_WIDTH = 6
+# Random specks are drawn in this corner of the image, which the server crops
+# away, so that every image is recognized rather than served from its cache.
+SPECK_CORNER_PIXELS = 8
+PERCENTILES = (50, 90, 99)
+
+T = TypeVar("T")
+
+
+@dataclasses.dataclass(frozen=True)
+class LoadSettings:
+    matches: int = 100
+    concurrency: int = 10
+    # Matches started per second, None to run closed loop.
+    rate: Optional[float] = None
+    # The fraction of turns played with an image.
+    image_turns: float = 0.0
+    # State polls before every turn, on average.
+    polls_per_turn: float = 0.0
+    seed: Optional[int] = None
+
+
+@dataclasses.dataclass
+class EndpointStats:
+    latencies: list[float] = dataclasses.field(default_factory=list)
+    errors: int = 0
+    # Requests turned away with a 503, and retried.
+    shed: int = 0
+
+    def percentile(self, percent: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+@dataclasses.dataclass
+class LoadReport:
+    elapsed_seconds: float = 0.0
+    matches_played: int = 0
+    matches_failed: int = 0
+    endpoints: dict[str, EndpointStats] = dataclasses.field(
+        default_factory=lambda: collections.defaultdict(EndpointStats)
+    )
+
+    async def timed(self, endpoint: str, request: Awaitable[T]) -> T:
+        stats = self.endpoints[endpoint]
+        start = time.perf_counter()
+        try:
+            return await request
+        except httpx.HTTPStatusError as error:
+            if error.response.status_code == httpx.codes.SERVICE_UNAVAILABLE:
+                stats.shed += 1
+            else:
+                stats.errors += 1
+            raise
+        except httpx.HTTPError:
+            stats.errors += 1
+            raise
+        finally:
+            stats.latencies.append(time.perf_counter() - start)
+
+    def format(self) -> str:
+        elapsed = max(self.elapsed_seconds, 1e-9)
+        lines = [
+            f"{self.matches_played} matches played, {self.matches_failed} failed"
+            f" in {self.elapsed_seconds:.1f}s"
+            f" ({self.matches_played / elapsed:.1f} matches/s)",
+            f"{'endpoint':<16}{'requests':>9}{'errors':>7}{'shed':>7}{'req/s':>9}"
+            + "".join(f"{f'p{percent} ms':>9}" for percent in PERCENTILES)
+            + f"{'max ms':>9}",
+        ]
+        for endpoint, stats in sorted(self.endpoints.items()):
+            if not stats.latencies:
+                continue
+            lines.append(
+                f"{endpoint:<16}{len(stats.latencies):>9}{stats.errors:>7}{stats.shed:>7}"
+                f"{len(stats.latencies) / elapsed:>9.1f}"
+                + "".join(
+                    f"{stats.percentile(percent) * 1000:>9.1f}"
+                    for percent in PERCENTILES
+                )
+                + f"{max(stats.latencies) * 1000:>9.1f}"
+            )
+        return "\n".join(lines)
+
+
+def render_board(board: list[list[str]], rng: random.Random) -> bytes:
+    """A PNG of the board, that the server's image recognition reads back."""
+    side = CELL_PIXELS * len(board)
+    image = Image.new("L", (side, side), 255)
+    draw = ImageDraw.Draw(image)
+    for line in range(1, len(board)):
+        offset = line * CELL_PIXELS
+        draw.line([(offset, 0), (offset, side)], fill=0, width=LINE_WIDTH // 2)
+        draw.line([(0, offset), (side, offset)], fill=0, width=LINE_WIDTH // 2)
+    padding = CELL_PIXELS // 4
+    for row, symbols in enumerate(board):
+        for col, symbol in enumerate(symbols):
+            left = col * CELL_PIXELS + padding
+            top = row * CELL_PIXELS + padding
+            right = (col + 1) * CELL_PIXELS - padding
+            bottom = (row + 1) * CELL_PIXELS - padding
+            if symbol == "X":
+                draw.line([(left, top), (right, bottom)], fill=0, width=LINE_WIDTH)
+                draw.line([(left, bottom), (right, top)], fill=0, width=LINE_WIDTH)
+            elif symbol == "O":
+                draw.ellipse([left, top, right, bottom], outline=0, width=LINE_WIDTH)
+    for _ in range(SPECK_CORNER_PIXELS):
+        image.putpixel(
+            (rng.randrange(SPECK_CORNER_PIXELS), rng.randrange(SPECK_CORNER_PIXELS)), 0
+        )
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def poll_count(settings: LoadSettings, rng: random.Random) -> int:
+    whole = int(settings.polls_per_turn)
+    return whole + (rng.random() < settings.polls_per_turn - whole)
+
+
+async def retry_shed(
+    report: LoadReport, endpoint: str, request: Callable[[], Awaitable[T]]
+) -> T:
+    """Retries the request for as long as the server sheds it, waiting as
+    long as it asks to."""
+    while True:
+        try:
+            return await report.timed(endpoint, request())
+        except httpx.HTTPStatusError as error:
+            if error.response.status_code != httpx.codes.SERVICE_UNAVAILABLE:
+                raise
+            await asyncio.sleep(float(error.response.headers.get("Retry-After", 1)))
+
+
+async def play_match(
+    t3: client.AsyncClient,
+    settings: LoadSettings,
+    report: LoadReport,
+    rng: random.Random,
+) -> None:
+    first = await report.timed("new_game", t3.new_game("load-1"))
+    second = await report.timed("join", t3.join(first.game_id, "load-2"))
+    view = await report.timed("state", t3.state(first.game_id))
+    seats = (
+        [first, second] if view.current_turn == client.FIRST_PLAYER else [second, first]
+    )
+    board = [["_"] * BOARD_SIZE for _ in range(BOARD_SIZE)]
+    for turn, (row, col) in enumerate(DRAWN_GAME):
+        for _ in range(poll_count(settings, rng)):
+            await report.timed("state", t3.state(first.game_id))
+        seat = seats[turn % 2]
+        board[row][col] = "X" if turn % 2 == 0 else "O"
+        if rng.random() < settings.image_turns:
+            image = render_board(board, rng)
+            await retry_shed(
+                report, "play_turn_image", lambda: t3.play_image_turn(seat, image)
+            )
+        else:
+            await report.timed("play_turn", t3.play_turn(seat, row, col))
+
+
+async def run(t3: client.AsyncClient, settings: LoadSettings) -> LoadReport:
+    report = LoadReport()
+    rng = random.Random(settings.seed)
+
+    async def play(match_rng: random.Random) -> None:
+        try:
+            await play_match(t3, settings, report, match_rng)
+            report.matches_played += 1
+        except httpx.HTTPError:
+            report.matches_failed += 1
+
+    start = time.monotonic()
+    if settings.rate is None:
+        remaining = iter(range(settings.matches))
+
+        async def keep_playing() -> None:
+            for _ in remaining:
+                await play(random.Random(rng.random()))
+
+        await asyncio.gather(*(keep_playing() for _ in range(settings.concurrency)))
+    else:
+        matches = []
+        for match in range(settings.matches):
+            await asyncio.sleep(
+                max(0.0, start + match / settings.rate - time.monotonic())
+            )
+            matches.append(asyncio.create_task(play(random.Random(rng.random()))))
+        await asyncio.gather(*matches)
+    report.elapsed_seconds = time.monotonic() - start
+    return report
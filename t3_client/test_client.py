@@ -0,0 +1,86 @@
+import asyncio
+import subprocess
+import sys
+import httpx
+import pytest
+from fastapi import testclient
+
+from server import server_main
+from t3_client import client
+
+
+@pytest.fixture
+def t3() -> client.Client:
+    return client.Client(http=testclient.TestClient(server_main.app))
+
+
+def test_whole_game(t3: client.Client) -> None:
+    first = t3.new_game("player1")
+    second = t3.join(first.game_id, "player2")
+    view = t3.state(first.game_id)
+    assert view.second_player_name == "player2"
+    assert t3.state(first.game_id) == view
+
+    seats = (
+        [first, second] if view.current_turn == client.FIRST_PLAYER else [second, first]
+    )
+    results = [
+        t3.play_turn(seats[turn % 2], row, col)
+        for turn, (row, col) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)])
+    ]
+    assert not any(result.is_over for result in results[:-1])
+    winner = "player1" if seats[0] is first else "player2"
+    assert results[-1] == client.TurnResult(result="won", winner=winner)
+    assert t3.state(first.game_id).version == 6
+
+    # Returns right away, since the game is over.
+    t3.wait_for_turn(seats[1])
+
+
+def test_errors(t3: client.Client) -> None:
+    seat = t3.new_game("player1")
+    with pytest.raises(httpx.HTTPStatusError):
+        t3.play_turn(seat, 20, 0)
+
+
+def test_async_games_against_server() -> None:
+    async def play(t3: client.AsyncClient) -> client.TurnResult:
+        seat = await t3.new_game("player1", against_server=True)
+        for row, col in [(row, col) for row in range(3) for col in range(3)]:
+            if (await t3.state(seat.game_id)).board[row][col] == "_":
+                result = await t3.play_turn(seat, row, col)
+                if result.is_over:
+                    return result
+        raise AssertionError("game didn't end")
+
+    async def main() -> list[client.TurnResult]:
+        transport = httpx.ASGITransport(app=server_main.app)
+        http = httpx.AsyncClient(transport=transport, base_url="http://test")
+        async with client.AsyncClient(http=http) as t3:
+            return await asyncio.gather(*(play(t3) for _ in range(10)))
+
+    results = asyncio.run(main())
+    assert all(result.winner != "player1" for result in results)
+
+
+def test_matchmake(t3: client.Client) -> None:
+    first, first_matched = t3.matchmake("player1", board_size=5)
+    second, second_matched = t3.matchmake("player2", board_size=5)
+    assert (first.game_id, first.role, first_matched) == (
+        second.game_id,
+        client.FIRST_PLAYER,
+        False,
+    )
+    assert (second.role, second_matched) == (client.SECOND_PLAYER, True)
+
+
+def test_cli_imports_lazily() -> None:
+    # In a fresh interpreter, since the other tests load them.
+    code = (
+        "import sys, t3_client.client_main; "
+        "print(*sorted(sys.modules.keys() & {'httpx', 'PIL', 't3_client.client'}))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
@@ -0,0 +1,25 @@
+import asyncio
+import httpx
+
+from server import server_main
+from t3_client import client, loadtest
+
+
+def test_loadtest_against_server() -> None:
+    settings = loadtest.LoadSettings(
+        matches=6, concurrency=3, image_turns=0.3, polls_per_turn=0.5, seed=1
+    )
+
+    async def main() -> loadtest.LoadReport:
+        transport = httpx.ASGITransport(app=server_main.app)
+        http = httpx.AsyncClient(transport=transport, base_url="http://test")
+        async with client.AsyncClient(http=http) as t3:
+            return await loadtest.run(t3, settings)
+
+    report = asyncio.run(main())
+    assert (report.matches_played, report.matches_failed) == (6, 0)
+    turns = report.endpoints["play_turn"], report.endpoints["play_turn_image"]
+    played = sum(len(stats.latencies) - stats.shed for stats in turns)
+    assert played == 6 * len(loadtest.DRAWN_GAME)
+    assert report.endpoints["play_turn_image"].latencies
+    assert "play_turn_image" in report.format()